@@ -1,3 +1,4 @@
+import logging
 import os
 import json
 import urllib.parse
@@ -8,10 +9,11 @@ from google_auth_oauthlib.flow import Flow
 from google.oauth2 import id_token
 from google.auth.transport import requests as google_requests
 from google.oauth2.credentials import Credentials
-import google.auth.transport.requests
+from services import credential_cache, tracing
 from services.google_service import ensure_drive_index
 import asyncio
-from datetime import datetime
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
@@ -32,53 +34,36 @@ GOOGLE_REDIRECT_URI = os.getenv("GOOGLE_REDIRECT_URI")
 FRONTEND_URL = os.getenv("FRONTEND_URL", "http://localhost:5173/")
 
 # --- Token Verification (Session Based) ---
+@tracing.traced("auth.verify_token")
 async def verify_google_token(request: Request) -> tuple[str, Credentials]:
     session_creds_dict = request.session.get('google_credentials')
     user_id = request.session.get('user_id')
 
     if not session_creds_dict or not user_id:
-        print("Verification failed: No token or user_id in session")
+        logger.warning("Verification failed: No token or user_id in session")
         raise HTTPException(status_code=401, detail="Not authenticated")
 
     try:
-        # Reconstruct credentials object from stored dictionary
-        creds = Credentials(**session_creds_dict)
-
-        # Handle expiry string conversion back to datetime
-        if creds.expiry and isinstance(creds.expiry, str):
-            creds.expiry = datetime.fromisoformat(creds.expiry)
-
-        # Check if token is expired and needs refresh
-        if creds.expired and creds.refresh_token:
-            print(f"Token expired for user {user_id}, attempting refresh...")
-            try:
-                auth_req = google.auth.transport.requests.Request()
-                creds.refresh(auth_req)
-                print(f"Token refreshed successfully for user {user_id}.")
-                # Update session with refreshed credentials
-                refreshed_creds_dict = {
-                    'token': creds.token,
-                    'refresh_token': creds.refresh_token,  # Use potentially new refresh token
-                    'token_uri': creds.token_uri,
-                    'client_id': creds.client_id,
-                    'client_secret': creds.client_secret,
-                    'scopes': creds.scopes,
-                    'expiry': creds.expiry.isoformat() if creds.expiry else None
-                }
-                request.session['google_credentials'] = refreshed_creds_dict
-            except Exception as refresh_error:
-                print(f"Error refreshing token for user {user_id}: {refresh_error}")
-                # If refresh fails, force re-authentication
-                request.session.pop('google_credentials', None)
-                request.session.pop('user_id', None)
-                raise HTTPException(status_code=401, detail="Token expired, refresh failed. Please login again.")
-
-        print(f"✅ Session check OK: user_id={user_id}, creds_valid={creds.valid}")
-        return user_id, creds
-
+        # Cached per user; refreshed ahead of expiry, once, off the event loop
+        creds = await credential_cache.get_credentials(user_id, session_creds_dict)
+    except credential_cache.RefreshFailed as refresh_error:
+        logger.error(f"Error refreshing token for user {user_id}: {refresh_error}")
+        # If refresh fails, force re-authentication
+        request.session.pop('google_credentials', None)
+        request.session.pop('user_id', None)
+        raise HTTPException(status_code=401, detail="Token expired, refresh failed. Please login again.")
+    except credential_cache.RefreshUnavailable as refresh_error:
+        logger.warning(f"Could not reach Google to refresh the token for user {user_id}: {refresh_error}")
+        raise HTTPException(status_code=503, detail="Could not renew your Google session. Please try again shortly.")
     except Exception as e:
-        # Handle potential errors during verification (e.g., invalid token format)
-        print(f"Token verification exception: {e}")
+        # e.g. malformed credentials in the session
+        logger.error(f"Token verification exception: {e}")
+        raise HTTPException(status_code=401, detail="Not authenticated")
+
+    if session_creds_dict.get('token') != creds.token:
+        # Refreshed since the cookie was written (possibly by another request)
+        request.session['google_credentials'] = credential_cache.to_session(creds)
+    return user_id, creds
 
 # --- Start OAuth2 Login ---
 @router.get("/local-login")
@@ -113,7 +98,7 @@ async def local_login(request: Request):
         prompt="consent",
     )
 
-    print(f"🚀 Forced v2 Authorization URL: {authorization_url}")
+    logger.debug(f"🚀 Forced v2 Authorization URL: {authorization_url}")
 
     return RedirectResponse(authorization_url)
 
@@ -146,9 +131,9 @@ async def oauth2callback(request: Request):
     )
 
     try:
-        print(f"🚀 Fetching token with code: {code}")
+        logger.debug(f"🚀 Fetching token with code: {code}")
         flow.fetch_token(code=code)
-        print(f"✅ Token successfully fetched.")
+        logger.debug(f"✅ Token successfully fetched.")
     except Exception as e:
         # Check if the exception has response attribute with details
         error_detail = str(e)
@@ -159,7 +144,7 @@ async def oauth2callback(request: Request):
             except Exception:  # Ignore if response is not JSON or parsing fails
                 pass
 
-        print(f"❌ Error fetching token: {error_detail}")
+        logger.error(f"❌ Error fetching token: {error_detail}")
         # Redirect back to frontend with error message
         error_params = {"error": "token_fetch_failed", "error_description": error_detail}
         error_redirect_url = f"{FRONTEND_URL}#{urllib.parse.urlencode(error_params)}"
@@ -182,34 +167,22 @@ async def oauth2callback(request: Request):
         user_id = id_info.get('sub')
         if not user_id:
             raise ValueError("Could not extract user ID (sub) from ID token.")
-        print(f"✅ ID Token verified for user_id: {user_id}")
+        logger.info(f"✅ ID Token verified for user_id: {user_id}")
     except Exception as e:
-        print(f"❌ ID Token verification failed: {e}")
+        logger.error(f"❌ ID Token verification failed: {e}")
         error_params = {"error": "id_token_verify_failed", "error_description": str(e)}
         error_redirect_url = f"{FRONTEND_URL}#{urllib.parse.urlencode(error_params)}"
         return RedirectResponse(error_redirect_url)
 
     # Store essential, serializable credential info in session
-    session_credentials = {
-        'token': credentials.token,
-        'refresh_token': credentials.refresh_token,
-        'token_uri': credentials.token_uri,
-        'client_id': credentials.client_id,
-        'client_secret': credentials.client_secret,
-        'scopes': credentials.scopes,
-        # Store expiry as ISO format string for JSON serialization
-        'expiry': credentials.expiry.isoformat() if credentials.expiry else None
-    }
+    session_credentials = credential_cache.to_session(credentials)
     request.session['google_credentials'] = session_credentials
     request.session['user_id'] = user_id  # Store user_id separately
 
-    # Also update/create the drive index immediately after login
-    # We need the Credentials object here, so reconstruct it temporarily
-    # NOTE: This reconstruction is okay here as we just got the creds
-    login_creds = Credentials(**session_credentials)
-    # Handle expiry string conversion back to datetime
-    if login_creds.expiry and isinstance(login_creds.expiry, str):
-        login_creds.expiry = datetime.fromisoformat(login_creds.expiry)
+    # Also update/create the drive index immediately after login, with the
+    # same credentials object later requests will get from the cache
+    login_creds = credential_cache.from_session(session_credentials)
+    credential_cache.store(user_id, login_creds)
 
     # await ensure_drive_index(user_id, login_creds)  # Pass Credentials object
 
@@ -219,12 +192,12 @@ async def oauth2callback(request: Request):
         "cache_status": "pending"  # Indicate successful login via session
     }
     redirect_url = f"{FRONTEND_URL}#{urllib.parse.urlencode(params)}"
-    print(f"🚀 Redirecting frontend to: {redirect_url}")
+    logger.debug(f"🚀 Redirecting frontend to: {redirect_url}")
 
     # Run Drive indexing in the background (don't block redirect)
     # await ensure_drive_index(user_id, access_token)
     asyncio.create_task(ensure_drive_index(user_id, login_creds))
-    print("🚀 Spawned background task for Drive indexing.")
+    logger.info("🚀 Spawned background task for Drive indexing.")
 
     return RedirectResponse(redirect_url)
 
@@ -0,0 +1,258 @@
+# benchmarks/fake_drive.py
+# In-memory stand-ins for the Drive v3 and Docs v1 API clients, backed by a
+# synthetic folder tree, so the Drive code paths can be benchmarked without
+# OAuth or network access.
+#
+# Only the calls google_service makes are implemented: files.list (parent,
+# name and mimeType queries, with paging), files.get, files.update (moves),
+# files.export_media / get_media, changes.getStartPageToken / changes.list,
+# and documents.get / create / batchUpdate. Every `execute()` / `download()`
+# sleeps for the configured latency on the calling thread, like a blocking
+# HTTP call would.
+
+import datetime
+import random
+import re
+import threading
+import time
+from dataclasses import dataclass
+
+FOLDER_MIME = "application/vnd.google-apps.folder"
+DOC_MIME = "application/vnd.google-apps.document"
+FILE_MIME_TYPES = [
+    (DOC_MIME, 0.5),
+    ("application/vnd.google-apps.spreadsheet", 0.2),
+    ("application/vnd.google-apps.presentation", 0.1),
+    ("application/pdf", 0.1),
+    ("text/plain", 0.1),
+]
+WORDS = (
+    "budget plan roadmap meeting notes report quarterly design spec review draft final launch "
+    "marketing sales research proposal summary invoice contract hiring onboarding strategy "
+    "analysis metrics retro project team client product release migration security audit"
+).split()
+
+_PARENT_RE = re.compile(r"'((?:[^'\\]|\\.)*)' in parents")
+_NAME_RE = re.compile(r"name\s*=\s*'((?:[^'\\]|\\.)*)'")
+_MIME_RE = re.compile(r"mimeType\s*=\s*'([^']*)'")
+
+
+@dataclass
+class DriveShape:
+    depth: int = 3               # Folder levels below the root
+    fanout: int = 5              # Subfolders per folder
+    files_per_folder: int = 10
+    doc_chars: int = 8000        # Approximate text size of each Doc / text file
+    seed: int = 0
+
+
+@dataclass
+class Latency:
+    """Simulated API latency, in seconds."""
+    mean: float = 0.05
+    jitter: float = 0.02
+
+    def sleep(self, rng: random.Random):
+        time.sleep(max(0.0, self.mean + rng.uniform(-self.jitter, self.jitter)))
+
+
+class SyntheticDrive:
+    """One user's Drive: a tree of `shape.depth` folder levels."""
+
+    def __init__(self, shape: DriveShape, latency: Latency, owner: str = "user"):
+        self.shape = shape
+        self.latency = latency
+        self.root_id = f"root-{owner}"
+        self.files: dict[str, dict] = {}
+        self.children: dict[str, list[str]] = {self.root_id: []}
+        self._rng = random.Random(shape.seed)
+        self._latency_rng = random.Random(shape.seed + 1)
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self._build(self.root_id, 0)
+
+    # --- generation ---
+    def _new_id(self, prefix: str) -> str:
+        self._next_id += 1
+        return f"{prefix}{self._next_id:07d}"
+
+    def _name(self) -> str:
+        return " ".join(self._rng.sample(WORDS, 2)).title() + f" {self._next_id}"
+
+    def _add(self, parent_id: str, mime_type: str) -> str:
+        item_id = self._new_id("f" if mime_type != FOLDER_MIME else "d")
+        modified = datetime.datetime(2025, 1, 1, tzinfo=datetime.timezone.utc) + datetime.timedelta(
+            minutes=self._rng.randrange(0, 60 * 24 * 365)
+        )
+        self.files[item_id] = {
+            "id": item_id,
+            "name": self._name(),
+            "mimeType": mime_type,
+            "parents": [parent_id],
+            "modifiedTime": modified.isoformat().replace("+00:00", ".000Z"),
+        }
+        self.children.setdefault(parent_id, []).append(item_id)
+        if mime_type == FOLDER_MIME:
+            self.children.setdefault(item_id, [])
+        return item_id
+
+    def _build(self, folder_id: str, level: int):
+        mime_types, weights = zip(*FILE_MIME_TYPES)
+        for _ in range(self.shape.files_per_folder):
+            self._add(folder_id, self._rng.choices(mime_types, weights)[0])
+        if level < self.shape.depth:
+            for _ in range(self.shape.fanout):
+                self._build(self._add(folder_id, FOLDER_MIME), level + 1)
+
+    def text_of(self, item_id: str) -> str:
+        """Deterministic pseudo-prose for a document."""
+        rng = random.Random(item_id)
+        lines, size = [], 0
+        while size < self.shape.doc_chars:
+            line = " ".join(rng.choice(WORDS) for _ in range(rng.randint(8, 20))).capitalize() + "."
+            lines.append(line)
+            size += len(line) + 1
+        return "\n".join(lines)
+
+    def items_of_type(self, mime_type: str | None = None) -> list[dict]:
+        return [f for f in self.files.values() if mime_type is None or f["mimeType"] == mime_type]
+
+    # --- API surface ---
+    def call(self, fn):
+        self.latency.sleep(self._latency_rng)
+        with self._lock:
+            return fn()
+
+    def drive_service(self) -> "FakeDriveService":
+        return FakeDriveService(self)
+
+    def docs_service(self) -> "FakeDocsService":
+        return FakeDocsService(self)
+
+
+class FakeRequest:
+    """Mimics googleapiclient's HttpRequest: `execute()` / a media download."""
+
+    def __init__(self, drive: SyntheticDrive, fn):
+        self.drive = drive
+        self.fn = fn
+        self.http = None
+
+    def execute(self, http=None, num_retries=0):
+        return self.drive.call(self.fn)
+
+    def download(self) -> bytes:
+        return self.drive.call(self.fn)
+
+
+class _Files:
+    def __init__(self, drive: SyntheticDrive):
+        self.drive = drive
+
+    def list(self, q: str = "", pageSize: int = 100, pageToken: str | None = None, **_):
+        def run():
+            parent = _PARENT_RE.search(q)
+            name = _NAME_RE.search(q)
+            mime = _MIME_RE.search(q)
+            if parent:
+                parent_id = self.drive.root_id if parent.group(1) == "root" else parent.group(1)
+                candidates = [self.drive.files[i] for i in self.drive.children.get(parent_id, [])]
+            else:
+                candidates = list(self.drive.files.values())
+            if name:
+                wanted = name.group(1).replace("\\'", "'")
+                candidates = [f for f in candidates if f["name"] == wanted]
+            if mime:
+                candidates = [f for f in candidates if f["mimeType"] == mime.group(1)]
+            start = int(pageToken or 0)
+            page = [dict(f) for f in candidates[start:start + pageSize]]
+            resp = {"files": page}
+            if start + pageSize < len(candidates):
+                resp["nextPageToken"] = str(start + pageSize)
+            return resp
+        return FakeRequest(self.drive, run)
+
+    def get(self, fileId: str, **_):
+        def run():
+            if fileId == "root":
+                return {"id": self.drive.root_id}
+            return dict(self.drive.files[fileId])
+        return FakeRequest(self.drive, run)
+
+    def update(self, fileId: str, addParents: str | None = None, removeParents: str | None = None, **_):
+        def run():
+            item = self.drive.files[fileId]
+            if removeParents:
+                self.drive.children[removeParents].remove(fileId)
+            if addParents:
+                self.drive.children.setdefault(addParents, []).append(fileId)
+            item["parents"] = [addParents] if addParents else item["parents"]
+            return {"id": fileId, "parents": item["parents"]}
+        return FakeRequest(self.drive, run)
+
+    def export_media(self, fileId: str, mimeType: str = "text/plain"):
+        return FakeRequest(self.drive, lambda: self.drive.text_of(fileId).encode("utf-8"))
+
+    def get_media(self, fileId: str, **_):
+        return FakeRequest(self.drive, lambda: self.drive.text_of(fileId).encode("utf-8"))
+
+
+class _Changes:
+    def __init__(self, drive: SyntheticDrive):
+        self.drive = drive
+
+    def getStartPageToken(self, **_):
+        return FakeRequest(self.drive, lambda: {"startPageToken": "1"})
+
+    def list(self, pageToken: str, **_):
+        # The synthetic tree doesn't change between syncs
+        return FakeRequest(self.drive, lambda: {"changes": [], "newStartPageToken": pageToken})
+
+
+class FakeDriveService:
+    def __init__(self, drive: SyntheticDrive):
+        self.drive = drive
+
+    def files(self) -> _Files:
+        return _Files(self.drive)
+
+    def changes(self) -> _Changes:
+        return _Changes(self.drive)
+
+
+class _Documents:
+    def __init__(self, drive: SyntheticDrive):
+        self.drive = drive
+
+    def get(self, documentId: str, **_):
+        def run():
+            content, index = [], 1
+            for line in self.drive.text_of(documentId).split("\n"):
+                text = line + "\n"
+                end = index + len(text)
+                content.append({
+                    "startIndex": index,
+                    "endIndex": end,
+                    "paragraph": {"elements": [{"startIndex": index, "endIndex": end, "textRun": {"content": text}}]},
+                })
+                index = end
+            return {"documentId": documentId, "revisionId": "rev-1", "body": {"content": content}}
+        return FakeRequest(self.drive, run)
+
+    def create(self, body: dict):
+        def run():
+            item_id = self.drive._add(self.drive.root_id, DOC_MIME)
+            self.drive.files[item_id]["name"] = body.get("title", "Untitled")
+            return {"documentId": item_id}
+        return FakeRequest(self.drive, run)
+
+    def batchUpdate(self, documentId: str, body: dict):
+        return FakeRequest(self.drive, lambda: {"documentId": documentId, "replies": [{} for _ in body.get("requests", [])]})
+
+
+class FakeDocsService:
+    def __init__(self, drive: SyntheticDrive):
+        self.drive = drive
+
+    def documents(self) -> _Documents:
+        return _Documents(self.drive)
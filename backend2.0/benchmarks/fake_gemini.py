@@ -0,0 +1,104 @@
+# benchmarks/fake_gemini.py
+# Stand-in for google.generativeai models: configurable time-to-first-token,
+# streaming rate and reply length, and no network. Installed by replacing
+# gemini_models.get_model, which every Gemini caller goes through.
+#
+# The instruction parser gets a JSON reply (so /api/ask takes its normal
+# paths); everything else gets filler prose of `reply_tokens` tokens.
+
+import asyncio
+import json
+import random
+import zlib
+from dataclasses import dataclass
+
+from benchmarks.fake_drive import WORDS
+
+
+@dataclass
+class GeminiProfile:
+    first_token: float = 0.4     # Seconds before the first chunk
+    tokens_per_second: float = 200.0
+    reply_tokens: int = 150
+    chunk_tokens: int = 20       # Tokens per streamed chunk
+
+
+class FakeChunk:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class FakeResponse:
+    """Both shapes of a Gemini response: `.text`, or `async for chunk in response`."""
+
+    def __init__(self, profile: GeminiProfile, text: str, on_done=None):
+        self.profile = profile
+        self._text = text
+        self._on_done = on_done
+
+    @property
+    def text(self) -> str:
+        return self._text
+
+    async def __aiter__(self):
+        words = self._text.split(" ")
+        step = max(1, self.profile.chunk_tokens)
+        for i in range(0, len(words), step):
+            await asyncio.sleep(step / self.profile.tokens_per_second)
+            yield FakeChunk(" ".join(words[i:i + step]) + (" " if i + step < len(words) else ""))
+        if self._on_done:
+            self._on_done()
+
+
+class FakeModel:
+    def __init__(self, profile: GeminiProfile, system_instruction: str | None = None):
+        self.profile = profile
+        self.system_instruction = system_instruction or ""
+
+    def _reply(self, prompt: str) -> str:
+        if self.system_instruction.startswith("You are an instruction parser"):
+            return json.dumps({"action_to_perform": "none"})
+        rng = random.Random(zlib.crc32(prompt.encode("utf-8")))
+        return " ".join(rng.choice(WORDS) for _ in range(self.profile.reply_tokens))
+
+    async def generate_content_async(self, prompt: str, stream: bool = False, on_done=None) -> FakeResponse:
+        text = self._reply(prompt)
+        await asyncio.sleep(self.profile.first_token)
+        if not stream:
+            # A non-streamed reply arrives all at once, after the whole generation
+            await asyncio.sleep(self.profile.reply_tokens / self.profile.tokens_per_second)
+        return FakeResponse(self.profile, text, on_done)
+
+    def start_chat(self, history: list | None = None) -> "FakeChat":
+        return FakeChat(self, list(history or []))
+
+
+class FakeChat:
+    def __init__(self, model: FakeModel, history: list):
+        self.model = model
+        self.history = history
+
+    async def send_message_async(self, prompt: str, stream: bool = False) -> FakeResponse:
+        def record():
+            self.history += [{"role": "user", "parts": [prompt]}, {"role": "model", "parts": [response.text]}]
+
+        response = await self.model.generate_content_async(prompt, stream=stream, on_done=record)
+        if not stream:
+            record()
+        return response
+
+
+def install(profile: GeminiProfile):
+    """Routes every gemini_models.get_model() call to a FakeModel."""
+    from services import gemini_models
+
+    models: dict[str, FakeModel] = {}
+
+    def get_model(model_name: str = gemini_models.GEMINI_MODEL_NAME, system_instruction: str | None = None,
+                  generation_config: dict | None = None) -> FakeModel:
+        key = system_instruction or ""
+        if key not in models:
+            models[key] = FakeModel(profile, system_instruction)
+        return models[key]
+
+    gemini_models.get_model = get_model
@@ -0,0 +1,275 @@
+# benchmarks/run.py
+# Offline load benchmark for the /api/ask pipeline and the Drive code paths
+# under it. Drive, Docs and Gemini are replaced by in-process fakes
+# (fake_drive, fake_gemini) with configurable latency, and every cache the
+# services write goes to a throwaway directory, so runs are repeatable and
+# need no credentials:
+#
+#   cd backend2.0
+#   python -m benchmarks.run --users 4 --requests 200 --concurrency 16
+#   python -m benchmarks.run --depth 4 --fanout 6 --json before.json
+#
+# For each operation it reports p50/p95/p99 latency, throughput and errors,
+# plus the process's peak RSS after each phase. Run it before and after
+# touching a hot path and compare.
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import pathlib
+import random
+import resource
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, field
+
+BACKEND_DIR = pathlib.Path(__file__).resolve().parent.parent
+
+
+@dataclass
+class PhaseResult:
+    name: str
+    requests: int
+    errors: int
+    seconds: float
+    latencies: list[float] = field(repr=False, default_factory=list)
+    peak_rss_mb: float = 0.0
+
+    def percentile(self, p: float) -> float:
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))]
+
+    def summary(self) -> dict:
+        return {
+            "name": self.name,
+            "requests": self.requests,
+            "errors": self.errors,
+            "p50_ms": self.percentile(50) * 1000,
+            "p95_ms": self.percentile(95) * 1000,
+            "p99_ms": self.percentile(99) * 1000,
+            "throughput_rps": self.requests / self.seconds if self.seconds else 0.0,
+            "peak_rss_mb": self.peak_rss_mb,
+        }
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024  # bytes on macOS, KiB on Linux
+
+
+async def run_phase(name: str, call, total: int, concurrency: int) -> PhaseResult:
+    """Runs `call(i)` for i in range(total), at most `concurrency` at a time."""
+    semaphore = asyncio.Semaphore(concurrency)
+    result = PhaseResult(name, total, 0, 0.0)
+
+    async def one(i: int):
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await call(i)
+            except Exception as e:
+                result.errors += 1
+                if result.errors <= 3:
+                    print(f"[{name}] request {i} failed: {e!r}", file=sys.__stderr__)
+            result.latencies.append(time.perf_counter() - start)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total)))
+    result.seconds = time.perf_counter() - started
+    result.peak_rss_mb = peak_rss_mb()
+    return result
+
+
+def print_report(results: list[PhaseResult], out=sys.stdout):
+    header = f"{'operation':<34}{'requests':>9}{'errors':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>10}{'peak RSS MB':>13}"
+    print(header, file=out)
+    print("-" * len(header), file=out)
+    for r in results:
+        s = r.summary()
+        print(f"{s['name']:<34}{s['requests']:>9}{s['errors']:>7}{s['p50_ms']:>10.1f}{s['p95_ms']:>10.1f}"
+              f"{s['p99_ms']:>10.1f}{s['throughput_rps']:>10.1f}{s['peak_rss_mb']:>13.1f}", file=out)
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Offline benchmark for the Drive/Gemini request pipeline.")
+    tree = parser.add_argument_group("synthetic Drive")
+    tree.add_argument("--users", type=int, default=4, help="users, each with their own Drive")
+    tree.add_argument("--depth", type=int, default=3, help="folder levels below the root")
+    tree.add_argument("--fanout", type=int, default=5, help="subfolders per folder")
+    tree.add_argument("--files-per-folder", type=int, default=10)
+    tree.add_argument("--doc-chars", type=int, default=8000, help="approximate text size of each document")
+    tree.add_argument("--drive-latency-ms", type=float, default=50.0)
+    tree.add_argument("--drive-jitter-ms", type=float, default=20.0)
+    tree.add_argument("--crawl-rps", type=float, default=1000.0,
+                      help="per-user Drive request budget (DRIVE_CRAWL_RPS); the production default is 20")
+    tree.add_argument("--sync-interval", type=float, default=30.0,
+                      help="DRIVE_SYNC_INTERVAL; 0 makes every warm request run an incremental sync")
+
+    gemini = parser.add_argument_group("fake Gemini")
+    gemini.add_argument("--gemini-first-token-ms", type=float, default=400.0)
+    gemini.add_argument("--gemini-tokens-per-second", type=float, default=200.0)
+    gemini.add_argument("--gemini-reply-tokens", type=int, default=150)
+    gemini.add_argument("--gemini-cache", action="store_true", help="leave the Gemini response cache on")
+
+    load = parser.add_argument_group("load")
+    load.add_argument("--requests", type=int, default=200, help="requests per phase")
+    load.add_argument("--concurrency", type=int, default=16)
+    load.add_argument("--crawl-runs", type=int, default=4, help="full crawls timed in the crawl phase")
+    load.add_argument("--stream", action="store_true", help="drive /ask with token streaming (as /ask/stream does)")
+    load.add_argument("--seed", type=int, default=0)
+    load.add_argument("--json", type=pathlib.Path, help="also write the results to this file")
+    load.add_argument("--keep-cache", action="store_true", help="keep the temporary cache directory")
+    load.add_argument("--verbose", action="store_true", help="show the services' own log output")
+    return parser.parse_args(argv)
+
+
+def configure_environment(args: argparse.Namespace) -> pathlib.Path:
+    """Points the services at a scratch directory and offline settings. Must
+    run before any `services` module is imported (they read env at import)."""
+    workdir = pathlib.Path(tempfile.mkdtemp(prefix="docupilot-bench-"))
+    if args.json:
+        args.json = args.json.resolve()
+    sys.path.insert(0, str(BACKEND_DIR))
+    os.chdir(workdir)  # drive_cache and friends write relative to the cwd
+    os.environ.setdefault("GEMINI_API_KEY", "benchmark")
+    os.environ["EMBEDDING_PROVIDER"] = "local"
+    os.environ["DRIVE_CRAWL_RPS"] = str(args.crawl_rps)
+    os.environ["DRIVE_SYNC_INTERVAL"] = str(args.sync_interval)
+    os.environ["SESSION_STORE"] = "sqlite"
+    if not args.gemini_cache:
+        os.environ["GEMINI_CACHE_TTL"] = "0"
+    return workdir
+
+
+async def main(args: argparse.Namespace) -> list[PhaseResult]:
+    from google.oauth2.credentials import Credentials
+
+    from benchmarks import fake_gemini
+    from benchmarks.fake_drive import DOC_MIME, WORDS, DriveShape, Latency, SyntheticDrive
+    from routers.action_router import UserQuery, handle_user_query, process_user_query
+    from services import drive_client, google_service, job_queue
+
+    rng = random.Random(args.seed)
+    latency = Latency(args.drive_latency_ms / 1000, args.drive_jitter_ms / 1000)
+    drives: dict[str, SyntheticDrive] = {}
+    users: list[tuple[str, Credentials]] = []
+    for n in range(args.users):
+        user_id = f"bench-user-{n}"
+        shape = DriveShape(args.depth, args.fanout, args.files_per_folder, args.doc_chars, seed=args.seed + n)
+        drives[user_id] = SyntheticDrive(shape, latency, owner=user_id)
+        users.append((user_id, Credentials(token=user_id)))
+    print(f"Synthetic Drives: {args.users} x {len(drives['bench-user-0'].files)} items.")
+
+    # --- Route the Google clients and Gemini to the fakes ---
+    def get_service(api: str, version: str, creds: Credentials):
+        drive = drives[creds.token]
+        return drive.drive_service() if api == "drive" else drive.docs_service()
+
+    drive_client.get_service = get_service
+    drive_client.execute = lambda request: request.execute()
+    drive_client.download = lambda request: request.download()
+    fake_gemini.install(fake_gemini.GeminiProfile(
+        first_token=args.gemini_first_token_ms / 1000,
+        tokens_per_second=args.gemini_tokens_per_second,
+        reply_tokens=args.gemini_reply_tokens,
+    ))
+
+    def pick_user() -> tuple[str, Credentials]:
+        return rng.choice(users)
+
+    def pick_item(user_id: str, mime_type: str | None = None) -> dict:
+        return rng.choice(drives[user_id].items_of_type(mime_type))
+
+    results: list[PhaseResult] = []
+    phase = run_phase
+
+    # 1. Cold full crawls (no index involved)
+    async def crawl(i: int):
+        user_id, creds = users[i % len(users)]
+        await google_service.crawl_drive_tree(creds, user_id=user_id)
+    results.append(await phase("crawl_drive_tree", crawl, args.crawl_runs, len(users)))
+
+    # 2. First ensure_drive_index per user: crawl + save + name index
+    async def ensure_cold(i: int):
+        user_id, creds = users[i]
+        await google_service.ensure_drive_index(user_id, creds)
+    results.append(await phase("ensure_drive_index (cold)", ensure_cold, len(users), len(users)))
+
+    # ...which also started background content indexing; time it to completion
+    async def content_indexing(i: int):
+        await asyncio.gather(*google_service._content_index_tasks.values())
+    results.append(await phase("content indexing (background)", content_indexing, 1, 1))
+
+    # 3. Steady state
+    async def ensure_warm(i: int):
+        user_id, creds = pick_user()
+        await google_service.ensure_drive_index(user_id, creds)
+    results.append(await phase("ensure_drive_index (warm)", ensure_warm, args.requests, args.concurrency))
+
+    async def find(i: int):
+        user_id, creds = pick_user()
+        name = pick_item(user_id)["name"]
+        roll = rng.random()
+        if roll < 0.2:
+            name = name.lower()[:-2]    # Prefix / case-insensitive match
+        elif roll < 0.3:
+            name = f"missing {i}"       # No match
+        await google_service.find_item_by_name(name, user_id, creds)
+    results.append(await phase("find_item_by_name", find, args.requests, args.concurrency))
+
+    async def content(i: int):
+        user_id, creds = pick_user()
+        await google_service.get_drive_item_content(pick_item(user_id, DOC_MIME)["name"], creds, user_id=user_id)
+    results.append(await phase("get_drive_item_content", content, args.requests, args.concurrency))
+
+    # 4. End to end: a mix of document questions, Drive-wide search and chat
+    async def ask(i: int):
+        user_id, creds = pick_user()
+        roll = rng.random()
+        if roll < 0.4:
+            message = f"summarize {pick_item(user_id, DOC_MIME)['name']}"
+        elif roll < 0.7:
+            message = f"which docs mention {rng.choice(WORDS)}"
+        else:
+            message = f"what have I been working on about {rng.choice(WORDS)} lately?"
+        query = UserQuery(message=message)
+        if args.stream:
+            async def emit(event: str, data: dict):
+                pass
+            await process_user_query(query, user_id, creds, emit=emit)
+        else:
+            await handle_user_query(query, request=None, token_info=(user_id, creds))
+    results.append(await phase("handle_user_query", ask, args.requests, args.concurrency))
+
+    # Document updates queued by the analyze requests finish in the background
+    async def drain_jobs(i: int):
+        while job_queue.job_queue_stats()["waiting"] or job_queue.job_queue_stats()["running"]:
+            await asyncio.sleep(0.05)
+    results.append(await phase("background jobs (drain)", drain_jobs, 1, 1))
+    await job_queue.shutdown()
+    return results
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    # The services log every step; keep the report readable unless asked
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR, stream=sys.stderr,
+                        format="%(levelname)s %(name)s: %(message)s")
+    workdir = configure_environment(args)
+    try:
+        results = asyncio.run(main(args))
+    finally:
+        if not args.keep_cache:
+            import shutil
+            shutil.rmtree(workdir, ignore_errors=True)
+    print()
+    print_report(results)
+    if args.json:
+        args.json.write_text(json.dumps({"args": {k: str(v) for k, v in vars(args).items()},
+                                         "results": [r.summary() for r in results]}, indent=2))
+        print(f"\nWrote {args.json}")
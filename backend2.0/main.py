@@ -1,19 +1,32 @@
+import base64
+import datetime
+import hashlib
+import logging
 import os
 from dotenv import load_dotenv
 load_dotenv()
 
+from services import log_sink
+log_sink.install()  # Before anything logs: records become JSON lines on stdout
+
 import uvicorn
-from fastapi import FastAPI, Depends, Request, HTTPException
+from fastapi import FastAPI, Depends, Query, Request, Response, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from google.oauth2.credentials import Credentials
 from starlette.middleware.sessions import SessionMiddleware
 from routers import action_router 
 from routers import status_router # Add this line
 from auth.auth import router as auth_router, verify_google_token
+from services import drive_cache
 from services.drive_cache import load_index
-from services.google_service import list_all_drive_items, ensure_drive_index
+from services.google_service import list_all_drive_items, ensure_drive_index, crawl_progress
+from services.gemini_service import warm_up_models
+from services import job_queue, tracing
 import json
 
+logger = logging.getLogger(__name__)
+
 # --- App Setup ---
 os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'  # Allow OAuth over HTTP for local dev
 
@@ -28,6 +41,25 @@ app.add_middleware(
     same_site='none'  # Allow cross-site cookie sending
 )
 
+# --- Compression (index pages, chat answers) ---
+class CompressionMiddleware:
+    """GZip for every response but SSE streams, whose events mustn't wait in
+    the compressor's buffer."""
+
+    def __init__(self, app):
+        self.app = app
+        self.gzip = GZipMiddleware(app, minimum_size=1024)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].endswith("/stream"):
+            return await self.app(scope, receive, send)
+        await self.gzip(scope, receive, send)
+
+app.add_middleware(CompressionMiddleware)
+
+# --- Tracing Middleware (one trace per request, X-Trace-Id header) ---
+app.add_middleware(tracing.TracingMiddleware)
+
 # --- CORS Middleware ---
 app.add_middleware(
     CORSMiddleware,
@@ -39,6 +71,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Trace-Id", "ETag"],
 )
 
 
@@ -46,6 +79,17 @@ app.add_middleware(
 app.include_router(auth_router, prefix="/auth", tags=["auth"])
 app.include_router(action_router.router, prefix="/api", tags=["actions"]) # Corrected: Access the 'router' attribute
 app.include_router(status_router.router) # Add this line
+# --- Startup ---
+@app.on_event("startup")
+async def warm_up():
+    # Build the shared Gemini models before the first request needs them
+    warm_up_models()
+
+@app.on_event("shutdown")
+async def stop_jobs():
+    # Unfinished background jobs can't outlive the process (credentials are in memory only)
+    await job_queue.shutdown()
+
 # --- Root endpoint ---
 @app.get("/")
 async def root():
@@ -58,24 +102,108 @@ async def get_user_info(request: Request, token_info: tuple = Depends(verify_goo
     return {"user_id": user_id}
 
 # +++ NEW Initial Context Endpoint +++
+# Page size of /api/initial-context, and the fields an item can be projected to
+INITIAL_CONTEXT_PAGE_SIZE = 200
+INITIAL_CONTEXT_MAX_PAGE_SIZE = 1000
+ITEM_FIELDS = ("id", "name", "mimeType", "parents", "path", "modifiedTime")
+
+def encode_cursor(seq: int) -> str:
+    return base64.urlsafe_b64encode(str(seq).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> int:
+    try:
+        return int(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode())
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def rfc3339_utc(value: str) -> str:
+    """Normalizes an ISO 8601 timestamp to Drive's format, so they compare as strings."""
+    try:
+        dt = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="modifiedSince must be an ISO 8601 timestamp")
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    dt = dt.astimezone(datetime.timezone.utc)
+    return f"{dt:%Y-%m-%dT%H:%M:%S}.{dt.microsecond // 1000:03d}Z"
+
 @app.get("/api/initial-context")
-async def get_initial_context(token_info: tuple[str, Credentials] = Depends(verify_google_token)):
-    """Endpoint called on frontend load to get user ID and ensure Drive index is ready."""
+async def get_initial_context(
+    request: Request,
+    response: Response,
+    limit: int = Query(INITIAL_CONTEXT_PAGE_SIZE, ge=1, le=INITIAL_CONTEXT_MAX_PAGE_SIZE),
+    cursor: str | None = None,
+    mime_type: str | None = Query(None, alias="mimeType"),
+    parent: str | None = None,
+    modified_since: str | None = Query(None, alias="modifiedSince"),
+    fields: str | None = None,
+    token_info: tuple[str, Credentials] = Depends(verify_google_token),
+):
+    """Endpoint called on frontend load to get user ID and ensure Drive index is ready.
+
+    Returns one page of the Drive index, in index order: pass `next_cursor`
+    back as `cursor` for the next one (null on the last page). Filters:
+    `mimeType`, `parent` (folder id, or "root"), `modifiedSince` (ISO 8601);
+    `fields` (comma-separated) projects each item. Responses carry an ETag of
+    the index version and query, and If-None-Match answers 304 while the index
+    is unchanged.
+
+    On first login this doesn't wait for the whole crawl: it returns the items
+    found so far, with `indexing` holding the crawl's progress (null once the
+    index is complete).
+    """
     user_id, creds = token_info
     if not user_id or not creds:
         raise HTTPException(status_code=401, detail="Authentication required")
-    
+
+    projection = ITEM_FIELDS
+    if fields:
+        projection = tuple(f.strip() for f in fields.split(",") if f.strip())
+        unknown = set(projection) - set(ITEM_FIELDS)
+        if unknown or not projection:
+            raise HTTPException(status_code=400, detail=f"fields must be drawn from {', '.join(ITEM_FIELDS)}")
+    after_seq = decode_cursor(cursor) if cursor else -1
+    modified_since = rfc3339_utc(modified_since) if modified_since else None
+
     try:
-        # Ensure the index is up-to-date (or created)
-        drive_index = await ensure_drive_index(user_id, creds)
-        print(f"Loaded drive index cache for initial context. Found {len(drive_index or [])} items.")
+        # Ensure the index is up-to-date (or being created)
+        await ensure_drive_index(user_id, creds, wait=False)
+
+        # The index version changes on every write, so it validates any page of it
+        version = drive_cache.updated_at(user_id)
+        query = json.dumps([limit, after_seq, mime_type, parent, modified_since, projection])
+        etag = f'W/"{version.timestamp() if version else 0}-{hashlib.sha1(query.encode()).hexdigest()[:16]}"'
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+        if_none_match = {tag.strip() for tag in (request.headers.get("if-none-match") or "").split(",")}
+        if etag in if_none_match or "*" in if_none_match:
+            return Response(status_code=304, headers=headers)
+
+        root_unknown = False
+        if parent == "root":
+            state = drive_cache.load_sync_state(user_id) or drive_cache.load_crawl(user_id)
+            parent = state["root_id"] if state else None
+            # No sync state or crawl yet: nothing is indexed under the root
+            root_unknown = parent is None
+        if root_unknown:
+            items, last_seq = [], None
+        else:
+            items, last_seq = drive_cache.query_items(
+                user_id, after_seq, limit, mime_type=mime_type, parent=parent, modified_since=modified_since
+            )
+        if projection != ITEM_FIELDS:
+            items = [{key: item[key] for key in projection if key in item} for item in items]
+        logger.info(f"Initial context page for user {user_id[:10]}: {len(items)} items.")
 
+        response.headers.update(headers)
         return {
             "user_id": user_id,
-            "drive_index": drive_index or []
+            "drive_index": items,
+            "next_cursor": encode_cursor(last_seq) if last_seq is not None else None,
+            "item_count": drive_cache.item_count(user_id),
+            "indexing": crawl_progress(user_id),
         }
     except Exception as e:
-        print(f"--- Error fetching initial context: {e} ---")
+        logger.error(f"Error fetching initial context: {e}")
         raise HTTPException(status_code=500, detail="Failed to fetch initial context")
 
 if __name__ == "__main__":
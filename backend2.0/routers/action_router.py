@@ -1,28 +1,49 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from auth.auth import verify_google_token
 from google.oauth2.credentials import Credentials
+import logging
 import traceback
+import asyncio
+from typing import Awaitable, Callable
 
 from services.gemini_service import parse_user_message, generate_doc_preview, generate_gemini_response
 from services.google_service import (
     get_drive_item_content,
-    run_langchain_doc_creation,
+    generate_doc_content,
+    create_google_doc,
     get_google_drive_url, 
     find_item_by_name,    
-    move_doc_to_folder    
+    move_doc_to_folder,
+    refresh_drive_index,
+    find_doc_id_by_name,
+    similar_item_names,
+    update_google_doc
 )
 from services.analyze_service import analyze_content
-from services.drive_cache import load_index
+from services.drive_cache import aload_index
+from services import job_queue, session_store, tracing
+from services.chat_history import document_reference
+from services.drive_context import build_drive_context
+from services.fulltext_index import search_documents
+from services.vector_index import search_passages
 import json
+
+logger = logging.getLogger(__name__)
 FOLDER_MIME = "application/vnd.google-apps.folder"
 router = APIRouter()
 
-# --- Pending confirmation storage ---
-pending_requests = {} 
+# Pending confirmations and chat histories live in services/session_store, so
+# a follow-up request can be served by any worker.
+ALREADY_HANDLED = {"message": "That request was already handled.", "needsConfirmation": False}
 
-# --- Chat History Storage ---
-chat_histories = {}
+def did_you_mean(user_id: str, name: str, mime_type: str | None = None) -> str:
+    """A "Did you mean ...?" hint listing near matches for a name that matched no item exactly."""
+    names = similar_item_names(user_id, name, mime_type=mime_type)
+    if not names:
+        return ""
+    return " Did you mean " + " or ".join(f"'{n}'" for n in names) + "?"
 
 class UserQuery(BaseModel):
     message: str
@@ -30,9 +51,167 @@ class UserQuery(BaseModel):
     regenerate: bool | None = None
     skip_preview: bool | None = None
 
+# How often a running /ask checks whether its client has gone away
+DISCONNECT_POLL_INTERVAL = 0.5
+# Passages pulled from the vector index for Drive-wide questions / general chat
+ANALYZE_PASSAGES = 8
+FALLBACK_PASSAGES = 4
+# Known states / actions get their own phase span; anything else is lumped
+# together so metric labels stay bounded
+TRACED_PENDING_STATES = {'moveDoc_initial', 'moveDoc_target_pending', 'moveDoc_confirm_pending', 'confirm_preview_gen', 'confirm_create'}
+TRACED_ACTIONS = {"moveDoc", "createDoc", "analyze"}
+
+# --- Background jobs (services/job_queue); /ask returns their ids to poll ---
+def submit_doc_creation(user_id: str, creds: Credentials, pending: dict) -> str:
+    file_name = pending['file_name']
+    original_message = pending.get('original_message')
+
+    async def create(report):
+        await report("generating", file_name=file_name)
+        content = await generate_doc_content(original_message)  # Transient failures are retried
+        await report("creating", file_name=file_name)
+        # Transient Docs API errors are raised, so the job queue retries them
+        doc_id, doc_url = await create_google_doc(title=file_name, creds=creds, content=content, raise_retryable=True)
+        if not (doc_id and doc_url):
+            raise job_queue.JobFailed(f"Sorry, I couldn't create the document '{file_name}'. Please try again.")
+        logger.info(f"Document '{file_name}' created successfully. ID: {doc_id}")
+        return {
+            "message": f"✅ Document **'{file_name}'** created successfully! You can access it [here]({doc_url}).",
+            "docUrl": doc_url
+        }
+
+    # Put the confirmation back on failure so the user can try again
+    return job_queue.submit(user_id, "createDoc", create, on_failure=lambda _: session_store.set_pending(user_id, pending))
+
+def submit_move(user_id: str, creds: Credentials, file_to_move: dict, current_parent_id: str, target_folder: dict) -> str:
+    async def move(report):
+        await report("moving", file_name=file_to_move.get('name'), target_folder=target_folder.get('name'))
+        result_message = await move_doc_to_folder(
+            file_id=file_to_move['id'],
+            current_parent_id=current_parent_id,
+            target_folder_id=target_folder['id'],
+            creds=creds,
+            doc_name=file_to_move.get('name', 'Unknown File') # Pass name for logging
+        )
+        if not result_message.startswith("✅"):
+            raise job_queue.JobFailed(result_message)
+        return {"message": result_message}
+
+    return job_queue.submit(user_id, "moveDoc", move)
+
+def submit_doc_update(user_id: str, creds: Credentials, doc_id: str, doc_name: str, new_content: str) -> str:
+    async def update(report):
+        await report("updating", file_name=doc_name)
+        if not await update_google_doc(doc_id, new_content, creds):
+            raise job_queue.JobFailed(f"⚠️ Couldn't update the document '{doc_name}'.")
+        return {"message": f"✅ Document '{doc_name}' has been updated successfully."}
+
+    return job_queue.submit(user_id, "updateDoc", update)
+
+async def answer_generally(user_id: str, message: str, on_token=None, passages: list[dict] | None = None,
+                           response_type: str = "fallback_message") -> dict:
+    """Plain Gemini answer, with the chat history and the Drive items (and
+    passages) most relevant to the message as context."""
+    current_history = session_store.get_history(user_id)
+    # Only the items relevant to this message, within a token budget
+    if passages is None:
+        passages = await search_passages(user_id, message, k=FALLBACK_PASSAGES)
+    # Rebuilds the relevance index from the stored Drive index when it changed
+    drive_context = await asyncio.to_thread(build_drive_context, user_id, message, passages=passages)
+
+    logger.debug(f"Drive context length: {len(drive_context)} chars for general answer")
+    response_text, updated_history = await generate_gemini_response(
+        message,
+        drive_context=drive_context,
+        chat_history=current_history,
+        on_token=on_token
+    )
+    session_store.save_history(user_id, updated_history)
+
+    return {
+        "success": True,
+        "message": response_text,
+        "type": response_type
+    }
+
+async def cancel_on_disconnect(request: Request | None, coro):
+    """Awaits `coro`, cancelling it (and any queued Drive calls) if the client disconnects."""
+    task = asyncio.ensure_future(coro)
+    if request is None:
+        return await task
+    while True:
+        done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+        if done:
+            return task.result()
+        if await request.is_disconnected():
+            logger.info("Client disconnected; cancelling in-flight request.")
+            task.cancel()
+            raise HTTPException(status_code=499, detail="Client disconnected")
+
 @router.post("/ask")
-async def handle_user_query(query: UserQuery, token_info: tuple[str, Credentials] = Depends(verify_google_token)):
+async def handle_user_query(query: UserQuery, request: Request = None, token_info: tuple[str, Credentials] = Depends(verify_google_token)):
     user_id, creds = token_info # Unpack user_id and Credentials object
+    return await cancel_on_disconnect(request, process_user_query(query, user_id, creds))
+
+# --- Streaming variant (Server-Sent Events) ---
+# Receives (event_name, payload) for progress events while a query is handled
+EventCallback = Callable[[str, dict], Awaitable[None]]
+
+def format_sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@router.post("/ask/stream")
+async def stream_user_query(query: UserQuery, token_info: tuple[str, Credentials] = Depends(verify_google_token)):
+    """Same as /ask, but streams Gemini tokens and state transitions as SSE.
+
+    Events: `token` ({"text"}), `state` ({"stage", ...}), then exactly one of
+    `done` (the usual /ask JSON body) or `error` ({"status", "detail"}).
+    """
+    user_id, creds = token_info
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def emit(event: str, data: dict):
+        await queue.put((event, data))
+
+    async def run():
+        try:
+            result = await process_user_query(query, user_id, creds, emit=emit)
+            await queue.put(("done", result))
+        except HTTPException as http_exc:
+            await queue.put(("error", {"status": http_exc.status_code, "detail": http_exc.detail}))
+        except Exception as e:
+            logger.error(f"Error in streamed query: {e}")
+            await queue.put(("error", {"status": 500, "detail": "Sorry, I encountered an error trying to respond."}))
+
+    async def event_stream():
+        task = asyncio.create_task(run())
+        try:
+            while True:
+                event, data = await queue.get()
+                yield format_sse(event, data)
+                if event in ("done", "error"):
+                    break
+        finally:
+            # Generator closed early means the client went away
+            task.cancel()
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+async def process_user_query(query: UserQuery, user_id: str, creds: Credentials, emit: EventCallback | None = None):
+    async def notify(stage: str, **data):
+        if emit:
+            await emit("state", {"stage": stage, **data})
+
+    async def on_token_cb(text: str):
+        await emit("token", {"text": text})
+
+    on_token = on_token_cb if emit else None
+    # Each state of the request is timed as an "ask.<phase>" span
+    phase = tracing.Phases("ask")
 
     try:
         user_message = query.message
@@ -40,36 +219,36 @@ async def handle_user_query(query: UserQuery, token_info: tuple[str, Credentials
         regenerate_request = query.regenerate
         skip_request = query.skip_preview
 
+        # Keep the cached Drive index fresh (incremental, rate-limited)
+        phase.enter("refresh_index")
+        await refresh_drive_index(user_id, creds)
+
         # --- Log state ---
-        print(f"User token: {user_id[:10]}...")
-        pending_data = pending_requests.get(user_id)
-        print(f"Pending data: {pending_data}")
-        print(f"Received query: message='{user_message}', confirmation={confirmation_choice}, regenerate={regenerate_request}, skip_preview={skip_request}")
+        logger.debug(f"User token: {user_id[:10]}...")
+        pending = session_store.get_pending(user_id)
+        logger.debug(f"Pending data: {pending}")
+        logger.debug(f"Received query: message='{user_message}', confirmation={confirmation_choice}, regenerate={regenerate_request}, skip_preview={skip_request}")
 
         pending_state = None  # Initialize pending_state here
 
         # --- Step 1: Check for pending confirmation request & Extract State ---
-        if user_id in pending_requests:
-            pending = pending_requests[user_id]
-            print(f"Pending data: {pending}") # Debug log pending data
-
+        if pending is not None:
             if 'state' not in pending:
-                print(f"ERROR: Pending data for user {user_id[:10]} missing 'state' key: {pending}. Clearing state.")
-                del pending_requests[user_id]
+                logger.error(f"Pending data for user {user_id[:10]} missing 'state' key: {pending}. Clearing state.")
+                session_store.clear_pending(user_id)
                 # Let pending_state remain None, fall through
             else:
                 pending_state = pending['state'] # Assign state if valid
-                print(f"User {user_id[:10]} has pending state: {pending_state}")
+                logger.info(f"User {user_id[:10]} has pending state: {pending_state}")
+                phase.enter(f"pending.{pending_state}" if pending_state in TRACED_PENDING_STATES else "pending.other")
 
         # --- Step 2: Handle Pending State (if one was found) ---
         if pending_state:
-            # Re-fetch pending data in case it was cleared above (though unlikely needed now)
-            if user_id not in pending_requests:
-                 print(f"WARNING: Pending state '{pending_state}' detected but request data missing for user {user_id[:10]}. Treating as new request.")
+            # Pending data may have been cleared above
+            if pending is None:
+                 logger.warning(f"Pending state '{pending_state}' detected but request data missing for user {user_id[:10]}. Treating as new request.")
                  pending_state = None # Force fallthrough
             else:
-                 pending = pending_requests[user_id]
-
                  # --- Handle moveDoc pending state --- (This block runs only if pending_state is valid)
                  if pending_state == 'moveDoc_initial':
                     # Step 1: Ask for destination folder
@@ -77,31 +256,35 @@ async def handle_user_query(query: UserQuery, token_info: tuple[str, Credentials
                     file_url = get_google_drive_url(file_to_move) if file_to_move else pending.get('doc_name')
                     file_display_name = f"[{pending['doc_name']}]({file_url})" if file_url else pending['doc_name']
 
-                    pending['state'] = 'moveDoc_target_pending' # Update state
-                    print(f"State updated to moveDoc_target_pending for user {user_id[:10]}...")
+                    if not session_store.transition_pending(user_id, pending_state, {**pending, 'state': 'moveDoc_target_pending'}):
+                        return ALREADY_HANDLED
+                    logger.debug(f"State updated to moveDoc_target_pending for user {user_id[:10]}...")
                     return {
                         "message": f"Where would you like to move {file_display_name} to? Please specify the destination folder name."
                     }
                  elif pending_state == 'moveDoc_target_pending':
                     # Step 2: Validate destination folder and ask for confirmation
                     target_folder_name = user_message
-                    target_folder = find_item_by_name(target_folder_name, user_id, creds)
+                    target_folder = await find_item_by_name(target_folder_name, user_id, creds, mime_type=FOLDER_MIME)
 
                     file_to_move = pending.get('file_to_move') # Retrieve stored file info
                     file_display_name = pending.get('file_display_name', pending.get('doc_name')) # Use stored display name
 
                     if not target_folder:
-                        return {"message": f"❌ Sorry, I couldn't find a folder named '{target_folder_name}'. Please specify a valid destination folder name."}
+                        return {"message": f"❌ Sorry, I couldn't find a folder named '{target_folder_name}'."
+                                           f"{did_you_mean(user_id, target_folder_name, FOLDER_MIME)} Please specify a valid destination folder name."}
                     elif target_folder.get('mimeType') != FOLDER_MIME:
                         return {"message": f"❌ Sorry, '{target_folder_name}' is not a folder. Please specify a valid destination folder name."}
                     else:
                         # Valid folder found, store details and ask for confirmation
-                        pending['target_folder'] = target_folder
-                        pending['state'] = 'moveDoc_confirm_pending'
+                        if not session_store.transition_pending(user_id, pending_state, {
+                            **pending, 'target_folder': target_folder, 'state': 'moveDoc_confirm_pending'
+                        }):
+                            return ALREADY_HANDLED
                         target_folder_url = get_google_drive_url(target_folder)
                         target_folder_display_name = f"[{target_folder_name}]({target_folder_url})" if target_folder_url else target_folder_name
 
-                        print(f"State updated to moveDoc_confirm_pending for user {user_id[:10]}...")
+                        logger.debug(f"State updated to moveDoc_confirm_pending for user {user_id[:10]}...")
                         return {
                             "message": f"Confirm: Move {file_display_name} to the folder {target_folder_display_name}?",
                             "needsConfirmation": True,
@@ -116,28 +299,26 @@ async def handle_user_query(query: UserQuery, token_info: tuple[str, Credentials
 
                         if not current_parent_id:
                             # This shouldn't happen if find_item_by_name worked, but handle defensively
-                            print(f"Error: Could not determine current parent for file ID {file_to_move.get('id')}")
+                            logger.error(f"Could not determine current parent for file ID {file_to_move.get('id')}")
                             # Return the error *before* deleting the state
                             return {"message": "❌ Error: Could not determine the file's current location."}
 
-                        print(f"Executing move: file_id={file_to_move['id']}, current_parent={current_parent_id}, target_folder={target_folder['id']}")
-                        result_message = await move_doc_to_folder(
-                            file_id=file_to_move['id'],
-                            current_parent_id=current_parent_id,
-                            target_folder_id=target_folder['id'],
-                            creds=creds,
-                            doc_name=file_to_move.get('name', 'Unknown File') # Pass name for logging
-                        )
-                        del pending_requests[user_id] # Delete state after successful move
-                        print(f"Move operation finished for user {user_id[:10]}, pending state cleared.")
-                        return {"message": result_message}
+                        # Claim the flow first so a double-clicked "Yes" can't move the file twice
+                        if not session_store.transition_pending(user_id, pending_state, None):
+                            return ALREADY_HANDLED
+                        logger.info(f"Queueing move: file_id={file_to_move['id']}, current_parent={current_parent_id}, target_folder={target_folder['id']}")
+                        job_id = submit_move(user_id, creds, file_to_move, current_parent_id, target_folder)
+                        return {
+                            "message": f"⏳ Moving '{file_to_move.get('name')}' to '{target_folder.get('name')}'...",
+                            "jobId": job_id
+                        }
                     elif confirmation_choice is False:
-                        del pending_requests[user_id] # Delete state on cancellation
-                        print(f"Move operation cancelled by user {user_id[:10]}, pending state cleared.")
+                        session_store.clear_pending(user_id) # Delete state on cancellation
+                        logger.info(f"Move operation cancelled by user {user_id[:10]}, pending state cleared.")
                         return {"message": "❌ Move operation canceled."}
                     else:
                         # Should not happen if frontend sends True/False, but handle just in case
-                        print(f"Invalid confirmation choice received: {confirmation_choice}")
+                        logger.warning(f"Invalid confirmation choice received: {confirmation_choice}")
                         return {"message": "Please confirm by clicking 'Yes' or 'No'."}
                  # --- Handle confirm_preview_gen / confirm_create pending states ---
                  elif pending_state in ['confirm_preview_gen', 'confirm_create']:
@@ -148,12 +329,15 @@ async def handle_user_query(query: UserQuery, token_info: tuple[str, Credentials
                     if pending_state == 'confirm_preview_gen':
                         if confirmation_choice is True:
                             try:
-                                print(f"Generating preview for '{file_name}'")
-                                preview = await generate_doc_preview(file_name) # Pass only file_name
+                                logger.info(f"Generating preview for '{file_name}'")
+                                preview = await generate_doc_preview(file_name, on_token=on_token) # Pass only file_name
+                                await notify("preview_ready", file_name=file_name)
                                 # Update state to confirm creation, store preview
-                                pending_requests[user_id]['state'] = 'confirm_create'
-                                pending_requests[user_id]['preview'] = preview
-                                print(f"Preview generated. New state: confirm_create")
+                                if not session_store.transition_pending(user_id, pending_state, {
+                                    **pending, 'state': 'confirm_create', 'preview': preview
+                                }):
+                                    return ALREADY_HANDLED
+                                logger.info(f"Preview generated. New state: confirm_create")
                                 return {
                                     "success": True,
                                     "message": (
@@ -166,30 +350,33 @@ async def handle_user_query(query: UserQuery, token_info: tuple[str, Credentials
                                     "allowRegenerate": True      # Signal frontend can show regenerate
                                 }
                             except Exception as e:
-                                print(f"Error generating preview: {e}")
-                                del pending_requests[user_id] # Clear pending on error
+                                logger.error(f"Error generating preview: {e}")
+                                session_store.clear_pending(user_id) # Clear pending on error
                                 raise HTTPException(status_code=500, detail=f"Failed to generate preview: {e}")
                         elif confirmation_choice is False:
-                            print("User cancelled preview generation.")
-                            del pending_requests[user_id]
+                            logger.info("User cancelled preview generation.")
+                            session_store.clear_pending(user_id)
                             return {"success": False, "message": "❌ Preview generation canceled."}
                         else:
                             # User sent a message instead of confirming - should not happen with buttons?
                             # For now, just remind them.
-                            del pending_requests[user_id] # Clear state and re-parse message
-                            print("Confirmation ambiguity. Clearing state and reprocessing message.")
+                            session_store.clear_pending(user_id) # Clear state and re-parse message
+                            pending_state = None
+                            logger.warning("Confirmation ambiguity. Clearing state and reprocessing message.")
                             # Fall through to re-process the message outside the confirmation block
             
                     # --- State: Confirm Document Creation (or Regenerate) ---
                     elif pending_state == 'confirm_create':
-                        preview = pending_requests[user_id].get('preview', '[Preview not available]')
+                        preview = pending.get('preview', '[Preview not available]')
                         
                         if regenerate_request is True:
                             try:
-                                print(f"Regenerating preview for '{file_name}'")
-                                new_preview = await generate_doc_preview(file_name) # Pass only file_name
-                                pending_requests[user_id]['preview'] = new_preview # Update stored preview
-                                print(f"Preview regenerated.")
+                                logger.info(f"Regenerating preview for '{file_name}'")
+                                new_preview = await generate_doc_preview(file_name, on_token=on_token, use_cache=False) # Fresh output on regenerate
+                                await notify("preview_ready", file_name=file_name)
+                                if not session_store.transition_pending(user_id, pending_state, {**pending, 'preview': new_preview}):
+                                    return ALREADY_HANDLED
+                                logger.info(f"Preview regenerated.")
                                 return {
                                     "success": True,
                                     "message": (
@@ -200,91 +387,52 @@ async def handle_user_query(query: UserQuery, token_info: tuple[str, Credentials
                                     "allowRegenerate": True # Allow further regeneration
                                 }
                             except Exception as e:
-                                print(f"Error regenerating preview: {e}")
+                                logger.error(f"Error regenerating preview: {e}")
                                 # Don't delete pending state here, let user try again or cancel
                                 raise HTTPException(status_code=500, detail=f"Failed to regenerate preview: {e}")
                 
-                        elif skip_request is True:
-                            print(f"User skipped preview. Running LangChain creation for: {original_message}")
-                            try:
-                                doc_id, doc_url = await run_langchain_doc_creation(
-                                    original_request=original_message,
-                                    generated_title=file_name,
-                                    creds=creds
-                                )
-
-                                if doc_id and doc_url:
-                                    # Clear pending state on success
-                                    if user_id in pending_requests:
-                                        del pending_requests[user_id]
-                                    print(f"Document '{file_name}' created successfully (skipped preview). ID: {doc_id}")
-                                    # Return success message and document URL
-                                    return {
-                                        "message": f"OK, I've created the Google Doc: '{file_name}'. You can view it [here]({doc_url}).",
-                                        "action_required": None,
-                                        "doc_url": doc_url
-                                    }
-                                else:
-                                    # Don't clear pending state on failure, maybe they want to retry?
-                                    # (Or maybe clear it? For now, keep it.)
-                                    print(f"Document creation failed for '{file_name}' (skipped preview).")
-                                    return {"message": f"Sorry, I couldn't create the document '{file_name}'. Please try again.", "action_required": None}
-                            except Exception as e:
-                                print(f"Error during skip preview creation: {e}")
-                                return {"message": f"An error occurred while creating the document: {e}", "action_required": None}
-                
-                        elif confirmation_choice is True:
-                            try:
-                                print(f"User confirmed. Running LangChain creation for: {original_message}")
-                                doc_id, doc_url = await run_langchain_doc_creation(
-                                    original_request=original_message,
-                                    generated_title=file_name,
-                                    creds=creds
-                                )
-
-                                if doc_id and doc_url:
-                                    response_message = f"✅ Document **'{file_name}'** created successfully! You can access it [here]({doc_url})."
-                                    del pending_requests[user_id] # Clear state on success
-                                return {
-                                    "success": True,
-                                    "message": response_message,
-                                    "docUrl": doc_url
-                                }
-                            except Exception as e:
-                                print(f"Error creating doc after confirmation: {e}")
-                                del pending_requests[user_id] # Clear pending on error
-                                raise HTTPException(status_code=500, detail=f"Failed to create document: {e}")
-                
+                        elif skip_request is True or confirmation_choice is True:
+                            if not session_store.transition_pending(user_id, pending_state, None):
+                                return ALREADY_HANDLED
+                            logger.info(f"User {'skipped preview' if skip_request else 'confirmed'}. Queueing creation for: {original_message}")
+                            job_id = submit_doc_creation(user_id, creds, pending)
+                            return {
+                                "success": True,
+                                "message": f"⏳ Creating **'{file_name}'**...",
+                                "needsConfirmation": False,
+                                "jobId": job_id
+                            }
+
                         elif confirmation_choice is False:
-                            print("User cancelled document creation.")
-                            del pending_requests[user_id]
+                            logger.info("User cancelled document creation.")
+                            session_store.clear_pending(user_id)
                             return {"success": False, "message": "❌ Document creation canceled.", "needsConfirmation": False}
                 
                         else:
                             # User sent a message instead of confirming
-                            print("Confirmation ambiguity. Clearing state.")
-                            if user_id in pending_requests:
-                                del pending_requests[user_id]
+                            logger.warning("Confirmation ambiguity. Clearing state.")
+                            session_store.clear_pending(user_id)
                             # Don't fall through. Tell user action cancelled.
                             return {
                                 "success": False,
                                 "message": "Action cancelled due to ambiguous response. Please state your request again.",
                                 "needsConfirmation": False # Ensure no buttons appear
                             }
-            # --- Handle unexpected state --- (This is the 'else' for the pending_state checks)
-        else:
-            print(f"WARNING: Unhandled pending state '{pending_state}' for user {user_id[:10]}. Clearing state.")
-            if user_id in pending_requests: # Check before deleting
-                del pending_requests[user_id]
-            pending_state = None # Ensure fallthrough
-            # Fall through to Step 3 (treat as new request)
+                 # --- Handle unexpected state ---
+                 else:
+                    logger.warning(f"Unhandled pending state '{pending_state}' for user {user_id[:10]}. Clearing state.")
+                    session_store.clear_pending(user_id)
+                    pending_state = None # Ensure fallthrough
+                    # Fall through to Step 3 (treat as new request)
 
         # --- Step 3: No pending request OR fallthrough from unhandled/missing state ---
         # This section is reached if pending_state remained None OR if an unhandled state fell through
         if not pending_state: # Explicitly check if we need to handle as new request
-            print("Parsing user message as a new request (no pending action handled).") # Clarify log message
-            parsed = await parse_user_message(user_message)
+            logger.debug("Parsing user message as a new request (no pending action handled).") # Clarify log message
+            phase.enter("parse")
+            parsed = await parse_user_message(user_message, user_id=user_id)
             action = parsed.get("action_to_perform")
+            phase.enter(f"action.{action}" if action in TRACED_ACTIONS else "action.fallback")
 
             # --- Handle specific actions first ---
             if action == "moveDoc":
@@ -294,22 +442,22 @@ async def handle_user_query(query: UserQuery, token_info: tuple[str, Credentials
                     return {"message": "Which document or folder would you like to move? Please specify its name."}
 
                 # Find the file first
-                file_to_move = find_item_by_name(doc_name, user_id, creds)
+                file_to_move = await find_item_by_name(doc_name, user_id, creds)
                 if not file_to_move:
                     # Don't set pending state if file not found
-                    return {"message": f"❌ Sorry, I couldn't find a document or folder named '{doc_name}'."}
+                    return {"message": f"❌ Sorry, I couldn't find a document or folder named '{doc_name}'.{did_you_mean(user_id, doc_name)}"}
                 else:
                     # File found, store details and set state to ask for target
                     file_url = get_google_drive_url(file_to_move)
                     file_display_name = f"[{doc_name}]({file_url})" if file_url else doc_name
 
-                    pending_requests[user_id] = {
+                    session_store.set_pending(user_id, {
                         'state': 'moveDoc_target_pending', # Match the state expected when destination is provided
                         'doc_name': doc_name,
                         'file_to_move': file_to_move,
                         'file_display_name': file_display_name
-                    }
-                    print(f"File '{doc_name}' found (ID: {file_to_move.get('id')}). Setting state to moveDoc_target_pending for user {user_id[:10]}...")
+                    })
+                    logger.info(f"File '{doc_name}' found (ID: {file_to_move.get('id')}). Setting state to moveDoc_target_pending for user {user_id[:10]}...")
 
                     # --- Instead of recursing, return the prompt for the 'moveDoc_initial' state ---
                     return {
@@ -324,12 +472,12 @@ async def handle_user_query(query: UserQuery, token_info: tuple[str, Credentials
                 original_message = user_message # Store the original request for LangChain
                 try:
                     # Store initial state: confirm preview generation
-                    pending_requests[user_id] = {
+                    session_store.set_pending(user_id, {
                         'state': 'confirm_preview_gen',
                         'file_name': file_name,
                         'original_message': user_message # Store original msg for preview gen
-                    }
-                    print(f"📝 Storing initial pending request for {user_id}: state=confirm_preview_gen, file={file_name}")
+                    })
+                    logger.info(f"📝 Storing initial pending request for {user_id}: state=confirm_preview_gen, file={file_name}")
 
                     # Ask user to confirm PREVIEW generation
                     return {
@@ -339,9 +487,8 @@ async def handle_user_query(query: UserQuery, token_info: tuple[str, Credentials
                         "confirmationType": "preview_gen" # Signal frontend type
                     }
                 except Exception as e:
-                     print(f"Error initiating createDoc flow: {e}")
-                     if user_id in pending_requests:
-                         del pending_requests[user_id]
+                     logger.error(f"Error initiating createDoc flow: {e}")
+                     session_store.clear_pending(user_id)
                      raise HTTPException(status_code=500, detail=f"Failed to process document creation request: {e}")
             elif action == "analyze":
                 target_name = parsed.get("target")
@@ -351,33 +498,65 @@ async def handle_user_query(query: UserQuery, token_info: tuple[str, Credentials
                     raise HTTPException(status_code=400, detail="Analysis query is missing.")
 
                 file_content_context = None
+                doc_version = None
                 if target_name:
-                    print(f"Attempting to fetch context for target: {target_name}")
+                    logger.debug(f"Attempting to fetch context for target: {target_name}")
                     try:
-                        file_content_context = await get_drive_item_content(target_name, creds)
+                        file_content_context = await get_drive_item_content(target_name, creds, user_id=user_id)
                         if not file_content_context:
-                            print(f"❌ Could not find content for '{target_name}'.")
-                            raise HTTPException(status_code=404, detail=f"❌ I couldn't find a document named '{target_name}' in your Drive.")
+                            logger.warning(f"❌ Could not find content for '{target_name}'.")
+                            raise HTTPException(status_code=404, detail=f"❌ I couldn't find a document named '{target_name}' in your Drive."
+                                                                        f"{did_you_mean(user_id, target_name)}")
                         else:
-                            print(f"✅ Successfully fetched file context for '{target_name}'.")
+                            logger.info(f"✅ Successfully fetched file context for '{target_name}'.")
+                            await notify("document_loaded", target=target_name)
+                            # Same lookup get_drive_item_content resolved (served from the name index)
+                            item = await find_item_by_name(target_name, user_id, creds)
+                            if item and item.get("modifiedTime"):
+                                doc_version = f"{item['id']}:{item['modifiedTime']}"
+                    except HTTPException:
+                        raise
                     except Exception as e:
-                        print(f"Error fetching file context for '{target_name}': {e}")
+                        logger.error(f"Error fetching file context for '{target_name}': {e}")
                         raise HTTPException(status_code=500, detail=f"Error accessing document '{target_name}': {e}")
 
-                drive_index = load_index(user_id) or []
-                print(f"Loaded drive index for analysis context ({len(drive_index)} items).")
-                current_history = chat_histories.get(user_id, [])
+                search_results = None
+                passages = None
+                if not target_name:
+                    # No document named: look the question up in the full-text
+                    # index (exact words) and the vector index (meaning)
+                    search_results = search_documents(user_id, analysis_query)
+                    passages = await search_passages(user_id, analysis_query, k=ANALYZE_PASSAGES)
+                    logger.info(f"Search found {len(search_results)} matching documents and {len(passages)} passages.")
+                    if not search_results and not passages:
+                        # Nothing in Drive matches: likely a general question
+                        # ("What is the capital of France?"), so just answer it
+                        logger.info("No matching documents; answering as a general question.")
+                        return await answer_generally(user_id, user_message, on_token, passages=passages,
+                                                      response_type="analysis_result")
+
+                drive_index = await aload_index(user_id) or []
+                logger.debug(f"Loaded drive index for analysis context ({len(drive_index)} items).")
+                current_history = session_store.get_history(user_id)
+
+                doc_id = await find_doc_id_by_name(target_name, creds, user_id=user_id) if target_name else None
 
                 analysis_result = await analyze_content(
                     analysis_query,
                     file_content_context=file_content_context,
                     drive_index=drive_index,
-                    chat_history=current_history
+                    chat_history=current_history,
+                    on_token=on_token,
+                    doc_version=doc_version,
+                    on_progress=lambda progress: notify("analyzing", **progress),
+                    doc_ref=document_reference(target_name, doc_id) if target_name else None,
+                    search_results=search_results,
+                    passages=passages
                 )
 
                 # Unpack result and updated history
                 analysis_result_dict, updated_history = analysis_result
-                chat_histories[user_id] = updated_history  # Store updated history
+                session_store.save_history(user_id, updated_history)  # Store updated history
 
                 if analysis_result_dict.get("error"):
                     raise HTTPException(status_code=500, detail=analysis_result_dict["error"])
@@ -385,22 +564,14 @@ async def handle_user_query(query: UserQuery, token_info: tuple[str, Credentials
                 # --- New: Actually update the doc ---
                 rewritten_content = analysis_result_dict.get("analysis")
                 if target_name and rewritten_content:
-                    from services.google_service import find_doc_id_by_name, update_google_doc
-                    doc_id = await find_doc_id_by_name(target_name, creds)
                     if doc_id:
-                        success = await update_google_doc(doc_id, rewritten_content, creds)
-                        if success:
-                            return {
-                                "success": True,
-                                "message": f"✅ Document '{target_name}' has been updated successfully.",
-                                "type": "analysis_result"
-                            }
-                        else:
-                            return {
-                                "success": False,
-                                "message": f"⚠️ Couldn't update the document '{target_name}'.",
-                                "type": "analysis_result"
-                            }
+                        job_id = submit_doc_update(user_id, creds, doc_id, target_name, rewritten_content)
+                        return {
+                            "success": True,
+                            "message": f"⏳ Updating '{target_name}'...",
+                            "type": "analysis_result",
+                            "jobId": job_id
+                        }
                     else:
                         return {
                             "success": False,
@@ -414,44 +585,22 @@ async def handle_user_query(query: UserQuery, token_info: tuple[str, Credentials
                         "type": "analysis_result"
                     }
 
-            
-        elif parsed.get("error"):
-            raise HTTPException(status_code=400, detail=parsed.get("error"))
-        else:
-            print(f"Unrecognized action parsed: {action}. Falling back to general response.")
-            try:
-                drive_index = load_index(user_id) or []
-                current_history = chat_histories.get(user_id, [])
-
-                if drive_index:
-                    index_prompt_lines = [f"- {item['name']} ({'Folder' if item.get('mimeType') == 'application/vnd.google-apps.folder' else 'File'}, id:{item['id']})" for item in drive_index[:200]]
-                    formatted_index = "\n".join(index_prompt_lines)
-                    drive_context = f"\nUser's Google Drive Contents (partial list):\n{formatted_index}\n---"
-                else:
-                    drive_context = "\nUser's Google Drive Contents: (Could not load or is empty)"
-                
-                print(f"[Debug] Drive context length: {len(drive_context)} chars for fallback")
-                response_content = await generate_gemini_response(
-                    user_message, 
-                    drive_context=drive_context,
-                    chat_history=current_history
-                )
-                
-                response_text, updated_history = response_content 
-                chat_histories[user_id] = updated_history
-                
-                return {
-                    "success": True,
-                    "message": response_text,
-                    "type": "fallback_message"
-                }
-                    
-            except Exception as e: 
-                print(f"Error generating fallback response: {e}")
-                raise HTTPException(status_code=500, detail="Sorry, I encountered an error trying to respond.")
+            elif parsed.get("error"):
+                raise HTTPException(status_code=400, detail=parsed.get("error"))
+            else:
+                logger.warning(f"Unrecognized action parsed: {action}. Falling back to general response.")
+                try:
+                    return await answer_generally(user_id, user_message, on_token)
+                except Exception as e: 
+                    logger.error(f"Error generating fallback response: {e}")
+                    raise HTTPException(status_code=500, detail="Sorry, I encountered an error trying to respond.")
 
     except HTTPException as http_exc:
+        phase.fail()
         raise http_exc
     except Exception as e:
-        print(f"Error handling user query: {e}")
+        phase.fail()
+        logger.error(f"Error handling user query: {e}")
         raise HTTPException(status_code=500, detail="Sorry, I encountered an error trying to respond.")
+    finally:
+        phase.close()
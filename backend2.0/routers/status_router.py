@@ -1,20 +1,74 @@
-from fastapi import APIRouter, Depends, HTTPException
+import os
+import secrets
+
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import PlainTextResponse
 # Make sure this import path is correct for your project structure
 from auth.auth import verify_google_token
-from services import drive_cache
+from services import (
+    content_cache, credential_cache, drive_cache, drive_client, gemini_cache, gemini_models, google_service, intent_service,
+    job_queue, tracing,
+)
 # Needed for the type hint in verify_google_token dependency
 from google.oauth2.credentials import Credentials
 
 router = APIRouter()
 
+# If set, /metrics requires "Authorization: Bearer <METRICS_TOKEN>"
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+tracing.register_collector("drive_api", drive_client.executor_stats)
+tracing.register_collector("index_cache", drive_cache.index_cache_stats)
+tracing.register_collector("content_cache", content_cache.content_cache_stats)
+tracing.register_collector("credentials", credential_cache.credential_cache_stats)
+tracing.register_collector("gemini_cache", gemini_cache.gemini_cache_stats)
+tracing.register_collector("gemini_models", gemini_models.model_registry_stats)
+tracing.register_collector("intent", intent_service.intent_stats)
+tracing.register_collector("jobs", job_queue.job_queue_stats)
+
 @router.get("/api/cache-status")
 async def get_cache_status(token_info: tuple[str, Credentials] = Depends(verify_google_token)):
-    """Checks if the drive cache file for the logged-in user exists."""
-    user_id, _ = token_info # Get user_id from verified session
-    cache_file = drive_cache.cache_path(user_id)
+    """Checks if the drive index for the logged-in user has been built.
+
+    While the first crawl runs, the status stays "pending" and `progress`
+    reports it (folders visited / remaining, items found, estimated time
+    left); the items found so far are already searchable. Polling also
+    resumes a crawl that stopped or whose worker went away.
+    """
+    user_id, creds = token_info # Get user_id from verified session
 
-    if cache_file.exists():
+    progress = google_service.crawl_progress(user_id)
+    if progress is not None:
+        await google_service.refresh_drive_index(user_id, creds)
+        progress = google_service.crawl_progress(user_id) or progress
+        return {"status": "pending", "partial": True, "progress": progress}
+    if drive_cache.has_index(user_id):
         return {"status": "ready"}
     else:
-        # The file doesn't exist, implying the background crawl isn't finished
+        # No index yet, implying the background crawl hasn't started
         return {"status": "pending"}
+
+@router.get("/api/jobs/{job_id}")
+async def get_job_status(job_id: str, token_info: tuple[str, Credentials] = Depends(verify_google_token)):
+    """State of a background job started by /api/ask (see services/job_queue).
+
+    `state` is queued, running, retrying, succeeded or failed; `stage` and
+    `progress` describe the running step, `result` holds the outcome
+    ({"message", ...}) once succeeded and `error` the reason once failed.
+    """
+    user_id, _ = token_info
+    job = job_queue.get_job(job_id, user_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics(request: Request):
+    """Prometheus text format: latency histograms of every traced span
+    (requests, Drive and Gemini calls, /ask phases) plus cache, pool and job
+    queue gauges. Per process: each gunicorn worker reports its own."""
+    if METRICS_TOKEN and not secrets.compare_digest(
+        request.headers.get("authorization", ""), f"Bearer {METRICS_TOKEN}"
+    ):
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+    return PlainTextResponse(tracing.render_metrics(), media_type="text/plain; version=0.0.4")
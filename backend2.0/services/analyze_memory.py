@@ -1,14 +1,14 @@
 # services/analyze_memory.py
-# Simple in-memory active doc tracker (can move to redis/db later if needed)
+# Active doc tracker, backed by the shared session store so every worker sees it
+
+from services import session_store
 
-active_docs = {}
 
 def set_active_doc(user_id: str, doc_id: str):
-    active_docs[user_id] = doc_id
+    session_store.set_active_doc(user_id, doc_id)
 
 def get_active_doc(user_id: str) -> str | None:
-    return active_docs.get(user_id)
+    return session_store.get_active_doc(user_id)
 
 def clear_active_doc(user_id: str):
-    if user_id in active_docs:
-        del active_docs[user_id]
+    session_store.clear_active_doc(user_id)
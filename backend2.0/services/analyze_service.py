@@ -1,40 +1,72 @@
+import asyncio
+import logging
 import os
-import google.generativeai as genai
+from typing import Awaitable, Callable
+
 from dotenv import load_dotenv
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from services import chat_history as history_manager, gemini_cache, gemini_models
+from services.drive_context import format_passages
+from services.drive_links import get_google_drive_url
+from services.gemini_service import TokenCallback, collect_stream
+from services.intent_service import is_summarize_request
 
 load_dotenv()
 
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-GEMINI_MODEL_NAME = "models/gemini-2.0-flash"
+from services.gemini_models import CHARS_PER_TOKEN, GEMINI_API_KEY, GEMINI_MODEL_NAME, estimate_tokens
 
-async def analyze_content(
-    user_query: str,
-    file_content_context: str | None = None,
-    drive_index: list[dict] | None = None,
-    chat_history: list | None = None
-) -> tuple[dict, list]:
-    """Analyzes or edits document content based on the user's instruction."""
+logger = logging.getLogger(__name__)
 
-    if not GEMINI_API_KEY:
-        print("Error: Gemini API Key not configured.")
-        return {"error": "Gemini service not configured."}, chat_history or []
+# Token budgets (estimated at ~CHARS_PER_TOKEN characters per token).
+# Documents up to ANALYZE_SINGLE_PASS_TOKENS go to Gemini in one prompt; longer
+# ones are split into ANALYZE_CHUNK_TOKENS chunks and processed map-reduce style.
+ANALYZE_SINGLE_PASS_TOKENS = int(os.getenv("ANALYZE_SINGLE_PASS_TOKENS", "6000"))
+ANALYZE_CHUNK_TOKENS = int(os.getenv("ANALYZE_CHUNK_TOKENS", "2000"))
+ANALYZE_CHUNK_OVERLAP_TOKENS = int(os.getenv("ANALYZE_CHUNK_OVERLAP_TOKENS", "100"))
+# Combined size of section summaries handed to the final merge call
+ANALYZE_MERGE_TOKENS = int(os.getenv("ANALYZE_MERGE_TOKENS", "6000"))
+ANALYZE_MAX_CONCURRENCY = int(os.getenv("ANALYZE_MAX_CONCURRENCY", "4"))
 
-    genai.configure(api_key=GEMINI_API_KEY)
+# Receives {"done": n, "total": m} as chunks finish
+ProgressCallback = Callable[[dict], Awaitable[None]]
 
-    # --- Format file content (basic) ---
-    file_context_string = file_content_context[:4000] if file_content_context else ""
+SECTION_SUMMARY_INSTRUCTION = "You summarize one section of a longer document. Output ONLY the summary of the section, keeping every key fact, name and number."
+SECTION_EDIT_INSTRUCTION = "You edit one section of a longer document. Output ONLY the updated section text, with no commentary."
 
-    # --- Decide which prompt to use ---
-    # Lowercase the instruction for easier keyword detection
-    user_query_lower = user_query.lower()
 
-    if any(keyword in user_query_lower for keyword in ["summarize", "shorter", "summarization", "make concise", "cut down", "condense", "make briefer"]):
-        prompt = f"""
+def split_document(text: str, chunk_tokens: int = ANALYZE_CHUNK_TOKENS, overlap_tokens: int = 0) -> list[str]:
+    """Splits on paragraph, then line, then word boundaries to fit the token budget.
+
+    Separators stay at the end of the chunk they close and nothing is
+    stripped, so without overlap "".join(chunks) == text.
+    """
+    splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_tokens * CHARS_PER_TOKEN,
+        chunk_overlap=overlap_tokens * CHARS_PER_TOKEN,
+        separators=["\n\n", "\n", ". ", " ", ""],
+        keep_separator="end",
+        strip_whitespace=False,
+    )
+    return splitter.split_text(text)
+
+def restore_spacing(chunk: str, edited: str) -> str:
+    """Gives an edited chunk the leading and trailing whitespace of the
+    original (model output comes back stripped), so edited chunks can be
+    joined with "" and an unchanged chunk comes back byte-identical."""
+    body = chunk.strip()
+    if not body:
+        return chunk
+    start = chunk.index(body[0])
+    return chunk[:start] + edited.strip() + chunk[start + len(body):]
+
+def _summarize_prompt(document: str, user_query: str) -> str:
+    return f"""
 You are a professional summarizer.
 
 Here is the original document:
 
-{file_context_string}
+{document}
 
 The user has requested:
 
@@ -51,15 +83,14 @@ Important Rules:
 - Do NOT explain your reasoning.
 - Output ONLY the summarized document text.
 """
-        print("[analyze_content] Detected summarization/editing task. Using summarization prompt.")
 
-    else:
-        prompt = f"""
+def _edit_prompt(document: str, user_query: str) -> str:
+    return f"""
 You are a professional document editor.
 
 Here is the original document:
 
-{file_context_string}
+{document}
 
 The user has requested:
 
@@ -74,19 +105,237 @@ Important Rules:
 - Do NOT explain your reasoning.
 - Output ONLY the updated document text.
 """
-        print("[analyze_content] Using standard editing prompt.")
 
-    print(f"[analyze_content] Sending prompt to Gemini (length: {len(prompt)} chars).")
+def _search_prompt(results: list[dict], passages: list[dict], user_query: str) -> str:
+    sections = []
+    if results:
+        matches = "\n".join(
+            f"- [{r['name']}]({get_google_drive_url(r)}): {r.get('snippet') or ''}" for r in results
+        )
+        sections.append(f"These documents matched the user's question (best match first), each with an excerpt where matching words are in **bold**:\n\n{matches}")
+    if passages:
+        sections.append(f"These passages from the user's documents are closest in meaning to the question (best first):\n\n{format_passages(passages)}")
+    found = "\n\n".join(sections)
+    return f"""
+You are a helpful assistant searching the user's Google Drive.
+
+{found}
+
+The user asked:
+
+"{user_query}"
+
+Your task:
+- Answer using only the documents above.
+- Refer to documents with the Markdown links given.
+- If none of them answers the question, say so briefly.
+"""
+
+async def _map_chunks(
+    chunks: list[str],
+    instruction: str,
+    user_query: str,
+    on_progress: ProgressCallback | None = None,
+    on_chunk_ready: Callable[[int, str], Awaitable[None]] | None = None,
+) -> list[str]:
+    """Runs `instruction` over every chunk with bounded concurrency.
+
+    Each result is cached on the chunk text itself, so re-running on a lightly
+    edited document only sends the chunks that changed.
+    """
+    model = gemini_models.get_model(GEMINI_MODEL_NAME, instruction)
+    semaphore = asyncio.Semaphore(ANALYZE_MAX_CONCURRENCY)
+    results: list[str | None] = [None] * len(chunks)
+    done = 0
+    lock = asyncio.Lock()
+
+    async def process(i: int, chunk: str):
+        nonlocal done
+        prompt = f"The user's request for the whole document: \"{user_query}\"\n\nSection:\n\n{chunk}"
+
+        async def call() -> str:
+            async with semaphore:
+                response = await model.generate_content_async(prompt)
+                return response.text.strip()
+
+        text, _ = await gemini_cache.cached_call(GEMINI_MODEL_NAME, instruction, prompt, call, normalize=False)
+        async with lock:
+            results[i] = text
+            done += 1
+            if on_progress:
+                await on_progress({"done": done, "total": len(chunks)})
+            if on_chunk_ready:
+                await on_chunk_ready(i, text)
+
+    await asyncio.gather(*(process(i, chunk) for i, chunk in enumerate(chunks)))
+    return results
+
+async def _reduce_summaries(summaries: list[str], user_query: str) -> list[str]:
+    """Merges neighbouring summaries until their total fits ANALYZE_MERGE_TOKENS."""
+    while len(summaries) > 1 and sum(estimate_tokens(s) for s in summaries) > ANALYZE_MERGE_TOKENS:
+        groups, current, current_tokens = [], [], 0
+        for summary in summaries:
+            tokens = estimate_tokens(summary)
+            if current and current_tokens + tokens > ANALYZE_CHUNK_TOKENS:
+                groups.append("\n\n".join(current))
+                current, current_tokens = [], 0
+            current.append(summary)
+            current_tokens += tokens
+        if current:
+            groups.append("\n\n".join(current))
+        if len(groups) == len(summaries):
+            break  # Each summary alone exceeds the chunk budget; merging can't shrink it further
+        summaries = await _map_chunks(groups, SECTION_SUMMARY_INSTRUCTION, user_query)
+    return summaries
+
+def _cache_version(doc_version: str | None, chat_history: list | None) -> str:
+    # Answers given in a chat session depend on the turns before them too
+    return f"{doc_version or ''}:{gemini_cache.history_fingerprint(chat_history)}"
+
+async def analyze_content(
+    user_query: str,
+    file_content_context: str | None = None,
+    drive_index: list[dict] | None = None,
+    chat_history: list | None = None,
+    on_token: TokenCallback | None = None,
+    doc_version: str | None = None,
+    use_cache: bool = True,
+    on_progress: ProgressCallback | None = None,
+    doc_ref: str | None = None,
+    search_results: list[dict] | None = None,
+    passages: list[dict] | None = None
+) -> tuple[dict, list]:
+    """Analyzes or edits document content based on the user's instruction.
+
+    Results are cached on the prompt, which embeds the document text, the
+    chat history the answer is given in, and `doc_version`
+    (e.g. "<file_id>:<modifiedTime>") when the caller knows it.
+    Documents over ANALYZE_SINGLE_PASS_TOKENS are processed in chunks, with
+    `on_progress` called as each chunk finishes. In the returned history the
+    document text is replaced by `doc_ref` (see chat_history.document_reference).
+    With `search_results` (fulltext_index matches) and/or `passages`
+    (vector_index matches) and no document, the question is answered from
+    those instead.
+    """
+
+    if not GEMINI_API_KEY:
+        logger.error("Gemini API Key not configured.")
+        return {"error": "Gemini service not configured."}, chat_history or []
+
+    document = file_content_context or ""
+    summarize = is_summarize_request(user_query)
+    reference = doc_ref or "[Document text omitted from history]"
+
+    if estimate_tokens(document) > ANALYZE_SINGLE_PASS_TOKENS:
+        try:
+            return await _analyze_chunked(
+                document, user_query, summarize, chat_history, on_token, on_progress, use_cache, reference, doc_version
+            )
+        except Exception as e:
+            logger.error(f"Error during chunked analysis in analyze_content: {e}")
+            return {"error": f"Failed to get analysis from AI: {e}"}, chat_history or []
+
+    # --- Decide which prompt to use ---
+    if (search_results or passages) and not document:
+        prompt = _search_prompt(search_results or [], passages or [], user_query)
+        reference = "[Search results omitted from history]"
+        logger.info(f"[analyze_content] Answering from {len(search_results or [])} full-text results and {len(passages or [])} passages.")
+    elif summarize:
+        prompt = _summarize_prompt(document, user_query)
+        logger.debug("[analyze_content] Detected summarization/editing task. Using summarization prompt.")
+    else:
+        prompt = _edit_prompt(document, user_query)
+        logger.debug("[analyze_content] Using standard editing prompt.")
+
+    logger.debug(f"[analyze_content] Sending prompt to Gemini (length: {len(prompt)} chars).")
 
     try:
-        model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+        model = gemini_models.get_model(GEMINI_MODEL_NAME)
         chat = model.start_chat(history=chat_history or [])
-        response = await chat.send_message_async(prompt)
-        analysis_result = response.text
-        print("[analyze_content] Received analysis result.")
 
-        return {"analysis": analysis_result.strip()}, chat.history
+        async def call() -> str:
+            if on_token:
+                response = await chat.send_message_async(prompt, stream=True)
+                return await collect_stream(response, on_token)
+            response = await chat.send_message_async(prompt)
+            return response.text
+
+        analysis_result, cached = await gemini_cache.cached_call(
+            GEMINI_MODEL_NAME, None, prompt, call, version=_cache_version(doc_version, chat_history),
+            use_cache=use_cache, normalize=False,
+        )
+        logger.debug(f"[analyze_content] Received analysis result{' (cached)' if cached else ''}.")
+
+        if cached:
+            if on_token:
+                await on_token(analysis_result)
+            history = gemini_cache.append_turn(chat_history, prompt, analysis_result)
+        else:
+            history = chat.history
+        # Past turns don't need the prompt template and whole document resent on every later turn
+        return {"analysis": analysis_result.strip()}, history_manager.strip_document(history, prompt, f"{user_query}\n{reference}")
 
     except Exception as e:
-        print(f"Error during Gemini API call in analyze_content: {e}")
+        logger.error(f"Error during Gemini API call in analyze_content: {e}")
         return {"error": f"Failed to get analysis from AI: {e}"}, chat_history or []
+
+async def _analyze_chunked(
+    document: str,
+    user_query: str,
+    summarize: bool,
+    chat_history: list | None,
+    on_token: TokenCallback | None,
+    on_progress: ProgressCallback | None,
+    use_cache: bool = True,
+    reference: str = "",
+    doc_version: str | None = None,
+) -> tuple[dict, list]:
+    """Map-reduce over a document too long for one prompt."""
+    if summarize:
+        chunks = split_document(document, overlap_tokens=ANALYZE_CHUNK_OVERLAP_TOKENS)
+        logger.info(f"[analyze_content] Summarizing {len(chunks)} chunks (max {ANALYZE_MAX_CONCURRENCY} at a time).")
+        summaries = await _map_chunks(chunks, SECTION_SUMMARY_INSTRUCTION, user_query, on_progress)
+        summaries = await _reduce_summaries(summaries, user_query)
+
+        # Final pass: one summary in the shape the user asked for, in the chat session
+        prompt = _summarize_prompt("\n\n".join(summaries), user_query)
+        chat = gemini_models.get_model(GEMINI_MODEL_NAME).start_chat(history=chat_history or [])
+
+        async def call() -> str:
+            if on_token:
+                response = await chat.send_message_async(prompt, stream=True)
+                return await collect_stream(response, on_token)
+            response = await chat.send_message_async(prompt)
+            return response.text
+
+        result, cached = await gemini_cache.cached_call(
+            GEMINI_MODEL_NAME, None, prompt, call, version=_cache_version(doc_version, chat_history),
+            use_cache=use_cache, normalize=False,
+        )
+        if cached and on_token:
+            await on_token(result)
+        history = gemini_cache.append_turn(chat_history, prompt, result) if cached else chat.history
+        return {"analysis": result.strip()}, history_manager.strip_document(history, prompt, f"{user_query}\n{reference}")
+
+    # Edits: each chunk is rewritten independently and stitched back in order.
+    # No overlap, or the overlapping text would appear twice in the output.
+    chunks = split_document(document)
+    logger.info(f"[analyze_content] Editing {len(chunks)} chunks (max {ANALYZE_MAX_CONCURRENCY} at a time).")
+    ready: dict[int, str] = {}
+    next_to_stream = 0
+
+    async def stream_in_order(i: int, text: str):
+        # Stream each section as soon as every section before it is done
+        nonlocal next_to_stream
+        ready[i] = restore_spacing(chunks[i], text)
+        while next_to_stream in ready:
+            await on_token(ready.pop(next_to_stream))
+            next_to_stream += 1
+
+    edited = await _map_chunks(
+        chunks, SECTION_EDIT_INSTRUCTION, user_query, on_progress,
+        on_chunk_ready=stream_in_order if on_token else None,
+    )
+    # The chunks keep their separators, so they join back without adding any
+    result = "".join(restore_spacing(chunk, text) for chunk, text in zip(chunks, edited))
+    return {"analysis": result}, gemini_cache.append_turn(chat_history, f"{user_query}\n{reference}", result)
@@ -0,0 +1,97 @@
+# services/chat_history.py
+# Keeps the chat history sent to Gemini on every turn within a token budget.
+#
+# Without this the prompt grows linearly over a session: every analysis turn
+# embeds the whole document and the model's full rewrite of it. Before a
+# history is stored:
+#   1. document text embedded in past prompts is replaced with a short
+#      reference (strip_document, done by the caller that knows the doc),
+#   2. any single message over HISTORY_MAX_MESSAGE_TOKENS is clipped,
+#   3. the oldest exchanges are folded into a short running summary until
+#      the whole history fits HISTORY_TOKEN_BUDGET.
+
+import os
+
+from services import gemini_cache
+from services.gemini_models import CHARS_PER_TOKEN, estimate_tokens
+
+HISTORY_TOKEN_BUDGET = int(os.getenv("CHAT_HISTORY_TOKEN_BUDGET", "4000"))
+HISTORY_MAX_MESSAGE_TOKENS = int(os.getenv("CHAT_HISTORY_MAX_MESSAGE_TOKENS", "800"))
+HISTORY_SUMMARY_TOKENS = int(os.getenv("CHAT_HISTORY_SUMMARY_TOKENS", "300"))
+
+SUMMARY_PREFIX = "Summary of the earlier conversation:"
+SUMMARY_ACK = "Understood."
+# Characters of each dropped user message kept in the summary
+SUMMARY_LINE_CHARS = 160
+
+
+def document_reference(name: str, file_id: str | None = None) -> str:
+    ref = f"'{name}'" + (f" (id: {file_id})" if file_id else "")
+    return f"[Document {ref} - content omitted from history]"
+
+def _to_messages(history: list | None) -> list[dict]:
+    messages = []
+    for entry in history or []:
+        role, parts = gemini_cache.content_parts(entry)
+        messages.append({"role": role, "parts": list(parts)})
+    return messages
+
+def message_tokens(message: dict) -> int:
+    return sum(estimate_tokens(part) for part in message["parts"])
+
+def history_tokens(history: list | None) -> int:
+    return sum(message_tokens(m) for m in _to_messages(history))
+
+def strip_document(history: list | None, document: str | None, reference: str) -> list[dict]:
+    """Replaces every copy of `document` in the history with `reference`."""
+    messages = _to_messages(history)
+    if not document or estimate_tokens(document) < estimate_tokens(reference):
+        return messages
+    for message in messages:
+        message["parts"] = [part.replace(document, reference) for part in message["parts"]]
+    return messages
+
+def _clip(text: str, max_tokens: int) -> str:
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    keep = max_tokens * CHARS_PER_TOKEN // 2  # Characters kept at each end
+    omitted = estimate_tokens(text[keep:-keep])
+    return f"{text[:keep]}\n[... about {omitted} tokens omitted ...]\n{text[-keep:]}"
+
+def _summary_line(message: dict) -> str:
+    text = " ".join(" ".join(message["parts"]).split())
+    if len(text) > SUMMARY_LINE_CHARS:
+        text = text[:SUMMARY_LINE_CHARS - 3] + "..."
+    return f"- The user asked: {text}"
+
+def _is_summary(messages: list[dict]) -> bool:
+    return len(messages) >= 2 and messages[0]["parts"][:1] and messages[0]["parts"][0].startswith(SUMMARY_PREFIX)
+
+def compact(history: list | None, budget_tokens: int = HISTORY_TOKEN_BUDGET) -> list[dict]:
+    """The history as plain {role, parts} dicts, fitted to `budget_tokens`."""
+    messages = _to_messages(history)
+    for message in messages:
+        message["parts"] = [_clip(part, HISTORY_MAX_MESSAGE_TOKENS) for part in message["parts"]]
+
+    summary_lines: list[str] = []
+    if _is_summary(messages):
+        summary_lines = messages[0]["parts"][0].splitlines()[1:]
+        messages = messages[2:]
+
+    def total() -> int:
+        summary = estimate_tokens("\n".join([SUMMARY_PREFIX, *summary_lines])) if summary_lines else 0
+        return summary + sum(message_tokens(m) for m in messages)
+
+    # Fold the oldest exchanges into the summary, always keeping the latest one
+    while len(messages) > 2 and total() > budget_tokens:
+        dropped, messages = messages[:2], messages[2:]
+        summary_lines += [_summary_line(m) for m in dropped if m["role"] == "user"]
+        while summary_lines and estimate_tokens("\n".join(summary_lines)) > HISTORY_SUMMARY_TOKENS:
+            summary_lines.pop(0)  # The summary itself is bounded too
+
+    if summary_lines:
+        messages = [
+            {"role": "user", "parts": ["\n".join([SUMMARY_PREFIX, *summary_lines])]},
+            {"role": "model", "parts": [SUMMARY_ACK]},
+        ] + messages
+    return messages
@@ -0,0 +1,168 @@
+# services/content_cache.py
+# Cache of exported document text, keyed by (file_id, modifiedTime).
+# A Drive file's modifiedTime changes whenever its content does, so an entry
+# never needs invalidating: a new version simply gets a new key.
+#
+# Tier 1: in-memory LRU of zlib-compressed text, bounded by compressed bytes.
+# Tier 2 (optional): compressed files under drive_cache/content/, shared by
+#         all workers on the machine and bounded by total size on disk.
+#
+# Disk reads and writes run on worker threads. The disk tier's files and
+# total size are tracked in memory (one directory scan per process, then
+# kept up to date on every write), so a put never lists the directory.
+# Files written by other workers are picked up by a rescan every
+# CONTENT_CACHE_DISK_RESCAN seconds; until then each worker's view of the
+# total is approximate.
+
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+from services import drive_cache
+
+logger = logging.getLogger(__name__)
+
+CONTENT_CACHE_MAX_BYTES = int(os.getenv("CONTENT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+CONTENT_CACHE_DISK = os.getenv("CONTENT_CACHE_DISK", "true").lower() in ("1", "true", "yes")
+CONTENT_CACHE_DISK_MAX_BYTES = int(os.getenv("CONTENT_CACHE_DISK_MAX_BYTES", str(512 * 1024 * 1024)))
+CONTENT_CACHE_DISK_RESCAN = float(os.getenv("CONTENT_CACHE_DISK_RESCAN", "600"))
+CONTENT_CACHE_DIR = drive_cache.CACHE_DIR / "content"
+
+_memory: "OrderedDict[tuple[str, str], bytes]" = OrderedDict()
+_memory_bytes = 0
+_lock = threading.Lock()
+# Disk tier: file_id -> (file name, size), least recently used first. One
+# version per file: writing a new version deletes the old one.
+_disk: "OrderedDict[str, tuple[str, int]]" = OrderedDict()
+_disk_bytes = 0
+_disk_scanned_at: float | None = None
+_disk_lock = threading.Lock()
+_counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0, "disk_evictions": 0}
+
+if CONTENT_CACHE_DISK:
+    CONTENT_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+
+
+def _disk_path(file_id: str, modified_time: str):
+    version = hashlib.sha1(modified_time.encode()).hexdigest()[:16]
+    return CONTENT_CACHE_DIR / f"{file_id}.{version}.z"
+
+def _remember(key: tuple[str, str], blob: bytes):
+    global _memory_bytes
+    if len(blob) > CONTENT_CACHE_MAX_BYTES:
+        return
+    with _lock:
+        old = _memory.pop(key, None)
+        if old is not None:
+            _memory_bytes -= len(old)
+        _memory[key] = blob
+        _memory_bytes += len(blob)
+        while _memory_bytes > CONTENT_CACHE_MAX_BYTES:
+            _, evicted = _memory.popitem(last=False)
+            _memory_bytes -= len(evicted)
+            _counters["evictions"] += 1
+
+def _scan_disk():
+    """Rebuilds the disk tier's bookkeeping from the directory (call with _disk_lock held)."""
+    global _disk_bytes, _disk_scanned_at
+    _disk_scanned_at = time.monotonic()
+    try:
+        files = sorted(((p, p.stat()) for p in CONTENT_CACHE_DIR.glob("*.z")), key=lambda f: f[1].st_mtime)
+    except OSError:
+        return
+    _disk.clear()
+    _disk_bytes = 0
+    for path, st in files:
+        file_id = path.name.split(".", 1)[0]
+        if file_id in _disk:
+            # An older version left by another worker
+            _forget_disk(file_id)
+        _disk[file_id] = (path.name, st.st_size)
+        _disk_bytes += st.st_size
+
+def _forget_disk(file_id: str):
+    """Deletes file_id's disk entry (call with _disk_lock held)."""
+    global _disk_bytes
+    name, size = _disk.pop(file_id)
+    (CONTENT_CACHE_DIR / name).unlink(missing_ok=True)
+    _disk_bytes -= size
+
+def _write_disk(file_id: str, modified_time: str, blob: bytes):
+    global _disk_bytes
+    path = _disk_path(file_id, modified_time)
+    try:
+        tmp = path.with_suffix(".tmp")
+        tmp.write_bytes(blob)
+        tmp.replace(path)
+    except OSError as e:
+        logger.error(f"Error writing content cache for {file_id}: {e}")
+        return
+    with _disk_lock:
+        if _disk_scanned_at is None or time.monotonic() - _disk_scanned_at > CONTENT_CACHE_DISK_RESCAN:
+            _scan_disk()
+        elif file_id in _disk and _disk[file_id][0] != path.name:
+            # Older versions of the same file are dead weight now
+            _forget_disk(file_id)
+        if file_id in _disk:
+            _disk_bytes -= _disk.pop(file_id)[1]
+        _disk[file_id] = (path.name, len(blob))
+        _disk_bytes += len(blob)
+        while _disk_bytes > CONTENT_CACHE_DISK_MAX_BYTES and len(_disk) > 1:
+            _forget_disk(next(iter(_disk)))
+            with _lock:
+                _counters["disk_evictions"] += 1
+
+def _read_disk(file_id: str, modified_time: str) -> bytes | None:
+    path = _disk_path(file_id, modified_time)
+    try:
+        blob = path.read_bytes()
+    except OSError:
+        return None
+    with _disk_lock:
+        if file_id in _disk and _disk[file_id][0] == path.name:
+            _disk.move_to_end(file_id)
+    return blob
+
+
+async def get(file_id: str, modified_time: str | None) -> str | None:
+    """Returns the cached text for this exact file version, or None."""
+    if not file_id or not modified_time:
+        return None
+    key = (file_id, modified_time)
+    with _lock:
+        blob = _memory.get(key)
+        if blob is not None:
+            _memory.move_to_end(key)
+            _counters["memory_hits"] += 1
+    if blob is None and CONTENT_CACHE_DISK:
+        blob = await asyncio.to_thread(_read_disk, file_id, modified_time)
+        if blob is not None:
+            _remember(key, blob)
+            with _lock:
+                _counters["disk_hits"] += 1
+    if blob is None:
+        with _lock:
+            _counters["misses"] += 1
+        return None
+    return zlib.decompress(blob).decode("utf-8")
+
+async def put(file_id: str, modified_time: str | None, text: str):
+    if not file_id or not modified_time:
+        return
+    blob = zlib.compress(text.encode("utf-8"), 6)
+    _remember((file_id, modified_time), blob)
+    if CONTENT_CACHE_DISK:
+        await asyncio.to_thread(_write_disk, file_id, modified_time, blob)
+
+def content_cache_stats() -> dict:
+    with _lock:
+        stats = {**_counters, "entries": len(_memory), "memory_bytes": _memory_bytes,
+                 "max_memory_bytes": CONTENT_CACHE_MAX_BYTES}
+    with _disk_lock:
+        stats.update(disk_entries=len(_disk), disk_bytes=_disk_bytes, max_disk_bytes=CONTENT_CACHE_DISK_MAX_BYTES)
+    return stats
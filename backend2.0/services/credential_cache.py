@@ -0,0 +1,183 @@
+# services/credential_cache.py
+# Per-process cache of users' Google OAuth credentials.
+#
+# Rebuilding Credentials from the session cookie on every request meant that
+# once the hourly access token expired, each in-flight request from that user
+# refreshed it again with a blocking HTTP call on the event loop. Here:
+#   - one Credentials object per user is kept and reused across requests;
+#   - a token within CREDENTIAL_REFRESH_MARGIN of expiry is refreshed in the
+#     background while requests keep using it, so most requests never wait;
+#   - concurrent refreshes for a user are coalesced into one (single-flight);
+#   - refreshes run on a worker thread over one shared keep-alive
+#     requests.Session to the token endpoint.
+# A refresh produces a new Credentials object; requests holding the old one
+# keep a token that is still valid.
+#
+# The cache is per process; each gunicorn worker refreshes at most once per
+# user per token lifetime. The session cookie stays the source of truth on
+# login, and is brought up to date by verify_google_token after a refresh.
+
+import asyncio
+import logging
+import os
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+
+import google.auth.transport.requests
+import requests
+from google.auth import exceptions as auth_exceptions
+from google.oauth2.credentials import Credentials
+
+from services import tracing
+
+logger = logging.getLogger(__name__)
+
+# Refresh in the background once a token has less than this left
+CREDENTIAL_REFRESH_MARGIN = float(os.getenv("CREDENTIAL_REFRESH_MARGIN", "300"))
+# With less than this left, wait for the refresh instead of using the token
+CREDENTIAL_MIN_VALIDITY = float(os.getenv("CREDENTIAL_MIN_VALIDITY", "30"))
+CREDENTIAL_REFRESH_TIMEOUT = float(os.getenv("CREDENTIAL_REFRESH_TIMEOUT", "20"))
+CREDENTIAL_CACHE_MAX_USERS = int(os.getenv("CREDENTIAL_CACHE_MAX_USERS", "5000"))
+
+
+class RefreshFailed(Exception):
+    """The refresh token was rejected (revoked, expired): the user must log in again."""
+
+
+class RefreshUnavailable(Exception):
+    """The token endpoint couldn't be reached; the token is unusable until it is."""
+
+
+@dataclass
+class _Entry:
+    creds: Credentials
+    refresh: asyncio.Task | None = field(default=None, repr=False)
+    # A background refresh was refused; don't retry until the token expires
+    rejected: bool = False
+
+
+_entries: "OrderedDict[str, _Entry]" = OrderedDict()
+_counters = {
+    "hits": 0,
+    "loads": 0,
+    "refreshes": 0,
+    "background_refreshes": 0,
+    "coalesced": 0,
+    "refresh_failures": 0,
+}
+
+# One keep-alive session for every refresh (requests.Session is safe to share
+# for plain POSTs like these)
+_http = requests.Session()
+_token_request = google.auth.transport.requests.Request(session=_http)
+
+
+def _utcnow() -> datetime:
+    # google-auth compares naive UTC datetimes
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def _remaining(creds: Credentials) -> float:
+    if creds.expiry is None:
+        return float("inf")
+    return (creds.expiry - _utcnow()).total_seconds()
+
+def from_session(data: dict) -> Credentials:
+    """Credentials from the dict stored in the session cookie."""
+    creds = Credentials(**{key: value for key, value in data.items() if key != "expiry"})
+    if data.get("expiry"):
+        creds.expiry = datetime.fromisoformat(data["expiry"])
+    return creds
+
+def to_session(creds: Credentials) -> dict:
+    return {
+        'token': creds.token,
+        'refresh_token': creds.refresh_token,
+        'token_uri': creds.token_uri,
+        'client_id': creds.client_id,
+        'client_secret': creds.client_secret,
+        'scopes': creds.scopes,
+        # Stored as an ISO string for JSON serialization
+        'expiry': creds.expiry.isoformat() if creds.expiry else None
+    }
+
+
+def _refresh_blocking(creds: Credentials) -> Credentials:
+    fresh = from_session(to_session(creds))
+    fresh.refresh(_token_request)
+    return fresh
+
+async def _refresh(user_id: str, entry: _Entry, background: bool):
+    _counters["background_refreshes" if background else "refreshes"] += 1
+    try:
+        with tracing.span("auth.refresh_token", background=background):
+            fresh = await asyncio.wait_for(
+                asyncio.to_thread(_refresh_blocking, entry.creds), CREDENTIAL_REFRESH_TIMEOUT
+            )
+    except auth_exceptions.RefreshError as e:
+        _counters["refresh_failures"] += 1
+        if background:
+            entry.rejected = True
+        elif _entries.get(user_id) is entry:
+            del _entries[user_id]
+        raise RefreshFailed(str(e)) from e
+    except Exception as e:
+        _counters["refresh_failures"] += 1
+        raise RefreshUnavailable(str(e) or e.__class__.__name__) from e
+    entry.creds = fresh
+    logger.info(f"Token refreshed for user {user_id[:10]} ({'ahead of expiry' if background else 'expired'}).")
+
+def _start_refresh(user_id: str, entry: _Entry, background: bool) -> asyncio.Task:
+    if entry.refresh is None or entry.refresh.done():
+        entry.refresh = asyncio.create_task(_refresh(user_id, entry, background))
+        if background:
+            # Nobody awaits it; log instead of leaving the failure unobserved
+            entry.refresh.add_done_callback(_log_background_failure)
+    else:
+        _counters["coalesced"] += 1
+    return entry.refresh
+
+def _log_background_failure(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Background token refresh failed: {task.exception()}")
+
+
+async def get_credentials(user_id: str, session_creds: dict) -> Credentials:
+    """The user's current credentials, refreshed if needed.
+
+    `session_creds` (from the session cookie) seeds the cache and replaces
+    the cached entry after a new login. Raises RefreshFailed when the user
+    has to log in again, RefreshUnavailable when Google can't be reached and
+    the token has (nearly) expired.
+    """
+    entry = _entries.get(user_id)
+    if entry is None or entry.creds.refresh_token != session_creds.get('refresh_token'):
+        # First request in this process, or a new login
+        _counters["loads"] += 1
+        entry = _Entry(from_session(session_creds))
+        _entries[user_id] = entry
+        while len(_entries) > CREDENTIAL_CACHE_MAX_USERS:
+            _entries.popitem(last=False)
+    else:
+        _counters["hits"] += 1
+        _entries.move_to_end(user_id)
+
+    remaining = _remaining(entry.creds)
+    if remaining > CREDENTIAL_REFRESH_MARGIN or not entry.creds.refresh_token:
+        return entry.creds
+    if remaining > CREDENTIAL_MIN_VALIDITY:
+        if not entry.rejected:
+            _start_refresh(user_id, entry, background=True)
+        return entry.creds
+    # shield: one caller going away (client disconnect) mustn't cancel the
+    # refresh the other callers are waiting on
+    await asyncio.shield(_start_refresh(user_id, entry, background=False))
+    return entry.creds
+
+def store(user_id: str, creds: Credentials):
+    """Seeds the cache with freshly issued credentials (after login)."""
+    _entries[user_id] = _Entry(creds)
+    _entries.move_to_end(user_id)
+
+def credential_cache_stats() -> dict:
+    return {**_counters, "entries": len(_entries), "max_entries": CREDENTIAL_CACHE_MAX_USERS}
@@ -0,0 +1,120 @@
+# services/doc_diff.py
+# Turns "replace this doc's text with new text" into the minimal set of
+# Docs API `deleteContentRange` / `insertText` requests, so an edit costs
+# roughly the size of the change and untouched text keeps its formatting,
+# comments and suggestions.
+#
+# Docs indices count UTF-16 code units and skip over non-text elements
+# (inline images, page breaks, ...), so the plain text is extracted together
+# with the document index of every character.
+
+import difflib
+import os
+
+# Char-level refinement is quadratic; larger changed blocks are replaced whole
+DOC_DIFF_MAX_CHAR_BLOCK = int(os.getenv("DOC_DIFF_MAX_CHAR_BLOCK", "20000"))
+# Beyond this many operations a full rewrite is smaller than the diff
+DOC_DIFF_MAX_OPS = int(os.getenv("DOC_DIFF_MAX_OPS", "2000"))
+
+# Body elements whose text can't be mapped back to a flat string
+UNSUPPORTED_ELEMENTS = ("table", "tableOfContents")
+
+
+class UnsupportedDocument(Exception):
+    """The document contains structure a plain-text diff can't update safely."""
+
+
+def _utf16_len(ch: str) -> int:
+    return 2 if ord(ch) > 0xFFFF else 1
+
+def extract_text(document: dict) -> tuple[str, list[int], int]:
+    """Returns (text, index of each character, body end index).
+
+    The body's final newline is left out of `text`: the API doesn't allow
+    deleting it, so edits are made in front of it instead.
+    """
+    chars: list[str] = []
+    indices: list[int] = []
+    content = document.get("body", {}).get("content", [])
+    for element in content:
+        if any(key in element for key in UNSUPPORTED_ELEMENTS):
+            raise UnsupportedDocument(f"document contains a {next(k for k in UNSUPPORTED_ELEMENTS if k in element)}")
+        for part in element.get("paragraph", {}).get("elements", []):
+            text = part.get("textRun", {}).get("content")
+            if text is None:
+                continue  # Non-text element: its index is simply skipped
+            index = part.get("startIndex", 0)
+            for ch in text:
+                chars.append(ch)
+                indices.append(index)
+                index += _utf16_len(ch)
+    end_index = content[-1].get("endIndex", 1) if content else 1
+    if chars and chars[-1] == "\n":
+        chars.pop()
+        indices.pop()
+    return "".join(chars), indices, end_index
+
+def _diff_ops(old: str, new: str) -> list[tuple[int, int, str]]:
+    """(start, end, replacement) edits in `old` coordinates, in ascending order.
+
+    Diffs by line first, then refines each changed block by character.
+    """
+    old_lines = old.splitlines(keepends=True)
+    new_lines = new.splitlines(keepends=True)
+    old_offsets = [0]
+    for line in old_lines:
+        old_offsets.append(old_offsets[-1] + len(line))
+
+    ops = []
+    line_matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in line_matcher.get_opcodes():
+        if tag == "equal":
+            continue
+        start, end = old_offsets[i1], old_offsets[i2]
+        replacement = "".join(new_lines[j1:j2])
+        old_block = old[start:end]
+        if tag != "replace" or len(old_block) + len(replacement) > DOC_DIFF_MAX_CHAR_BLOCK:
+            ops.append((start, end, replacement))
+            continue
+        char_matcher = difflib.SequenceMatcher(None, old_block, replacement, autojunk=False)
+        for ctag, c1, c2, d1, d2 in char_matcher.get_opcodes():
+            if ctag != "equal":
+                ops.append((start + c1, start + c2, replacement[d1:d2]))
+    return ops
+
+def _contiguous_ranges(old: str, indices: list[int], start: int, end: int) -> list[tuple[int, int]]:
+    """Document index ranges covering old[start:end], split around skipped elements."""
+    ranges = []
+    range_start = indices[start]
+    for k in range(start, end):
+        next_index = indices[k] + _utf16_len(old[k])
+        if k + 1 == end or indices[k + 1] != next_index:
+            ranges.append((range_start, next_index))
+            if k + 1 < end:
+                range_start = indices[k + 1]
+    return ranges
+
+def build_requests(document: dict, new_text: str) -> list[dict]:
+    """Docs batchUpdate requests that turn `document`'s body text into `new_text`.
+
+    Requests run from the end of the document towards the start, so each one
+    addresses indices no earlier request has shifted. Raises
+    UnsupportedDocument when a diff can't be applied safely.
+    """
+    old, indices, end_index = extract_text(document)
+    new = new_text[:-1] if new_text.endswith("\n") else new_text
+
+    ops = _diff_ops(old, new)
+    if len(ops) > DOC_DIFF_MAX_OPS:
+        raise UnsupportedDocument(f"{len(ops)} edits; a full rewrite is smaller")
+
+    requests = []
+    for start, end, replacement in reversed(ops):
+        # Inserting at the very end goes in front of the body's final newline
+        location = indices[start] if start < len(old) else end_index - 1
+        if end > start:
+            for range_start, range_end in reversed(_contiguous_ranges(old, indices, start, end)):
+                requests.append({"deleteContentRange": {"range": {"startIndex": range_start, "endIndex": range_end}}})
+        if replacement:
+            requests.append({"insertText": {"location": {"index": location}, "text": replacement}})
+    return requests
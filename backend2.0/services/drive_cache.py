@@ -1,27 +1,464 @@
-import json, os, datetime, pathlib
+import asyncio, json, logging, os, datetime, pathlib, sqlite3, threading
+from collections import OrderedDict
 
+from services import tracing
+
+logger = logging.getLogger(__name__)
 
 CACHE_DIR = pathlib.Path("drive_cache")
 CACHE_DIR.mkdir(exist_ok=True)
 
+# All users' indexes live in one SQLite database (WAL mode, so the gunicorn
+# workers can read while another one writes). Items are stored one row each,
+# indexed on the columns we look things up by.
+DB_PATH = pathlib.Path(os.getenv("DRIVE_INDEX_DB", str(CACHE_DIR / "drive_index.db")))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    user_id       TEXT NOT NULL,
+    id            TEXT NOT NULL,
+    seq           INTEGER NOT NULL,
+    name          TEXT,
+    name_lower    TEXT,
+    mime_type     TEXT,
+    parent        TEXT,
+    parents       TEXT,
+    path          TEXT,
+    modified_time TEXT,
+    PRIMARY KEY (user_id, id)
+);
+CREATE INDEX IF NOT EXISTS items_seq        ON items (user_id, seq);
+CREATE INDEX IF NOT EXISTS items_name       ON items (user_id, name);
+CREATE INDEX IF NOT EXISTS items_name_lower ON items (user_id, name_lower);
+CREATE INDEX IF NOT EXISTS items_parent     ON items (user_id, parent);
+CREATE INDEX IF NOT EXISTS items_mime_type  ON items (user_id, mime_type);
+
+CREATE TABLE IF NOT EXISTS indexes (
+    user_id    TEXT PRIMARY KEY,
+    updated_at REAL NOT NULL,
+    item_count INTEGER NOT NULL,
+    page_token TEXT,
+    root_id    TEXT,
+    synced_at  REAL
+);
+
+-- First-time crawls in progress (see "Resumable crawls" below)
+CREATE TABLE IF NOT EXISTS crawls (
+    user_id       TEXT PRIMARY KEY,
+    owner         TEXT NOT NULL,
+    page_token    TEXT NOT NULL,
+    root_id       TEXT NOT NULL,
+    frontier      TEXT NOT NULL,
+    folders_done  INTEGER NOT NULL DEFAULT 0,
+    items_found   INTEGER NOT NULL DEFAULT 0,
+    started_at    REAL NOT NULL,
+    checkpoint_at REAL NOT NULL
+);
+"""
+
+_ITEM_COLUMNS = "id, name, mime_type, parents, path, modified_time"
+
+_local = threading.local()
+
+# --- In-process LRU of parsed indexes ---
+# Bounded by the total number of items held across all cached users; entries
+# are revalidated against the index's `updated_at` on every read.
+INDEX_CACHE_MAX_ITEMS = int(os.getenv("DRIVE_INDEX_CACHE_MAX_ITEMS", "200000"))
+
+_index_cache: "OrderedDict[str, tuple[float, list[dict]]]" = OrderedDict()
+_index_cache_items = 0
+_index_cache_lock = threading.Lock()
+_index_cache_counters = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+def _db() -> sqlite3.Connection:
+    """One connection per thread (sqlite3 connections must not be shared across threads)."""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(_SCHEMA)
+        _local.conn = conn
+    return conn
+
+def _now() -> float:
+    return datetime.datetime.now(datetime.timezone.utc).timestamp()
+
+def _row_to_item(row: tuple) -> dict:
+    item_id, name, mime_type, parents, path, modified_time = row
+    item = {"id": item_id, "name": name, "mimeType": mime_type}
+    if parents:
+        item["parents"] = parents.split(",")
+    if modified_time:
+        item["modifiedTime"] = modified_time
+    item["path"] = path
+    return item
+
+def _item_to_row(user_id: str, seq: int, item: dict) -> tuple:
+    parents = item.get("parents") or []
+    name = item.get("name")
+    return (
+        user_id, item["id"], seq, name, name.lower() if name else None,
+        item.get("mimeType"), parents[0] if parents else None,
+        ",".join(parents) or None, item.get("path"), item.get("modifiedTime"),
+    )
+
+def _touch(conn: sqlite3.Connection, user_id: str):
+    conn.execute(
+        "UPDATE indexes SET updated_at = ?, item_count = (SELECT COUNT(*) FROM items WHERE user_id = ?) "
+        "WHERE user_id = ?",
+        (_now(), user_id, user_id),
+    )
+
+
+def _index_version(user_id: str) -> float | None:
+    row = _db().execute("SELECT updated_at FROM indexes WHERE user_id = ?", (user_id,)).fetchone()
+    return row[0] if row else None
+
+def _cache_get(user_id: str, version: float) -> list[dict] | None:
+    with _index_cache_lock:
+        entry = _index_cache.get(user_id)
+        if entry and entry[0] == version:
+            _index_cache.move_to_end(user_id)
+            _index_cache_counters["hits"] += 1
+            return entry[1]
+        _index_cache_counters["misses"] += 1
+        return None
+
+def _cache_put(user_id: str, version: float, index: list[dict]):
+    global _index_cache_items
+    if len(index) > INDEX_CACHE_MAX_ITEMS:
+        return  # Would evict everything else; just serve it uncached
+    with _index_cache_lock:
+        old = _index_cache.pop(user_id, None)
+        if old:
+            _index_cache_items -= len(old[1])
+        _index_cache[user_id] = (version, index)
+        _index_cache_items += len(index)
+        while _index_cache_items > INDEX_CACHE_MAX_ITEMS and len(_index_cache) > 1:
+            _, (_, evicted) = _index_cache.popitem(last=False)
+            _index_cache_items -= len(evicted)
+            _index_cache_counters["evictions"] += 1
+
+def invalidate_cached_index(user_id: str):
+    global _index_cache_items
+    with _index_cache_lock:
+        old = _index_cache.pop(user_id, None)
+        if old:
+            _index_cache_items -= len(old[1])
+            _index_cache_counters["invalidations"] += 1
+
+def index_cache_stats() -> dict:
+    """Hit/miss/eviction counters and current size of the parsed-index LRU."""
+    with _index_cache_lock:
+        return {
+            **_index_cache_counters,
+            "users": len(_index_cache),
+            "items": _index_cache_items,
+            "max_items": INDEX_CACHE_MAX_ITEMS,
+        }
+
+
+# --- Legacy JSON files (pre-SQLite) ---
 def cache_path(user_id: str) -> pathlib.Path:
+    """Path of the old per-user JSON index; only read once to migrate it."""
     return CACHE_DIR / f"{user_id}.json"
 
-def load_index(user_id: str) -> list[dict] | None:
+def _migrate_legacy(user_id: str) -> bool:
     p = cache_path(user_id)
-    return json.loads(p.read_text()) if p.exists() else None
+    if not p.exists():
+        return False
+    try:
+        save_index(user_id, json.loads(p.read_text()))
+        sync_p = CACHE_DIR / f"{user_id}.sync.json"
+        if sync_p.exists():
+            state = json.loads(sync_p.read_text())
+            save_sync_state(user_id, state["page_token"], state["root_id"])
+            sync_p.unlink(missing_ok=True)
+        p.unlink(missing_ok=True)
+        logger.info(f"Migrated legacy JSON Drive index for user {user_id} to SQLite.")
+        return True
+    except (OSError, ValueError, KeyError) as e:
+        logger.error(f"Error migrating legacy Drive index for {user_id}: {e}")
+        return False
+
+
+# --- Whole-index API (compatibility layer) ---
+def has_index(user_id: str) -> bool:
+    row = _db().execute("SELECT 1 FROM indexes WHERE user_id = ?", (user_id,)).fetchone()
+    return row is not None or _migrate_legacy(user_id)
+
+@tracing.traced("index.load")
+def load_index(user_id: str) -> list[dict] | None:
+    """Returns the user's whole index, served from the in-process LRU when unchanged.
+
+    The returned list is shared with other requests: treat it as read-only.
+    """
+    version = _index_version(user_id)
+    if version is None:
+        if not _migrate_legacy(user_id):
+            return None
+        version = _index_version(user_id)
+    cached = _cache_get(user_id, version)
+    if cached is not None:
+        return cached
+    rows = _db().execute(
+        f"SELECT {_ITEM_COLUMNS} FROM items WHERE user_id = ? ORDER BY seq", (user_id,)
+    ).fetchall()
+    index = [_row_to_item(r) for r in rows]
+    _cache_put(user_id, version, index)
+    return index
+
+async def aload_index(user_id: str) -> list[dict] | None:
+    """load_index for async callers: a cache miss reads (and parses) every
+    row, so it runs on a worker thread instead of the event loop."""
+    return await asyncio.to_thread(load_index, user_id)
 
 def save_index(user_id: str, index: list[dict]):
-    cache_path(user_id).write_text(json.dumps(index, indent=2))
+    invalidate_cached_index(user_id)
+    conn = _db()
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DELETE FROM items WHERE user_id = ?", (user_id,))
+        conn.executemany(
+            "INSERT OR REPLACE INTO items VALUES (?,?,?,?,?,?,?,?,?,?)",
+            (_item_to_row(user_id, seq, item) for seq, item in enumerate(index)),
+        )
+        conn.execute(
+            "INSERT INTO indexes (user_id, updated_at, item_count) VALUES (?, ?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET updated_at = excluded.updated_at, item_count = excluded.item_count",
+            (user_id, _now(), len(index)),
+        )
+
+def clear_index(user_id: str):
+    invalidate_cached_index(user_id)
+    conn = _db()
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DELETE FROM items WHERE user_id = ?", (user_id,))
+        conn.execute("DELETE FROM indexes WHERE user_id = ?", (user_id,))
+        conn.execute("DELETE FROM crawls WHERE user_id = ?", (user_id,))
 
 def updated_at(user_id: str) -> datetime.datetime | None:
-    """Returns the last modification time of the cache file, or None if it doesn't exist."""
-    p = cache_path(user_id)
+    """Returns when the user's index was last written, or None if it doesn't exist."""
     try:
-        if p.exists():
-            # Get modification time and convert to UTC datetime object
-            mtime = p.stat().st_mtime
-            return datetime.datetime.fromtimestamp(mtime, tz=datetime.timezone.utc)
-    except OSError as e:
-        print(f"Error accessing cache file stats for {user_id}: {e}")
-    return None
\ No newline at end of file
+        row = _db().execute("SELECT updated_at FROM indexes WHERE user_id = ?", (user_id,)).fetchone()
+    except sqlite3.Error as e:
+        logger.error(f"Error reading index timestamp for {user_id}: {e}")
+        return None
+    return datetime.datetime.fromtimestamp(row[0], tz=datetime.timezone.utc) if row else None
+
+def item_count(user_id: str) -> int:
+    row = _db().execute("SELECT item_count FROM indexes WHERE user_id = ?", (user_id,)).fetchone()
+    return row[0] if row else 0
+
+
+# --- Point lookups ---
+def get_item(user_id: str, item_id: str) -> dict | None:
+    row = _db().execute(
+        f"SELECT {_ITEM_COLUMNS} FROM items WHERE user_id = ? AND id = ?", (user_id, item_id)
+    ).fetchone()
+    return _row_to_item(row) if row else None
+
+def find_items_by_name(user_id: str, name: str, case_insensitive: bool = False,
+                       mime_type: str | None = None) -> list[dict]:
+    column, value = ("name_lower", name.lower()) if case_insensitive else ("name", name)
+    sql = f"SELECT {_ITEM_COLUMNS} FROM items WHERE user_id = ? AND {column} = ?"
+    params: list = [user_id, value]
+    if mime_type:
+        sql += " AND mime_type = ?"
+        params.append(mime_type)
+    rows = _db().execute(sql + " ORDER BY seq", params).fetchall()
+    return [_row_to_item(r) for r in rows]
+
+def list_children(user_id: str, parent_id: str) -> list[dict]:
+    rows = _db().execute(
+        f"SELECT {_ITEM_COLUMNS} FROM items WHERE user_id = ? AND parent = ? ORDER BY seq",
+        (user_id, parent_id),
+    ).fetchall()
+    return [_row_to_item(r) for r in rows]
+
+def list_by_mime_type(user_id: str, mime_type: str) -> list[dict]:
+    rows = _db().execute(
+        f"SELECT {_ITEM_COLUMNS} FROM items WHERE user_id = ? AND mime_type = ? ORDER BY seq",
+        (user_id, mime_type),
+    ).fetchall()
+    return [_row_to_item(r) for r in rows]
+
+def query_items(user_id: str, after_seq: int = -1, limit: int = 200, mime_type: str | None = None,
+                parent: str | None = None, modified_since: str | None = None) -> tuple[list[dict], int | None]:
+    """One page of the user's items in index order, starting after `after_seq`.
+
+    `modified_since` is an RFC 3339 UTC timestamp (as Drive writes them).
+    Returns (items, seq to continue after), the latter None on the last page.
+    Items appended later (a crawl in progress) get higher seqs, so paging
+    through a growing index still sees each item once.
+    """
+    sql = f"SELECT seq, {_ITEM_COLUMNS} FROM items WHERE user_id = ? AND seq > ?"
+    params: list = [user_id, after_seq]
+    if mime_type:
+        sql += " AND mime_type = ?"
+        params.append(mime_type)
+    if parent:
+        sql += " AND parent = ?"
+        params.append(parent)
+    if modified_since:
+        sql += " AND modified_time >= ?"
+        params.append(modified_since)
+    rows = _db().execute(sql + " ORDER BY seq LIMIT ?", (*params, limit + 1)).fetchall()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    return [_row_to_item(r[1:]) for r in rows], (rows[-1][0] if more else None)
+
+
+# --- Partial updates ---
+def upsert_items(user_id: str, items: list[dict]):
+    """Inserts or replaces individual items; new items are appended after existing ones."""
+    if not items:
+        return
+    invalidate_cached_index(user_id)
+    conn = _db()
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        next_seq = conn.execute(
+            "SELECT COALESCE(MAX(seq), -1) + 1 FROM items WHERE user_id = ?", (user_id,)
+        ).fetchone()[0]
+        rows = []
+        for item in items:
+            existing = conn.execute(
+                "SELECT seq FROM items WHERE user_id = ? AND id = ?", (user_id, item["id"])
+            ).fetchone()
+            if existing:
+                seq = existing[0]
+            else:
+                seq, next_seq = next_seq, next_seq + 1
+            rows.append(_item_to_row(user_id, seq, item))
+        conn.executemany("INSERT OR REPLACE INTO items VALUES (?,?,?,?,?,?,?,?,?,?)", rows)
+        _touch(conn, user_id)
+
+def delete_items(user_id: str, item_ids: list[str]):
+    if not item_ids:
+        return
+    invalidate_cached_index(user_id)
+    conn = _db()
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany(
+            "DELETE FROM items WHERE user_id = ? AND id = ?", ((user_id, i) for i in item_ids)
+        )
+        _touch(conn, user_id)
+
+
+# --- Incremental sync state (Drive Changes feed) ---
+def load_sync_state(user_id: str) -> dict | None:
+    """Returns {"page_token", "root_id", "synced_at"} for the user's index, or None."""
+    row = _db().execute(
+        "SELECT page_token, root_id, synced_at FROM indexes WHERE user_id = ? AND page_token IS NOT NULL",
+        (user_id,),
+    ).fetchone()
+    if not row:
+        return None
+    return {"page_token": row[0], "root_id": row[1], "synced_at": row[2]}
+
+def save_sync_state(user_id: str, page_token: str, root_id: str):
+    _db().execute(
+        "UPDATE indexes SET page_token = ?, root_id = ?, synced_at = ? WHERE user_id = ?",
+        (page_token, root_id, _now(), user_id),
+    )
+
+
+# --- Resumable crawls ---
+# A user's first crawl writes the items of every fully listed folder into the
+# index as it goes, together with its frontier (folders still to list, as
+# [folder_id, path] pairs), so requests can use the partial index and a crawl
+# interrupted by a restart resumes where it left off. `owner` is the process
+# running it; a crawl whose checkpoint is older than the lease is up for grabs.
+def _crawl_row_to_dict(row: tuple) -> dict:
+    owner, page_token, root_id, frontier, folders_done, items_found, started_at, checkpoint_at = row
+    return {
+        "owner": owner, "page_token": page_token, "root_id": root_id,
+        "frontier": [tuple(f) for f in json.loads(frontier)],
+        "folders_done": folders_done, "items_found": items_found,
+        "started_at": started_at, "checkpoint_at": checkpoint_at,
+    }
+
+_CRAWL_COLUMNS = "owner, page_token, root_id, frontier, folders_done, items_found, started_at, checkpoint_at"
+
+def load_crawl(user_id: str) -> dict | None:
+    row = _db().execute(f"SELECT {_CRAWL_COLUMNS} FROM crawls WHERE user_id = ?", (user_id,)).fetchone()
+    return _crawl_row_to_dict(row) if row else None
+
+def start_crawl(user_id: str, owner: str, page_token: str, root_id: str) -> dict | None:
+    """Registers a new first-time crawl from the Drive root, with an empty
+    index. Returns its state, or None if a crawl for the user already exists."""
+    invalidate_cached_index(user_id)
+    now = _now()
+    conn = _db()
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        inserted = conn.execute(
+            "INSERT OR IGNORE INTO crawls (user_id, owner, page_token, root_id, frontier, started_at, checkpoint_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (user_id, owner, page_token, root_id, json.dumps([["root", ""]]), now, now),
+        ).rowcount
+        if not inserted:
+            return None
+        conn.execute("DELETE FROM items WHERE user_id = ?", (user_id,))
+        conn.execute(
+            "INSERT OR REPLACE INTO indexes (user_id, updated_at, item_count) VALUES (?, ?, 0)", (user_id, now)
+        )
+    return load_crawl(user_id)
+
+def claim_crawl(user_id: str, owner: str, lease_seconds: float) -> dict | None:
+    """Takes over a crawl that is ours or whose owner stopped checkpointing.
+    Returns its state, or None if it is still running elsewhere."""
+    now = _now()
+    claimed = _db().execute(
+        "UPDATE crawls SET owner = ?, checkpoint_at = ? WHERE user_id = ? AND (owner = ? OR checkpoint_at < ?)",
+        (owner, now, user_id, owner, now - lease_seconds),
+    ).rowcount
+    return load_crawl(user_id) if claimed else None
+
+def checkpoint_crawl(user_id: str, owner: str, items: list[dict], frontier: list[tuple[str, str]],
+                     folders_done: int) -> bool:
+    """Appends newly found items to the index and records the frontier, in one
+    transaction. `folders_done` is the number of folders finished since the
+    last checkpoint. Returns False if another process has taken the crawl over."""
+    invalidate_cached_index(user_id)
+    conn = _db()
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute("SELECT owner FROM crawls WHERE user_id = ?", (user_id,)).fetchone()
+        if not row or row[0] != owner:
+            return False
+        next_seq = conn.execute(
+            "SELECT COALESCE(MAX(seq), -1) + 1 FROM items WHERE user_id = ?", (user_id,)
+        ).fetchone()[0]
+        conn.executemany(
+            "INSERT OR REPLACE INTO items VALUES (?,?,?,?,?,?,?,?,?,?)",
+            (_item_to_row(user_id, next_seq + i, item) for i, item in enumerate(items)),
+        )
+        conn.execute(
+            "UPDATE crawls SET frontier = ?, folders_done = folders_done + ?, items_found = items_found + ?, "
+            "checkpoint_at = ? WHERE user_id = ?",
+            (json.dumps(frontier), folders_done, len(items), _now(), user_id),
+        )
+        _touch(conn, user_id)
+    return True
+
+def finish_crawl(user_id: str, owner: str) -> bool:
+    """Marks the index complete: records its change token and drops the crawl."""
+    conn = _db()
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        crawl = conn.execute(
+            "SELECT page_token, root_id FROM crawls WHERE user_id = ? AND owner = ?", (user_id, owner)
+        ).fetchone()
+        if not crawl:
+            return False
+        conn.execute(
+            "UPDATE indexes SET page_token = ?, root_id = ?, synced_at = ? WHERE user_id = ?",
+            (crawl[0], crawl[1], _now(), user_id),
+        )
+        conn.execute("DELETE FROM crawls WHERE user_id = ?", (user_id,))
+    return True
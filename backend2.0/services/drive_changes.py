@@ -0,0 +1,115 @@
+# services/drive_changes.py
+# Applies Drive Changes feed records to a path-annotated Drive index without
+# re-crawling: adds, removals/trashing, renames and moves. Pure functions over
+# the index dicts, so google_service can persist just the delta.
+
+# Fields kept for each index item (plus the computed `path`)
+INDEX_FIELDS = ("id", "name", "mimeType", "parents", "modifiedTime")
+
+
+def apply_drive_changes(index: list[dict], changes: list[dict], root_id: str) -> tuple[list[dict], list[dict], list[str]]:
+    """Applies Drive change records to a path-annotated index.
+
+    Changed items and everything below a changed or removed item get their
+    `path` recomputed in one top-down pass; items that end up outside the
+    crawled tree (no reachable parent) are dropped, matching what a fresh
+    `crawl_drive_tree` would return.
+
+    Returns (new_index, upserted_items, deleted_ids) so callers can persist
+    just the delta.
+    """
+    # Shallow copies: `index` may be the shared, cached list from load_index
+    by_id: dict[str, dict] = {item["id"]: dict(item) for item in index}
+    order = [item["id"] for item in index]
+    changed: set[str] = set()
+    removed: set[str] = set()
+
+    for change in changes:
+        file_id = change.get("fileId")
+        f = change.get("file")
+        if change.get("removed") or not f or f.get("trashed"):
+            if by_id.pop(file_id, None) is not None:
+                removed.add(file_id)
+            changed.discard(file_id)
+            continue
+        if file_id not in by_id:
+            order.append(file_id)
+        by_id[file_id] = {k: f[k] for k in INDEX_FIELDS if k in f}
+        changed.add(file_id)
+        removed.discard(file_id)
+
+    if not changed and not removed:
+        return index, [], []
+
+    children: dict[str, list[str]] = {}
+    for item in by_id.values():
+        parents = item.get("parents") or []
+        if parents:
+            children.setdefault(parents[0], []).append(item["id"])
+
+    # Everything below a changed or removed item may have a new path. Any
+    # other item's ancestors are all unchanged, so its stored path still holds.
+    dirty = set(changed)
+    stack = list(changed | removed)
+    while stack:
+        for child_id in children.get(stack.pop(), []):
+            if child_id not in dirty:
+                dirty.add(child_id)
+                stack.append(child_id)
+
+    old_paths = {item_id: by_id[item_id].get("path") for item_id in dirty}
+    resolved: dict[str, str | None] = {}
+
+    def resolve(item_id: str) -> str | None:
+        # Iterative walk up to the nearest clean ancestor (trees can be deep),
+        # then paths are filled in top-down on the way back
+        chain: list[str] = []
+        on_chain: set[str] = set()
+        path: str | None = None
+        current = item_id
+        while True:
+            if current in resolved:
+                path = resolved[current]
+                break
+            if current in on_chain:
+                path = None  # Parent cycle: never reachable from the root
+                break
+            chain.append(current)
+            on_chain.add(current)
+            parents = by_id[current].get("parents") or []
+            parent_id = parents[0] if parents else None
+            if parent_id is None:
+                path = None
+                break
+            if parent_id == root_id:
+                path = ""
+                break
+            if parent_id in dirty:
+                current = parent_id
+                continue
+            path = by_id[parent_id].get("path") if parent_id in by_id else None
+            break
+        for chain_id in reversed(chain):
+            name = by_id[chain_id].get("name", "(untitled)")
+            if path is not None:
+                path = f"{path}/{name}" if path else name
+            resolved[chain_id] = path
+        return resolved[item_id]
+
+    unreachable = set(removed)
+    upserted_ids: list[str] = []
+    for item_id in dirty:
+        path = resolve(item_id)
+        if path is None:
+            unreachable.add(item_id)
+            continue
+        by_id[item_id]["path"] = path
+        if item_id in changed or path != old_paths[item_id]:
+            upserted_ids.append(item_id)
+
+    for item_id in unreachable:
+        by_id.pop(item_id, None)
+
+    new_index = [by_id[item_id] for item_id in order if item_id in by_id]
+    upserted = [by_id[item_id] for item_id in upserted_ids]
+    return new_index, upserted, list(unreachable)
@@ -0,0 +1,179 @@
+# services/drive_client.py
+# Process-wide factory for Google Drive / Docs API clients.
+#
+# `googleapiclient.discovery.build()` re-reads and re-parses the discovery
+# document and opens a fresh HTTP transport on every call. Here the parsed
+# discovery documents are cached once per process and every thread keeps one
+# keep-alive `httplib2.Http` that all users' requests share; per-user
+# credentials are layered on top with a lightweight `AuthorizedHttp` wrapper.
+#
+# httplib2 connections are not thread-safe, so requests must be executed with
+# `execute()` / `download()` below, which bind them to the *calling* thread's
+# pooled connection rather than the one the service was built on.
+#
+# Async code must use `aexecute()` / `adownload()`: they run the blocking call
+# on a dedicated, size-limited thread pool with a per-call timeout, so a slow
+# export never stalls the event loop (and every other user on the worker).
+
+import asyncio
+import io
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import google_auth_httplib2
+import httplib2
+from google.oauth2.credentials import Credentials
+from googleapiclient import discovery_cache
+from googleapiclient.discovery import V2_DISCOVERY_URI, build_from_document
+from googleapiclient.http import MediaIoBaseDownload
+
+from services import tracing
+
+logger = logging.getLogger(__name__)
+
+HTTP_TIMEOUT = float(os.getenv("GOOGLE_HTTP_TIMEOUT", "60"))
+# Threads dedicated to Google API calls, and the default per-call deadline
+GOOGLE_API_WORKERS = int(os.getenv("GOOGLE_API_WORKERS", "32"))
+GOOGLE_API_CALL_TIMEOUT = float(os.getenv("GOOGLE_API_CALL_TIMEOUT", "120"))
+
+_discovery_docs: dict[tuple[str, str], dict] = {}
+_discovery_lock = threading.Lock()
+_local = threading.local()
+
+
+def _discovery_doc(api: str, version: str) -> dict:
+    key = (api, version)
+    doc = _discovery_docs.get(key)
+    if doc is None:
+        with _discovery_lock:
+            doc = _discovery_docs.get(key)
+            if doc is None:
+                content = discovery_cache.get_static_doc(api, version)
+                if content is None:
+                    # Not bundled with the library: fetch it once over the network
+                    uri = V2_DISCOVERY_URI.format(api=api, apiVersion=version)
+                    resp, content = httplib2.Http(timeout=HTTP_TIMEOUT).request(uri)
+                    if resp.status >= 400:
+                        raise RuntimeError(f"Could not fetch discovery document for {api} {version}: {resp.status}")
+                doc = json.loads(content)
+                _discovery_docs[key] = doc
+    return doc
+
+def pooled_http() -> httplib2.Http:
+    """The calling thread's keep-alive HTTP transport."""
+    http = getattr(_local, "http", None)
+    if http is None:
+        http = httplib2.Http(timeout=HTTP_TIMEOUT)
+        _local.http = http
+    return http
+
+def authorized_http(creds: Credentials) -> google_auth_httplib2.AuthorizedHttp:
+    return google_auth_httplib2.AuthorizedHttp(creds, http=pooled_http())
+
+def get_service(api: str, version: str, creds: Credentials):
+    """Drop-in replacement for `build(api, version, credentials=creds)`."""
+    return build_from_document(_discovery_doc(api, version), http=authorized_http(creds))
+
+def _thread_http(request):
+    creds = getattr(request.http, "credentials", None)
+    return authorized_http(creds) if creds is not None else pooled_http()
+
+def execute(request):
+    """Executes an API request on the calling thread's pooled connection."""
+    return request.execute(http=_thread_http(request))
+
+def download(request) -> bytes:
+    """Runs a media download (`get_media` / `export_media`) to completion."""
+    http = _thread_http(request)
+    fh = io.BytesIO()
+    downloader = MediaIoBaseDownload(fh, request)
+    done = False
+    while done is False:
+        status, done = downloader.next_chunk(http=http)
+        logger.debug(f"Download {int(status.progress() * 100)}%.")
+    return fh.getvalue()
+
+
+# --- Async execution layer ---
+_executor = ThreadPoolExecutor(max_workers=GOOGLE_API_WORKERS, thread_name_prefix="google-api")
+_stats_lock = threading.Lock()
+_stats = {
+    "queued": 0,          # submitted, waiting for a free thread
+    "running": 0,
+    "max_queue_depth": 0,
+    "completed": 0,
+    "failed": 0,
+    "timeouts": 0,
+    "cancelled": 0,
+    "total_wait_seconds": 0.0,
+}
+
+def executor_stats() -> dict:
+    """Queue depth and outcome counters for the Google API thread pool."""
+    with _stats_lock:
+        return {**_stats, "workers": GOOGLE_API_WORKERS}
+
+def _bump(**changes):
+    with _stats_lock:
+        for key, delta in changes.items():
+            _stats[key] += delta
+        _stats["max_queue_depth"] = max(_stats["max_queue_depth"], _stats["queued"])
+
+async def run(fn, *args, timeout: float | None = None):
+    """Runs a blocking Google API call on the dedicated pool.
+
+    Raises asyncio.TimeoutError after `timeout` seconds (default
+    GOOGLE_API_CALL_TIMEOUT). If the awaiting task is cancelled (e.g. the
+    client disconnected) a call that hasn't started yet is dropped from the
+    queue; one that is already running finishes in the background and its
+    result is discarded.
+    """
+    submitted = time.monotonic()
+    state = {"started": False, "abandoned": False}
+
+    def call():
+        with _stats_lock:
+            if state["abandoned"]:
+                return None  # Caller gave up before a thread was free
+            state["started"] = True
+        _bump(queued=-1, running=1, total_wait_seconds=time.monotonic() - submitted)
+        try:
+            return fn(*args)
+        finally:
+            _bump(running=-1)
+
+    def abandon(counter: str):
+        with _stats_lock:
+            if not state["started"]:
+                state["abandoned"] = True
+                _stats["queued"] -= 1
+        _bump(**{counter: 1})
+
+    _bump(queued=1)
+    future = asyncio.get_running_loop().run_in_executor(_executor, call)
+    try:
+        result = await asyncio.wait_for(future, timeout or GOOGLE_API_CALL_TIMEOUT)
+        _bump(completed=1)
+        return result
+    except asyncio.TimeoutError:
+        abandon("timeouts")
+        raise
+    except asyncio.CancelledError:
+        abandon("cancelled")
+        raise
+    except Exception:
+        _bump(failed=1)
+        raise
+
+async def aexecute(request, timeout: float | None = None):
+    # Spans are named by the API method, e.g. "drive.files.list"
+    with tracing.span(getattr(request, "methodId", None) or "google.execute"):
+        return await run(execute, request, timeout=timeout)
+
+async def adownload(request, timeout: float | None = None) -> bytes:
+    with tracing.span("drive.download", method=getattr(request, "methodId", None)):
+        return await run(download, request, timeout=timeout)
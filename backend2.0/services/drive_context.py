@@ -0,0 +1,197 @@
+# services/drive_context.py
+# Picks the Drive items most relevant to a user message for Gemini's
+# context, instead of the first N items in crawl order.
+#
+# Per user (and per index version) an inverted index maps name and path
+# tokens to items. A message is scored against it with IDF-weighted token
+# matches (names count more than folder paths), then nudged by recency and
+# by the kind of item the message mentions. The best items are rendered as
+# Markdown-ready lines until the token budget is spent. Passages found by
+# vector_index, when given, follow as quoted excerpts under their own budget.
+
+import bisect
+import datetime
+import math
+import os
+import threading
+
+from services import drive_cache
+from services.drive_links import get_google_drive_url
+from services.gemini_models import estimate_tokens
+from services.name_index import tokenize
+
+DRIVE_CONTEXT_TOKEN_BUDGET = int(os.getenv("DRIVE_CONTEXT_TOKEN_BUDGET", "1500"))
+DRIVE_PASSAGES_TOKEN_BUDGET = int(os.getenv("DRIVE_PASSAGES_TOKEN_BUDGET", "1500"))
+
+NAME_WEIGHT = 3.0
+PATH_WEIGHT = 1.0
+PREFIX_FACTOR = 0.5       # Partial ("proj" -> "project") matches count half
+RECENCY_WEIGHT = 1.0      # Added for an item modified just now, halving every RECENCY_HALF_LIFE_DAYS
+RECENCY_HALF_LIFE_DAYS = 30.0
+KIND_WEIGHT = 1.5         # Added when the message mentions the item's kind ("folder", "sheet", ...)
+MIN_PREFIX_LEN = 3
+
+FOLDER_MIME = "application/vnd.google-apps.folder"
+KIND_WORDS = {
+    "folder": FOLDER_MIME, "folders": FOLDER_MIME, "directory": FOLDER_MIME,
+    "doc": "application/vnd.google-apps.document", "docs": "application/vnd.google-apps.document",
+    "document": "application/vnd.google-apps.document", "documents": "application/vnd.google-apps.document",
+    "sheet": "application/vnd.google-apps.spreadsheet", "sheets": "application/vnd.google-apps.spreadsheet",
+    "spreadsheet": "application/vnd.google-apps.spreadsheet", "spreadsheets": "application/vnd.google-apps.spreadsheet",
+    "slides": "application/vnd.google-apps.presentation", "presentation": "application/vnd.google-apps.presentation",
+    "deck": "application/vnd.google-apps.presentation",
+    "pdf": "application/pdf", "pdfs": "application/pdf",
+}
+KIND_LABELS = {
+    FOLDER_MIME: "Folder",
+    "application/vnd.google-apps.document": "Doc",
+    "application/vnd.google-apps.spreadsheet": "Sheet",
+    "application/vnd.google-apps.presentation": "Slides",
+    "application/pdf": "PDF",
+}
+STOPWORDS = {
+    "a", "an", "and", "are", "about", "any", "can", "could", "do", "does", "drive", "file", "files", "find",
+    "for", "from", "have", "how", "i", "in", "is", "it", "me", "my", "of", "on", "or", "please", "show",
+    "that", "the", "there", "this", "to", "what", "where", "which", "with", "you",
+}
+
+
+def _age_days(modified_time: str | None, now: datetime.datetime) -> float | None:
+    if not modified_time:
+        return None
+    try:
+        modified = datetime.datetime.fromisoformat(modified_time.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return max((now - modified).total_seconds() / 86400, 0.0)
+
+
+class RelevanceIndex:
+    """Inverted index over item name and path tokens, with IDF weights."""
+
+    def __init__(self, items: list[dict]):
+        self.items = items
+        self.postings: dict[str, dict[int, float]] = {}
+        for pos, item in enumerate(items):
+            name = item.get("name") or ""
+            path = item.get("path") or ""
+            folders = path.rsplit("/", 1)[0] if "/" in path else ""
+            for tok in set(tokenize(folders)):
+                self.postings.setdefault(tok, {})[pos] = PATH_WEIGHT
+            for tok in set(tokenize(name)):
+                self.postings.setdefault(tok, {})[pos] = NAME_WEIGHT
+        n = max(len(items), 1)
+        self.idf = {tok: math.log(1 + n / len(posting)) for tok, posting in self.postings.items()}
+        self.vocabulary = sorted(self.postings)
+
+    def _prefix_tokens(self, prefix: str) -> list[str]:
+        start = bisect.bisect_left(self.vocabulary, prefix)
+        end = bisect.bisect_left(self.vocabulary, prefix + "\uffff")
+        return self.vocabulary[start:end]
+
+    def rank(self, message: str, limit: int = 200) -> list[tuple[float, dict]]:
+        tokens = [t for t in tokenize(message) if t not in STOPWORDS]
+        kinds = {KIND_WORDS[t] for t in tokens if t in KIND_WORDS}
+        tokens = [t for t in tokens if t not in KIND_WORDS]
+
+        scores: dict[int, float] = {}
+        for tok in set(tokens):
+            matched = {tok: 1.0} if tok in self.postings else {}
+            if len(tok) >= MIN_PREFIX_LEN:
+                for other in self._prefix_tokens(tok):
+                    matched.setdefault(other, PREFIX_FACTOR)
+            for other, factor in matched.items():
+                idf = self.idf[other]
+                for pos, weight in self.postings[other].items():
+                    scores[pos] = scores.get(pos, 0.0) + idf * weight * factor
+
+        # With no textual match, the recency/kind boosts alone pick the items
+        candidates = scores.keys() if scores else range(len(self.items))
+        now = datetime.datetime.now(datetime.timezone.utc)
+        ranked = []
+        for pos in candidates:
+            item = self.items[pos]
+            score = scores.get(pos, 0.0)
+            age = _age_days(item.get("modifiedTime"), now)
+            if age is not None:
+                score += RECENCY_WEIGHT * 0.5 ** (age / RECENCY_HALF_LIFE_DAYS)
+            if item.get("mimeType") in kinds:
+                score += KIND_WEIGHT
+            ranked.append((score, item))
+        ranked.sort(key=lambda r: -r[0])
+        return ranked[:limit]
+
+
+# --- Per-user registry (rebuilt when the stored index changes) ---
+_indexes: dict[str, tuple[float, RelevanceIndex]] = {}
+_lock = threading.Lock()
+
+def get_relevance_index(user_id: str) -> RelevanceIndex | None:
+    version = drive_cache.updated_at(user_id)
+    if version is None:
+        return None
+    with _lock:
+        entry = _indexes.get(user_id)
+    if entry and entry[0] == version.timestamp():
+        return entry[1]
+    items = drive_cache.load_index(user_id)
+    if items is None:
+        return None
+    index = RelevanceIndex(items)
+    with _lock:
+        _indexes[user_id] = (version.timestamp(), index)
+    return index
+
+def _format_item(item: dict) -> str:
+    kind = KIND_LABELS.get(item.get("mimeType"), "File")
+    line = f"- {item.get('name')} ({kind}"
+    if item.get("path"):
+        line += f", path: {item['path']}"
+    if item.get("modifiedTime"):
+        line += f", modified: {item['modifiedTime'][:10]}"
+    url = get_google_drive_url(item)
+    if url:
+        line += f", URL: {url}"
+    return line + ")"
+
+def format_passages(passages: list[dict], budget_tokens: int = DRIVE_PASSAGES_TOKEN_BUDGET) -> str:
+    """vector_index passages as quoted excerpts linked to their documents, best first."""
+    blocks = []
+    used = 0
+    for passage in passages:
+        quote = "\n  > ".join(passage["text"].strip().splitlines())
+        block = f"- From [{passage.get('name')}]({get_google_drive_url(passage)}):\n  > {quote}"
+        cost = estimate_tokens(block)
+        if used + cost > budget_tokens:
+            break
+        blocks.append(block)
+        used += cost
+    return "\n".join(blocks)
+
+def build_drive_context(
+    user_id: str,
+    message: str,
+    budget_tokens: int = DRIVE_CONTEXT_TOKEN_BUDGET,
+    passages: list[dict] | None = None,
+) -> str:
+    """Context block of the items most relevant to `message`, within `budget_tokens`,
+    followed by `passages` (see format_passages) when given."""
+    index = get_relevance_index(user_id)
+    if not index or not index.items:
+        return "\nUser's Google Drive Contents: (Could not load or is empty)"
+
+    header = f"\nUser's Google Drive Contents (most relevant of {len(index.items)} items):"
+    lines = [header]
+    used = estimate_tokens(header)
+    for _, item in index.rank(message):
+        line = _format_item(item)
+        cost = estimate_tokens(line)
+        if used + cost > budget_tokens:
+            break
+        lines.append(line)
+        used += cost
+    excerpts = format_passages(passages or [])
+    if excerpts:
+        lines += ["", "Passages from the user's documents that may answer the question:", excerpts]
+    lines.append("---")
+    return "\n".join(lines)
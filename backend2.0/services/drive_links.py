@@ -0,0 +1,24 @@
+# services/drive_links.py
+# Web links to Drive items. No dependencies, so prompt-building code can use
+# it without importing the Google API client stack.
+
+def get_google_drive_url(item: dict) -> str:
+    """Generates the web URL for a Google Drive file or folder."""
+    item_id = item.get("id")
+    mime_type = item.get("mimeType")
+
+    if not item_id:
+        return "" # Cannot generate URL without ID
+
+    if mime_type == "application/vnd.google-apps.folder":
+        return f"https://drive.google.com/drive/folders/{item_id}"
+    elif mime_type == "application/vnd.google-apps.document":
+        return f"https://docs.google.com/document/d/{item_id}/edit"
+    elif mime_type == "application/vnd.google-apps.spreadsheet":
+        return f"https://docs.google.com/spreadsheets/d/{item_id}/edit"
+    elif mime_type == "application/vnd.google-apps.presentation":
+        return f"https://docs.google.com/presentation/d/{item_id}/edit"
+    # Add more specific types if needed (e.g., forms, drawings)
+    else:
+        # Default link for other file types viewable in Drive
+        return f"https://drive.google.com/file/d/{item_id}/view"
@@ -0,0 +1,91 @@
+# services/embeddings.py
+# Pluggable text embedding providers for vector_index.
+#   "gemini" - Gemini's embedding model (default when GEMINI_API_KEY is set)
+#   "local"  - deterministic feature hashing; no network, stable across runs,
+#              used for development and tests
+# Every provider returns L2-normalised float32 vectors, so a dot product is
+# the cosine similarity.
+
+import asyncio
+import hashlib
+import logging
+import os
+
+import google.generativeai as genai
+import numpy as np
+
+from services import gemini_models, tracing
+from services.name_index import tokenize
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_PROVIDER = os.getenv("EMBEDDING_PROVIDER", "").lower()
+GEMINI_EMBEDDING_MODEL = os.getenv("GEMINI_EMBEDDING_MODEL", "models/text-embedding-004")
+GEMINI_EMBEDDING_DIM = int(os.getenv("GEMINI_EMBEDDING_DIM", "768"))
+LOCAL_EMBEDDING_DIM = int(os.getenv("LOCAL_EMBEDDING_DIM", "256"))
+# Texts per embedding request (the Gemini API accepts up to 100)
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "100"))
+
+
+def _normalise(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (vectors / norms).astype(np.float32)
+
+
+class GeminiEmbeddingProvider:
+    def __init__(self, model: str = GEMINI_EMBEDDING_MODEL, dim: int = GEMINI_EMBEDDING_DIM):
+        self.model = model
+        self.dim = dim
+        self.name = f"gemini:{model}:{dim}"
+
+    def _embed_batch(self, texts: list[str], task_type: str) -> list[list[float]]:
+        gemini_models.configure()
+        result = genai.embed_content(model=self.model, content=texts, task_type=task_type)
+        return result["embedding"]
+
+    async def embed(self, texts: list[str], is_query: bool = False) -> np.ndarray:
+        task_type = "retrieval_query" if is_query else "retrieval_document"
+        vectors = []
+        for i in range(0, len(texts), EMBED_BATCH_SIZE):
+            # The client is blocking; keep it off the event loop
+            with tracing.span("gemini.embed"):
+                vectors += await asyncio.to_thread(self._embed_batch, texts[i:i + EMBED_BATCH_SIZE], task_type)
+        return _normalise(np.asarray(vectors, dtype=np.float32).reshape(len(texts), self.dim))
+
+
+class HashingEmbeddingProvider:
+    """Hashes words and word bigrams into signed buckets (the "hashing trick")."""
+
+    def __init__(self, dim: int = LOCAL_EMBEDDING_DIM):
+        self.dim = dim
+        self.name = f"local-hashing:{dim}"
+
+    def _bucket(self, feature: str) -> tuple[int, float]:
+        digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+        value = int.from_bytes(digest, "little")
+        return value % self.dim, 1.0 if value >> 63 else -1.0
+
+    def _embed_one(self, text: str) -> np.ndarray:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        tokens = tokenize(text)
+        for feature in tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]:
+            index, sign = self._bucket(feature)
+            vector[index] += sign
+        return vector
+
+    async def embed(self, texts: list[str], is_query: bool = False) -> np.ndarray:
+        if not texts:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return _normalise(np.stack([self._embed_one(text) for text in texts]))
+
+
+_provider = None
+
+def get_provider():
+    global _provider
+    if _provider is None:
+        choice = EMBEDDING_PROVIDER or ("gemini" if gemini_models.GEMINI_API_KEY else "local")
+        _provider = GeminiEmbeddingProvider() if choice == "gemini" else HashingEmbeddingProvider()
+        logger.info(f"Using embedding provider {_provider.name}.")
+    return _provider
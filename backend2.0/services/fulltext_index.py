@@ -0,0 +1,177 @@
+# services/fulltext_index.py
+# On-disk full-text index over the text of each user's Docs, Slides and
+# text files, so "which doc mentions the Q3 budget" is answered locally in
+# milliseconds instead of by downloading files at query time.
+#
+# Each user gets their own SQLite FTS5 database under drive_cache/fulltext/
+# (so BM25's term statistics are computed over that user's documents only).
+# FTS5 stores positional postings, which gives phrase queries for free.
+# The `docs` table records the modifiedTime each file was indexed at, so the
+# indexer (google_service.index_document_contents) only re-exports files
+# that changed.
+
+import hashlib
+import logging
+import os
+import pathlib
+import re
+import sqlite3
+import threading
+import time
+
+from services import drive_cache
+
+logger = logging.getLogger(__name__)
+
+FULLTEXT_DIR = pathlib.Path(os.getenv("FULLTEXT_DIR", str(drive_cache.CACHE_DIR / "fulltext")))
+FULLTEXT_DIR.mkdir(parents=True, exist_ok=True)
+
+# Longer documents are indexed up to this many characters
+FULLTEXT_MAX_CHARS = int(os.getenv("FULLTEXT_MAX_CHARS", str(1_000_000)))
+
+INDEXABLE_MIME_TYPES = (
+    "application/vnd.google-apps.document",
+    "application/vnd.google-apps.presentation",
+)
+
+# BM25 column weights: a term in the title counts for more than one in the body
+NAME_WEIGHT = 5.0
+BODY_WEIGHT = 1.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS docs (
+    id            INTEGER PRIMARY KEY,
+    file_id       TEXT NOT NULL UNIQUE,
+    name          TEXT,
+    mime_type     TEXT,
+    modified_time TEXT,
+    indexed_at    REAL NOT NULL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS doc_text USING fts5(
+    name, body, tokenize = 'unicode61 remove_diacritics 2'
+);
+"""
+
+_local = threading.local()
+_QUOTED_RE = re.compile(r'"([^"]+)"')
+_WORD_RE = re.compile(r"[^\W_]+", re.UNICODE)
+STOPWORDS = {
+    "a", "about", "all", "an", "and", "any", "are", "contain", "contains", "doc", "docs", "document",
+    "documents", "does", "file", "files", "find", "for", "have", "has", "in", "is", "it", "me", "mention",
+    "mentions", "my", "of", "on", "or", "say", "says", "talk", "talks", "the", "to", "what", "where",
+    "which", "with",
+}
+
+
+def is_indexable(mime_type: str | None) -> bool:
+    return bool(mime_type) and (mime_type in INDEXABLE_MIME_TYPES or mime_type.startswith("text/"))
+
+def _db_path(user_id: str) -> pathlib.Path:
+    return FULLTEXT_DIR / f"{hashlib.sha1(user_id.encode()).hexdigest()[:16]}.db"
+
+def _db(user_id: str) -> sqlite3.Connection:
+    """One connection per (thread, user)."""
+    conns = getattr(_local, "conns", None)
+    if conns is None:
+        conns = _local.conns = {}
+    conn = conns.get(user_id)
+    if conn is None:
+        conn = sqlite3.connect(_db_path(user_id), timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(_SCHEMA)
+        conns[user_id] = conn
+    return conn
+
+def indexed_versions(user_id: str) -> dict[str, str | None]:
+    """file_id -> modifiedTime of every indexed document."""
+    return dict(_db(user_id).execute("SELECT file_id, modified_time FROM docs"))
+
+def stale_items(user_id: str, items: list[dict]) -> tuple[list[dict], list[str]]:
+    """(items to (re)index, file ids to drop) for the user's current Drive index."""
+    indexed = indexed_versions(user_id)
+    current = {item["id"]: item for item in items if is_indexable(item.get("mimeType"))}
+    to_index = [item for file_id, item in current.items() if indexed.get(file_id, "") != item.get("modifiedTime")]
+    to_drop = [file_id for file_id in indexed if file_id not in current]
+    return to_index, to_drop
+
+def add_document(user_id: str, item: dict, text: str):
+    conn = _db(user_id)
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute("SELECT id FROM docs WHERE file_id = ?", (item["id"],)).fetchone()
+        if row:
+            conn.execute("DELETE FROM doc_text WHERE rowid = ?", (row[0],))
+            conn.execute(
+                "UPDATE docs SET name = ?, mime_type = ?, modified_time = ?, indexed_at = ? WHERE id = ?",
+                (item.get("name"), item.get("mimeType"), item.get("modifiedTime"), time.time(), row[0]),
+            )
+            rowid = row[0]
+        else:
+            rowid = conn.execute(
+                "INSERT INTO docs (file_id, name, mime_type, modified_time, indexed_at) VALUES (?, ?, ?, ?, ?)",
+                (item["id"], item.get("name"), item.get("mimeType"), item.get("modifiedTime"), time.time()),
+            ).lastrowid
+        conn.execute(
+            "INSERT INTO doc_text (rowid, name, body) VALUES (?, ?, ?)",
+            (rowid, item.get("name") or "", text[:FULLTEXT_MAX_CHARS]),
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def remove_documents(user_id: str, file_ids: list[str]):
+    if not file_ids:
+        return
+    conn = _db(user_id)
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for file_id in file_ids:
+            row = conn.execute("SELECT id FROM docs WHERE file_id = ?", (file_id,)).fetchone()
+            if row:
+                conn.execute("DELETE FROM doc_text WHERE rowid = ?", (row[0],))
+                conn.execute("DELETE FROM docs WHERE id = ?", (row[0],))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def document_count(user_id: str) -> int:
+    return _db(user_id).execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+def build_match_query(query: str) -> str | None:
+    """FTS5 MATCH expression: "quoted phrases" stay phrases, other words are OR-ed."""
+    terms = [f'"{" ".join(_WORD_RE.findall(phrase))}"' for phrase in _QUOTED_RE.findall(query)]
+    rest = _QUOTED_RE.sub(" ", query)
+    words = [w for w in _WORD_RE.findall(rest.casefold()) if w not in STOPWORDS]
+    terms += [f'"{w}"' for w in dict.fromkeys(words)]
+    terms = [t for t in terms if t != '""']
+    return " OR ".join(terms) if terms else None
+
+def search_documents(user_id: str, query: str, limit: int = 5) -> list[dict]:
+    """Best BM25 matches for `query`, each with a highlighted snippet."""
+    match = build_match_query(query)
+    if not match:
+        return []
+    try:
+        rows = _db(user_id).execute(
+            f"""
+            SELECT d.file_id, d.name, d.mime_type, d.modified_time,
+                   bm25(doc_text, {NAME_WEIGHT}, {BODY_WEIGHT}) AS score,
+                   snippet(doc_text, 1, '**', '**', '…', 16)
+            FROM doc_text JOIN docs d ON d.id = doc_text.rowid
+            WHERE doc_text MATCH ?
+            ORDER BY score
+            LIMIT ?
+            """,
+            (match, limit),
+        ).fetchall()
+    except sqlite3.OperationalError as e:
+        logger.error(f"Full-text search failed for query {match!r}: {e}")
+        return []
+    return [
+        {"id": file_id, "name": name, "mimeType": mime_type, "modifiedTime": modified_time,
+         "score": -score, "snippet": snippet}
+        for file_id, name, mime_type, modified_time, score, snippet in rows
+    ]
@@ -0,0 +1,118 @@
+# services/gemini_cache.py
+# Response cache in front of Gemini calls.
+# Keys are (model, system instruction, prompt, version), where `version` is
+# whatever else the answer depends on: a document's (file_id, modifiedTime),
+# a fingerprint of the chat history, etc. Short prompts (the user's own
+# message) are keyed case- and whitespace-insensitively; prompts embedding
+# document text are keyed exactly (normalize=False), since a change of case
+# or spacing in the document is a change to the document.
+# Entries expire after a TTL and the cache is a size-bounded LRU.
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable
+
+from services import tracing
+
+GEMINI_CACHE_TTL = float(os.getenv("GEMINI_CACHE_TTL", "3600"))
+GEMINI_CACHE_MAX_ENTRIES = int(os.getenv("GEMINI_CACHE_MAX_ENTRIES", "2000"))
+
+_entries: "OrderedDict[str, tuple[float, str]]" = OrderedDict()
+_lock = threading.Lock()
+_counters = {"hits": 0, "misses": 0, "bypassed": 0, "expired": 0, "evictions": 0}
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Whitespace- and case-insensitive form of a prompt, used only for keying."""
+    return " ".join(prompt.split()).casefold()
+
+def make_key(model_name: str, system_instruction: str | None, prompt: str, version: str | None = None,
+             normalize: bool = True) -> str:
+    h = hashlib.sha256()
+    for part in (model_name, system_instruction or "", normalize_prompt(prompt) if normalize else prompt, version or ""):
+        h.update(part.encode("utf-8"))
+        h.update(b"\x00")
+    return h.hexdigest()
+
+def content_parts(entry) -> tuple[str, list[str]]:
+    if isinstance(entry, dict):
+        parts = entry.get("parts", [])
+        return entry.get("role", ""), [p if isinstance(p, str) else p.get("text", "") for p in parts]
+    return entry.role, [getattr(p, "text", "") for p in entry.parts]
+
+def history_fingerprint(history: list | None) -> str:
+    """Stable digest of a chat history (Content objects or dicts)."""
+    h = hashlib.sha256()
+    for entry in history or []:
+        role, parts = content_parts(entry)
+        h.update(role.encode("utf-8"))
+        for text in parts:
+            h.update(b"\x00")
+            h.update(text.encode("utf-8"))
+        h.update(b"\x01")
+    return h.hexdigest()
+
+def append_turn(history: list | None, prompt: str, response_text: str) -> list:
+    """History as a chat session would have it after answering `prompt` with `response_text`."""
+    return list(history or []) + [
+        {"role": "user", "parts": [prompt]},
+        {"role": "model", "parts": [response_text]},
+    ]
+
+def get(key: str) -> str | None:
+    with _lock:
+        entry = _entries.get(key)
+        if entry is None:
+            _counters["misses"] += 1
+            return None
+        stored_at, text = entry
+        if time.monotonic() - stored_at > GEMINI_CACHE_TTL:
+            del _entries[key]
+            _counters["expired"] += 1
+            _counters["misses"] += 1
+            return None
+        _entries.move_to_end(key)
+        _counters["hits"] += 1
+        return text
+
+def put(key: str, text: str):
+    with _lock:
+        _entries[key] = (time.monotonic(), text)
+        _entries.move_to_end(key)
+        while len(_entries) > GEMINI_CACHE_MAX_ENTRIES:
+            _entries.popitem(last=False)
+            _counters["evictions"] += 1
+
+async def cached_call(
+    model_name: str,
+    system_instruction: str | None,
+    prompt: str,
+    call: Callable[[], Awaitable[str]],
+    version: str | None = None,
+    use_cache: bool = True,
+    normalize: bool = True,
+) -> tuple[str, bool]:
+    """Returns (text, was_cached). With use_cache=False the model is always
+    called, and the fresh answer replaces the cached one. Pass
+    normalize=False when the prompt embeds document text. Exceptions from
+    `call` propagate and nothing is stored."""
+    key = make_key(model_name, system_instruction, prompt, version, normalize)
+    if use_cache:
+        cached = get(key)
+        if cached is not None:
+            return cached, True
+    else:
+        with _lock:
+            _counters["bypassed"] += 1
+    with tracing.span("gemini.generate", model=model_name):
+        text = await call()
+    put(key, text)
+    return text, False
+
+def gemini_cache_stats() -> dict:
+    with _lock:
+        return {**_counters, "entries": len(_entries), "max_entries": GEMINI_CACHE_MAX_ENTRIES,
+                "ttl_seconds": GEMINI_CACHE_TTL}
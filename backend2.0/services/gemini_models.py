@@ -0,0 +1,90 @@
+# services/gemini_models.py
+# Process-wide registry of configured Gemini models.
+#
+# `genai.configure()` throws away the library's default clients (and their
+# gRPC channels), so calling it on every request also threw away the
+# connection pool. Here it runs once per process, and each
+# (model, system_instruction, generation_config) combination is built once
+# and shared; all models use the library's default sync/async clients.
+
+import json
+import logging
+import os
+import threading
+
+import google.generativeai as genai
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+GEMINI_MODEL_NAME = "models/gemini-2.0-flash"
+# Rough token estimate used for budgets, without a count_tokens round trip
+CHARS_PER_TOKEN = 4
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+_models: dict[tuple[str, str, str], genai.GenerativeModel] = {}
+_lock = threading.Lock()
+_configured = False
+
+
+def configure() -> bool:
+    """Configures the API key once. Returns False when no key is set."""
+    global _configured
+    if _configured:
+        return True
+    if not GEMINI_API_KEY:
+        return False
+    with _lock:
+        if not _configured:
+            genai.configure(api_key=GEMINI_API_KEY)
+            _configured = True
+    return True
+
+def _config_key(generation_config: dict | None) -> str:
+    return json.dumps(generation_config, sort_keys=True) if generation_config else ""
+
+def get_model(
+    model_name: str = GEMINI_MODEL_NAME,
+    system_instruction: str | None = None,
+    generation_config: dict | None = None,
+) -> genai.GenerativeModel:
+    """The shared model for this combination, built on first use."""
+    key = (model_name, system_instruction or "", _config_key(generation_config))
+    model = _models.get(key)
+    if model is None:
+        configure()
+        with _lock:
+            model = _models.get(key)
+            if model is None:
+                model = genai.GenerativeModel(
+                    model_name,
+                    system_instruction=system_instruction,
+                    generation_config=generation_config,
+                )
+                _models[key] = model
+    return model
+
+def warm_up(specs: list[tuple[str, str | None]]):
+    """Builds the given (model_name, system_instruction) models and opens the
+    default clients, so the first chat turn doesn't pay for the setup."""
+    if not configure():
+        logger.warning("GEMINI_API_KEY not set; skipping Gemini warm-up.")
+        return
+    for model_name, system_instruction in specs:
+        get_model(model_name, system_instruction)
+    try:
+        from google.generativeai import client
+        client.get_default_generative_client()
+        client.get_default_generative_async_client()
+    except Exception as e:
+        logger.error(f"Gemini client warm-up failed (will retry lazily): {e}")
+    logger.info(f"Warmed up {len(_models)} Gemini model(s).")
+
+def model_registry_stats() -> dict:
+    with _lock:
+        return {"configured": _configured, "models": len(_models)}
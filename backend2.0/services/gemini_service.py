@@ -1,12 +1,27 @@
-import os
 import json
-import google.generativeai as genai
+import logging
+from typing import Awaitable, Callable
 from dotenv import load_dotenv
 
+from services import chat_history as history_manager, gemini_cache, gemini_models, intent_service
+from services.gemini_models import GEMINI_API_KEY, GEMINI_MODEL_NAME
+
+logger = logging.getLogger(__name__)
+
 load_dotenv()
 
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-GEMINI_MODEL_NAME = "models/gemini-2.0-flash"  # Use 2.0 flash for potentially better instruction following
+# Callback receiving each text chunk as Gemini streams it
+TokenCallback = Callable[[str], Awaitable[None]]
+
+async def collect_stream(response, on_token: TokenCallback) -> str:
+    """Forwards every chunk of a streamed Gemini response to `on_token`; returns the full text."""
+    parts = []
+    async for chunk in response:
+        text = chunk.text
+        if text:
+            parts.append(text)
+            await on_token(text)
+    return "".join(parts)
 
 # --- Updated System Prompt ---
 SYSTEM_PROMPT = """You are an instruction parser for a Google Drive Assistant. Your goal is to understand if the user wants to 'createDoc' or 'analyze' something in their Drive.
@@ -58,97 +73,135 @@ You are a helpful AI assistant integrated with Google Drive. Your primary functi
 *   **Brevity:** Be concise in your responses. Try to keep your responses under 300 words.
 """
 
-async def parse_user_message(user_message: str) -> dict:
-    """Parses the user's message to determine the desired action and parameters."""
+async def parse_user_message(user_message: str, user_id: str | None = None) -> dict:
+    """Parses the user's message to determine the desired action and parameters.
+
+    Common phrasings are resolved locally (see intent_service); Gemini is only
+    asked when the local classifier isn't confident.
+    """
+    local = intent_service.classify(user_message, user_id)
+    if local:
+        return local
+
     if not GEMINI_API_KEY:
-        print("Error: Gemini API Key not configured.")
+        logger.error("Gemini API Key not configured.")
         return {"error": "Gemini service not configured."}
     
-    genai.configure(api_key=GEMINI_API_KEY)
-    
     try:
-        print(f"Parsing user message with Gemini ({GEMINI_MODEL_NAME})...")
-        model = genai.GenerativeModel(
-            GEMINI_MODEL_NAME,
-            system_instruction=SYSTEM_PROMPT,
-        )
-
-        response = await model.generate_content_async(user_message)
-        
-        # Attempt to parse the JSON response
-        raw_response = response.text
-        
-        # Clean potential markdown ```json ... ``` artifacts
-        if raw_response.strip().startswith("```json"):
-            raw_response = raw_response.strip()[7:-3].strip()
-        elif raw_response.strip().startswith("```"):
-             raw_response = raw_response.strip()[3:-3].strip()
+        logger.debug(f"Parsing user message with Gemini ({GEMINI_MODEL_NAME})...")
+        model = gemini_models.get_model(GEMINI_MODEL_NAME, SYSTEM_PROMPT)
+
+        async def call() -> str:
+            response = await model.generate_content_async(user_message)
+            raw = response.text.strip()
+            # Clean potential markdown ```json ... ``` artifacts
+            if raw.startswith("```json"):
+                raw = raw[7:-3].strip()
+            elif raw.startswith("```"):
+                raw = raw[3:-3].strip()
+            json.loads(raw)  # Raise before caching if it isn't valid JSON
+            return raw
+
+        raw_response, cached = await gemini_cache.cached_call(GEMINI_MODEL_NAME, SYSTEM_PROMPT, user_message, call)
 
         parsed_json = json.loads(raw_response)
-        print(f"Parsed action: {parsed_json}")
+        logger.debug(f"Parsed action{' (cached)' if cached else ''}: {parsed_json}")
         return parsed_json
 
     except json.JSONDecodeError as e:
-        print(f"Error decoding Gemini JSON response: {e}\nRaw response was: {response.text}")
-        return {"error": "Failed to parse Gemini response", "details": response.text}
+        logger.error(f"Error decoding Gemini JSON response: {e}\nRaw response was: {e.doc}")
+        return {"error": "Failed to parse Gemini response", "details": e.doc}
     except Exception as e:
-        print(f"Gemini parsing error: {e}")
+        logger.error(f"Gemini parsing error: {e}")
         return {"error": "Failed to parse"}
 
-async def generate_doc_preview(file_name: str) -> str:
+PREVIEW_SYSTEM_PROMPT = "You are a content creator that generates an informative preview for a Google Doc based on its title. Do NOT include multiple options, explanations, or introductory lines. Only output the preview text directly."
+
+async def generate_doc_preview(file_name: str, on_token: TokenCallback | None = None, use_cache: bool = True) -> str:
+    """Pass use_cache=False to force a fresh preview (e.g. when the user asks to regenerate)."""
     try:
         prompt = f"Generate an informative preview for a Google Doc titled '{file_name}'. The preview should hint at the content of the document but DO NOT include introductory phrases like 'Here's a preview' or offer multiple options."
 
-        model = genai.GenerativeModel(
-            GEMINI_MODEL_NAME,
-            system_instruction="You are a content creator that generates an informative preview for a Google Doc based on its title. Do NOT include multiple options, explanations, or introductory lines. Only output the preview text directly."
+        model = gemini_models.get_model(GEMINI_MODEL_NAME, PREVIEW_SYSTEM_PROMPT)
+
+        async def call() -> str:
+            if on_token:
+                response = await model.generate_content_async(prompt, stream=True)
+                return (await collect_stream(response, on_token)).strip()
+            response = await model.generate_content_async(prompt)
+            return response.text.strip()
+
+        preview, cached = await gemini_cache.cached_call(
+            GEMINI_MODEL_NAME, PREVIEW_SYSTEM_PROMPT, prompt, call, use_cache=use_cache
         )
-        response = await model.generate_content_async(prompt)
-        return response.text.strip()
+        if cached and on_token:
+            await on_token(preview)
+        return preview
     except Exception as e:
-        print(f"Gemini preview error: {e}")
+        logger.error(f"Gemini preview error: {e}")
         return "Failed to generate preview."
     
 async def generate_gemini_response(
     prompt: str, 
     drive_context: str | None = None,
-    chat_history: list | None = None
+    chat_history: list | None = None,
+    on_token: TokenCallback | None = None
 ) -> tuple[str, list]: 
     """Generates a response from Gemini, potentially using Drive context and chat history."""
     if not GEMINI_API_KEY:
-        print("Error: Gemini API Key not configured.")
+        logger.error("Gemini API Key not configured.")
         return "⚠️ Gemini service not configured.", chat_history or []
  
-    genai.configure(api_key=GEMINI_API_KEY)
- 
     try:
         full_prompt = prompt
         if drive_context:
             # Prepend the drive context to the user's actual prompt
             full_prompt = f"{drive_context}\n\nUser Question: {prompt}"
-            print(f"[Debug] Using Drive context for Gemini generation.")
+            logger.debug(f"Using Drive context for Gemini generation.")
         else:
-            print(f"[Debug] No Drive context provided for Gemini generation.")
+            logger.debug(f"No Drive context provided for Gemini generation.")
 
-        # Enhance prompt for document creation
-        full_prompt = f"Generate detailed content for a Google Doc based on this request: {prompt}"
-        model = genai.GenerativeModel(
-            GEMINI_MODEL_NAME,
-            system_instruction=RESPONSE_SYSTEM_PROMPT # <-- Use the response prompt
-        )
+        model = gemini_models.get_model(GEMINI_MODEL_NAME, RESPONSE_SYSTEM_PROMPT)
         
         # Start chat session with existing history
         chat = model.start_chat(history=chat_history or [])
-        
-        # Send the new message (including context)
-        response = await chat.send_message_async(full_prompt)
-        
-        # Return response text and the updated history from the chat object
-        return response.text.strip(), chat.history
+
+        async def call() -> str:
+            # Send the new message (including context)
+            if on_token:
+                response = await chat.send_message_async(full_prompt, stream=True)
+                return (await collect_stream(response, on_token)).strip()
+            response = await chat.send_message_async(full_prompt)
+            return response.text.strip()
+
+        # The answer depends on the conversation so far and the Drive context;
+        # only the user's own message is keyed loosely, the context exactly
+        version = gemini_cache.history_fingerprint(chat_history) + gemini_cache.make_key("", None, drive_context or "", normalize=False)
+        response_text, cached = await gemini_cache.cached_call(
+            GEMINI_MODEL_NAME, RESPONSE_SYSTEM_PROMPT, prompt, call, version=version
+        )
+        if cached:
+            if on_token:
+                await on_token(response_text)
+            history = gemini_cache.append_turn(chat_history, full_prompt, response_text)
+        else:
+            history = chat.history  # The updated history from the chat object
+
+        # The Drive listing is rebuilt for every turn; don't keep old copies in history
+        return response_text, history_manager.strip_document(history, drive_context, "[Drive listing omitted from history]")
     except Exception as e:
-        print(f"Error generating Gemini response: {e}")
+        logger.error(f"Error generating Gemini response: {e}")
         return "⚠️ Gemini failed to generate a response.", chat_history or [] # Return original history on error
 
+def warm_up_models():
+    """Builds every model this module uses; called once at app startup."""
+    gemini_models.warm_up([
+        (GEMINI_MODEL_NAME, SYSTEM_PROMPT),
+        (GEMINI_MODEL_NAME, PREVIEW_SYSTEM_PROMPT),
+        (GEMINI_MODEL_NAME, RESPONSE_SYSTEM_PROMPT),
+        (GEMINI_MODEL_NAME, None),  # analyze_content
+    ])
+
 # Example usage (for testing):
 # if __name__ == "__main__":
 #     import asyncio
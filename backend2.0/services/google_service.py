@@ -1,13 +1,17 @@
-from services import drive_cache
+from services import (
+    content_cache, doc_diff, drive_cache, drive_client, fulltext_index, job_queue, name_index, tracing, vector_index,
+)
+from services.drive_changes import apply_drive_changes
+from services.drive_links import get_google_drive_url
+import logging
 import os
 from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
-from googleapiclient.http import MediaIoBaseDownload
-import io
 import asyncio
 import datetime
 import re
+import time
+from typing import Callable
 
 # --- LangChain Imports ---
 from langchain_core.prompts import ChatPromptTemplate
@@ -17,18 +21,27 @@ from langchain_core.output_parsers import StrOutputParser
 from langchain_google_doc.llms import gemini_llm # Correct variable name
 from langchain_google_doc.prompts import content_generation_template
 
-async def find_doc_id_by_name(doc_name: str, creds: Credentials) -> str | None:
+logger = logging.getLogger(__name__)
+
+async def find_doc_id_by_name(doc_name: str, creds: Credentials, user_id: str | None = None) -> str | None:
     """
     Finds the Google Doc ID by its name (case-insensitive).
+    Uses the user's name index when it is fresh; lists Docs over the API otherwise.
     """
-    service = build('drive', 'v3', credentials=creds)
+    if user_id and not is_index_stale(user_id):
+        for score, item in name_index.search_names(user_id, doc_name, limit=1, mime_type=DOC_MIME):
+            if score >= name_index.SCORE_CASEFOLD:
+                return item["id"]
+        return None
+
+    service = drive_client.get_service("drive", "v3", creds)
     try:
-        results = service.files().list(
+        results = await drive_client.aexecute(service.files().list(
             q=f"mimeType='application/vnd.google-apps.document' and trashed=false",
             spaces='drive',
             fields='files(id, name)',
             pageSize=1000
-        ).execute()
+        ))
 
         items = results.get('files', [])
         for item in items:
@@ -37,7 +50,7 @@ async def find_doc_id_by_name(doc_name: str, creds: Credentials) -> str | None:
         
         return None  # Not found
     except Exception as e:
-        print(f"Error finding doc ID by name: {e}")
+        logger.error(f"Error finding doc ID by name: {e}")
         return None
 
 
@@ -57,15 +70,15 @@ def sanitize_content(text: str) -> str:
 
 async def list_all_drive_items(creds: Credentials) -> list[dict]:
     """Return every file & folder’s id, name, mimeType, parents, modifiedTime."""
-    service = build("drive", "v3", credentials=creds)
+    service = drive_client.get_service("drive", "v3", creds)
     items, page_token = [], None
     while True:
-        resp = service.files().list(
+        resp = await drive_client.aexecute(service.files().list(
             q="trashed=false",
             fields="nextPageToken, files(id,name,mimeType,parents,modifiedTime)",
             pageSize=1000,
             pageToken=page_token,
-        ).execute()
+        ))
         items.extend(resp.get("files", []))
         page_token = resp.get("nextPageToken")
         if not page_token:
@@ -107,87 +120,154 @@ async def list_all_drive_items(creds: Credentials) -> list[dict]:
         item["path"] = compute_path(item["id"])
 
     return items
-from .drive_cache import load_index, save_index
+from .drive_cache import aload_index, save_index
 
 # --- Google Drive Folder MIME ---
 FOLDER_MIME = "application/vnd.google-apps.folder"
-
-# --- Drive Item URL Generation ---
-
-def get_google_drive_url(item: dict) -> str:
-    """Generates the web URL for a Google Drive file or folder."""
-    item_id = item.get("id")
-    mime_type = item.get("mimeType")
-
-    if not item_id:
-        return "" # Cannot generate URL without ID
-
-    if mime_type == "application/vnd.google-apps.folder":
-        return f"https://drive.google.com/drive/folders/{item_id}"
-    elif mime_type == "application/vnd.google-apps.document":
-        return f"https://docs.google.com/document/d/{item_id}/edit"
-    elif mime_type == "application/vnd.google-apps.spreadsheet":
-        return f"https://docs.google.com/spreadsheets/d/{item_id}/edit"
-    elif mime_type == "application/vnd.google-apps.presentation":
-        return f"https://docs.google.com/presentation/d/{item_id}/edit"
-    # Add more specific types if needed (e.g., forms, drawings)
-    else:
-        # Default link for other file types viewable in Drive
-        return f"https://drive.google.com/file/d/{item_id}/view"
+DOC_MIME = "application/vnd.google-apps.document"
+
+# An index not synced for this long may be missing recent files, so name
+# lookups that miss it are double-checked against the Drive API.
+DRIVE_INDEX_STALE_AFTER = float(os.getenv("DRIVE_INDEX_STALE_AFTER", "600"))
+
+# Lowest name-index score accepted as "the item the user meant": an exact or
+# case-insensitive match. Token/prefix/fuzzy matches may be a different file,
+# so they are only offered back as suggestions (see similar_item_names).
+NAME_MATCH_MIN_SCORE = name_index.SCORE_CASEFOLD
+# Weakest match still worth suggesting
+NAME_SUGGEST_MIN_SCORE = name_index.SCORE_FUZZY
+
+def is_index_stale(user_id: str) -> bool:
+    sync_state = drive_cache.load_sync_state(user_id)
+    if not sync_state or not sync_state.get("synced_at"):
+        return True
+    age = datetime.datetime.now(datetime.timezone.utc).timestamp() - sync_state["synced_at"]
+    return age > DRIVE_INDEX_STALE_AFTER
 
 # --- Find Item by Name (using cache) ---
-def find_item_by_name(item_name: str, user_id: str, creds: Credentials) -> dict | None:
-    """Searches the cached drive index, then falls back to Google Drive API search."""
-    drive_index = load_index(user_id)
-    if drive_index:
-        for item in drive_index:
-            if item.get('name') == item_name:
-                print(f"Found item '{item_name}' in cache (ID: {item.get('id')})")
-                return item # Return the first cache match
+async def find_item_by_name(item_name: str, user_id: str, creds: Credentials, mime_type: str | None = None) -> dict | None:
+    """Finds the item with exactly this name (case-insensitive) in the user's
+    name index, then falls back to Google Drive API search only if the index
+    is stale. Near matches are not returned; see similar_item_names."""
+    if drive_cache.has_index(user_id):
+        candidates = name_index.search_names(user_id, item_name, limit=1, mime_type=mime_type)
+        if candidates and candidates[0][0] >= NAME_MATCH_MIN_SCORE:
+            score, item = candidates[0]
+            logger.debug(f"Found item '{item_name}' in cache as '{item.get('name')}' (ID: {item.get('id')}, score {score:.2f})")
+            return dict(item) # Copy: the index entry is shared
+        if not is_index_stale(user_id):
+            logger.info(f"Item '{item_name}' not found in up-to-date index for user {user_id}.")
+            return None
     else:
-        print(f"Warning: Drive index cache not found or empty for user {user_id}. Proceeding with API search.")
+        logger.warning(f"Drive index cache not found or empty for user {user_id}. Proceeding with API search.")
 
     # --- Fallback to API Search ---
-    print(f"Item '{item_name}' not found in cache for user {user_id}. Searching via Drive API...")
+    logger.info(f"Item '{item_name}' not found in cache for user {user_id}. Searching via Drive API...")
     try:
-        service = build('drive', 'v3', credentials=creds)
+        service = drive_client.get_service("drive", "v3", creds)
         # Search for files/folders with the exact name, not trashed
         # Escape single quotes in the item name itself to avoid breaking the query
         escaped_item_name = item_name.replace("'", "\\'")
         query = f"name = '{escaped_item_name}' and trashed = false"
+        if mime_type:
+            query += f" and mimeType = '{mime_type}'"
        
-        results = service.files().list(
+        results = await drive_client.aexecute(service.files().list(
             q=query,
             spaces='drive',
             fields='files(id, name, mimeType, parents, modifiedTime)',
             pageSize=10 # Limit results slightly, usually expect 0 or 1
-        ).execute()
+        ))
        
         items = results.get('files', [])
        
         if items:
             # TODO: Handle multiple matches? For now, return the first.
             first_item = items[0]
-            print(f"Found item '{item_name}' via API (ID: {first_item.get('id')})")
+            logger.debug(f"Found item '{item_name}' via API (ID: {first_item.get('id')})")
             # Add a 'path' key like the cache for consistency, though it might be None/incomplete
             first_item['path'] = first_item.get('name') 
             return first_item
         else:
-            print(f"Item '{item_name}' not found via API either.")
+            logger.info(f"Item '{item_name}' not found via API either.")
             return None
            
     except HttpError as error:
-        print(f"An API error occurred during find_item_by_name: {error}")
+        logger.error(f"An API error occurred during find_item_by_name: {error}")
         return None
     except Exception as e:
-        print(f"An unexpected error occurred during API search in find_item_by_name: {e}")
+        logger.error(f"An unexpected error occurred during API search in find_item_by_name: {e}")
         return None
 
+def similar_item_names(user_id: str, item_name: str, mime_type: str | None = None, limit: int = 3) -> list[str]:
+    """Names of items that nearly match `item_name`, for asking the user which one they meant."""
+    if not drive_cache.has_index(user_id):
+        return []
+    names: list[str] = []
+    for score, item in name_index.search_names(user_id, item_name, limit=limit, mime_type=mime_type):
+        name = item.get("name")
+        if score >= NAME_SUGGEST_MIN_SCORE and name and name not in names:
+            names.append(name)
+    return names
+
 # ------------------------------------------------------------
-# Breadth-First Crawl to Build Complete Drive Index WITH Paths
+# Concurrent Crawl to Build Complete Drive Index WITH Paths
 # ------------------------------------------------------------
-async def crawl_drive_tree(creds: Credentials) -> list[dict]:
-    """Breadth-first traversal of *all* non-trashed files & folders.
+# How many folders are listed at once, and how many `files.list` calls per
+# second a single user's crawl may issue (Drive's per-user quota is shared
+# with every other request we make on their behalf).
+CRAWL_MAX_CONCURRENCY = int(os.getenv("DRIVE_CRAWL_CONCURRENCY", "8"))
+CRAWL_REQUESTS_PER_SECOND = float(os.getenv("DRIVE_CRAWL_RPS", "20"))
+# A first-time crawl saves its progress this often, so requests can use the
+# partial index and a restarted worker can resume it; a crawl not checkpointed
+# for CRAWL_LEASE_SECONDS is taken to be abandoned and is resumed.
+CRAWL_CHECKPOINT_SECONDS = float(os.getenv("DRIVE_CRAWL_CHECKPOINT_SECONDS", "5"))
+CRAWL_LEASE_SECONDS = float(os.getenv("DRIVE_CRAWL_LEASE_SECONDS", "120"))
+
+
+class RateLimiter:
+    """Async token bucket: allows `rate` acquisitions per second, bursting up to `burst`."""
+
+    def __init__(self, rate: float, burst: int | None = None):
+        self.rate = rate
+        self.capacity = burst or max(1, int(rate))
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+# One budget per user so concurrent crawls/refreshes for the same account share it
+_user_rate_limiters: dict[str, RateLimiter] = {}
+
+def get_rate_limiter(user_id: str | None) -> RateLimiter:
+    key = user_id or "_anonymous"
+    limiter = _user_rate_limiters.get(key)
+    if limiter is None:
+        limiter = RateLimiter(CRAWL_REQUESTS_PER_SECOND)
+        _user_rate_limiters[key] = limiter
+    return limiter
+
+
+# Callback persisting crawl progress: (items found since the last call, the
+# frontier of folders still to list, folders finished since the last call)
+CrawlCheckpoint = Callable[[list[dict], list[tuple[str, str]], int], None]
+
+async def crawl_drive_tree(creds: Credentials, user_id: str | None = None,
+                           max_concurrency: int | None = None,
+                           frontier: list[tuple[str, str]] | None = None,
+                           on_checkpoint: CrawlCheckpoint | None = None) -> list[dict]:
+    """Concurrent breadth-first traversal of *all* non-trashed files & folders.
 
     Each returned item includes a `path` key representing its
     human-readable location (e.g.  "Work/Specs/DocA").
@@ -196,20 +276,45 @@ async def crawl_drive_tree(creds: Credentials) -> list[dict]:
     • We start at the implicit root folder ID "root".
     • We request `supportsAllDrives=True` + `includeItemsFromAllDrives=True`
       so shared drives and shortcuts are included when permissions allow.
-    • API quota: one `files.list` per folder.  Typical personal Drives have
-      < a few thousand folders, well under quota limits.
+    • API quota: one `files.list` per folder (page).  Up to `max_concurrency`
+      folders are listed at once, throttled by the user's rate budget.
+    • The blocking `.execute()` calls run on drive_client's API thread pool so
+      the event loop stays free while the crawl is in progress.
+    • `frontier` resumes an earlier crawl from its unlisted folders
+      ((folder_id, path) pairs). A folder's items are only taken once all
+      its pages are listed, so `on_checkpoint` (called at most every
+      CRAWL_CHECKPOINT_SECONDS, and once at the end) always sees a
+      consistent state: every item from finished folders, and every folder
+      not yet finished in the frontier.
     """
-    service = build("drive", "v3", credentials=creds)
+    concurrency = max(1, max_concurrency or CRAWL_MAX_CONCURRENCY)
+    limiter = get_rate_limiter(user_id)
 
     items: list[dict] = []          # Flat list of every file/folder
-    queue: list[tuple[str, str]] = [("root", "")]  # (folder_id, current_path)
-
-    while queue:
-        folder_id, current_path = queue.pop(0)
-
+    queue: asyncio.Queue[tuple[str, str]] = asyncio.Queue()  # (folder_id, current_path)
+    pending: dict[str, str] = {}    # Queued or in-progress folders -> path
+    for folder_id, path in frontier or [("root", "")]:
+        pending[folder_id] = path
+        queue.put_nowait((folder_id, path))
+    errors: list[Exception] = []
+    unsaved: list[dict] = []        # Items not checkpointed yet
+    folders_finished = 0
+    last_checkpoint = time.monotonic()
+
+    def checkpoint():
+        nonlocal folders_finished, last_checkpoint
+        on_checkpoint(list(unsaved), list(pending.items()), folders_finished)
+        unsaved.clear()
+        folders_finished = 0
+        last_checkpoint = time.monotonic()
+
+    async def list_folder(service, folder_id: str, current_path: str):
+        nonlocal folders_finished
+        found: list[dict] = []
         page_token = None
         while True:
-            resp = service.files().list(
+            await limiter.acquire()
+            request = service.files().list(
                 q=f"'{folder_id}' in parents and trashed = false",
                 fields="nextPageToken, files(id,name,mimeType,parents,modifiedTime)",
                 pageSize=1000,
@@ -217,71 +322,272 @@ async def crawl_drive_tree(creds: Credentials) -> list[dict]:
                 supportsAllDrives=True,
                 includeItemsFromAllDrives=True,
                 corpora="user",
-            ).execute()
-
-            for f in resp.get("files", []):
-                # Build path: root-level children have no leading slash
-                path = f"{current_path}/{f['name']}" if current_path else f["name"]
-                f["path"] = path
-                items.append(f)
-
-                # If folder, enqueue for further traversal
-                if f.get("mimeType") == FOLDER_MIME:
-                    queue.append((f["id"], path))
-
+            )
+            resp = await drive_client.aexecute(request)
+            found.extend(resp.get("files", []))
             page_token = resp.get("nextPageToken")
             if not page_token:
                 break
 
+        # The whole folder is listed: take its items (no awaits from here on,
+        # so a checkpoint can't see it half-done)
+        for f in found:
+            # Build path: root-level children have no leading slash
+            path = f"{current_path}/{f['name']}" if current_path else f["name"]
+            f["path"] = path
+            items.append(f)
+
+            # If folder, enqueue for further traversal
+            if f.get("mimeType") == FOLDER_MIME and f["id"] not in pending:
+                pending[f["id"]] = path
+                queue.put_nowait((f["id"], path))
+        del pending[folder_id]
+        if on_checkpoint:
+            unsaved.extend(found)
+            folders_finished += 1
+            if time.monotonic() - last_checkpoint >= CRAWL_CHECKPOINT_SECONDS:
+                checkpoint()
+
+    # One service for all workers: drive_client.execute() binds each request
+    # to the executing thread's own pooled connection.
+    service = drive_client.get_service("drive", "v3", creds)
+
+    async def worker():
+        while True:
+            folder_id, current_path = await queue.get()
+            try:
+                if not errors:
+                    await list_folder(service, folder_id, current_path)
+            except Exception as e:
+                logger.error(f"Error listing folder {folder_id} during crawl: {e}")
+                errors.append(e)
+            finally:
+                queue.task_done()
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    try:
+        await queue.join()
+    finally:
+        for w in workers:
+            w.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    if errors:
+        raise errors[0]
+    if on_checkpoint:
+        checkpoint()
     return items
 
-async def ensure_drive_index(user_id: str, creds: Credentials) -> list[dict]:
-    """If no cache or >24 h old, (re)build the index.
-    Passes Credentials object to list_all_drive_items.
+# ------------------------------------------------------------
+# Incremental Refresh via the Drive Changes Feed
+# ------------------------------------------------------------
+# Minimum seconds between two incremental syncs of the same user's index
+DRIVE_SYNC_INTERVAL = float(os.getenv("DRIVE_SYNC_INTERVAL", "30"))
+
+async def get_changes_start_token(creds: Credentials) -> tuple[str, str]:
+    """Returns (startPageToken, root folder id) to begin tracking changes from now."""
+    service = drive_client.get_service("drive", "v3", creds)
+    token_resp = await drive_client.aexecute(service.changes().getStartPageToken(supportsAllDrives=True))
+    root = await drive_client.aexecute(service.files().get(fileId="root", fields="id"))
+    return token_resp["startPageToken"], root["id"]
+
+async def list_drive_changes(creds: Credentials, page_token: str, user_id: str | None = None) -> tuple[list[dict], str]:
+    """Fetches every change since `page_token`. Returns (changes, newStartPageToken)."""
+    service = drive_client.get_service("drive", "v3", creds)
+    limiter = get_rate_limiter(user_id)
+    changes: list[dict] = []
+    while True:
+        await limiter.acquire()
+        request = service.changes().list(
+            pageToken=page_token,
+            spaces="drive",
+            fields="nextPageToken, newStartPageToken, "
+                   "changes(fileId, removed, file(id,name,mimeType,parents,modifiedTime,trashed))",
+            pageSize=1000,
+            supportsAllDrives=True,
+            includeItemsFromAllDrives=True,
+        )
+        resp = await drive_client.aexecute(request)
+        changes.extend(resp.get("changes", []))
+        if resp.get("newStartPageToken"):
+            return changes, resp["newStartPageToken"]
+        page_token = resp["nextPageToken"]
+
+async def sync_drive_index(user_id: str, creds: Credentials, index: list[dict], sync_state: dict) -> list[dict]:
+    """Brings an existing index up to date using the Changes feed and saves it.
+
+    API cost scales with the number of changes since the last sync, not with Drive size.
+    """
+    changes, new_token = await list_drive_changes(creds, sync_state["page_token"], user_id=user_id)
+    if changes:
+        index, upserted, deleted = apply_drive_changes(index, changes, sync_state["root_id"])
+        drive_cache.delete_items(user_id, deleted)
+        drive_cache.upsert_items(user_id, upserted)
+        await asyncio.to_thread(name_index.build_name_index, user_id)
+        schedule_content_indexing(user_id, creds)
+        logger.info(f"Applied {len(changes)} Drive changes to index for user {user_id} "
+                    f"({len(upserted)} updated, {len(deleted)} removed).")
+    drive_cache.save_sync_state(user_id, new_token, sync_state["root_id"])
+    return index
+
+# ------------------------------------------------------------
+# Progressive, resumable first crawl
+# ------------------------------------------------------------
+_crawl_tasks: dict[str, asyncio.Task] = {}
+
+class CrawlTakenOver(Exception):
+    """Another process resumed this crawl (ours stopped checkpointing for too long)."""
+
+async def _run_first_crawl(user_id: str, creds: Credentials, crawl: dict):
+    def checkpoint(items: list[dict], frontier: list[tuple[str, str]], folders_done: int):
+        if not drive_cache.checkpoint_crawl(user_id, job_queue.PROCESS_ID, items, frontier, folders_done):
+            raise CrawlTakenOver(user_id)
+
+    try:
+        with tracing.start_trace("crawl"):
+            await crawl_drive_tree(creds, user_id=user_id, frontier=crawl["frontier"], on_checkpoint=checkpoint)
+        if drive_cache.finish_crawl(user_id, job_queue.PROCESS_ID):
+            await asyncio.to_thread(name_index.build_name_index, user_id)
+            schedule_content_indexing(user_id, creds)
+            logger.info(f"Saved complete Drive index for user {user_id}.")
+    except CrawlTakenOver:
+        logger.info(f"Crawl for user {user_id} was resumed by another worker; stopping here.")
+    except Exception as e:
+        # Progress so far is checkpointed; the next ensure_drive_index resumes it
+        logger.warning(f"First crawl for user {user_id} stopped: {e}")
+    finally:
+        _crawl_tasks.pop(user_id, None)
+
+async def _first_index(user_id: str, creds: Credentials, wait: bool) -> list[dict]:
+    """Starts (or resumes) the user's first crawl unless it is already running,
+    here or in another worker, and returns the index found so far."""
+    task = _crawl_tasks.get(user_id)
+    if task is None:
+        crawl = drive_cache.load_crawl(user_id)
+        if crawl is None:
+            logger.info(f"Building Drive index for user {user_id} (progressive first crawl)...")
+            # Take the change token *before* crawling so edits made mid-crawl are replayed next sync
+            page_token, root_id = await get_changes_start_token(creds)
+            crawl = drive_cache.start_crawl(user_id, job_queue.PROCESS_ID, page_token, root_id)
+        else:
+            crawl = drive_cache.claim_crawl(user_id, job_queue.PROCESS_ID, CRAWL_LEASE_SECONDS)
+            if crawl:
+                logger.info(f"Resuming Drive crawl for user {user_id}: {crawl['folders_done']} folders done, "
+                            f"{len(crawl['frontier'])} to go.")
+        if crawl and user_id not in _crawl_tasks:
+            task = _crawl_tasks[user_id] = asyncio.create_task(_run_first_crawl(user_id, creds, crawl))
+    if wait and task:
+        await asyncio.shield(task)
+    return await aload_index(user_id) or []
+
+def crawl_progress(user_id: str) -> dict | None:
+    """Progress of the user's first crawl, or None if none is in progress.
+
+    `estimated_seconds_remaining` assumes the folders left contain no further
+    folders, so it is a lower bound early in the crawl.
+    """
+    crawl = drive_cache.load_crawl(user_id)
+    if crawl is None:
+        return None
+    elapsed = crawl["checkpoint_at"] - crawl["started_at"]
+    rate = crawl["folders_done"] / elapsed if elapsed > 0 else 0.0
+    remaining = len(crawl["frontier"])
+    return {
+        "folders_visited": crawl["folders_done"],
+        "folders_remaining": remaining,
+        "items_found": crawl["items_found"],
+        "started_at": crawl["started_at"],
+        "last_checkpoint_at": crawl["checkpoint_at"],
+        "estimated_seconds_remaining": round(remaining / rate, 1) if rate else None,
+    }
+
+async def ensure_drive_index(user_id: str, creds: Credentials, force_full: bool = False, wait: bool = True) -> list[dict]:
+    """Returns the user's Drive index, building or refreshing it as needed.
+
+    • No index yet -> progressive first crawl (see _first_index), saved as it
+      goes. With wait=False (or if another worker runs the crawl) the partial
+      index found so far is returned while the crawl continues.
+    • Existing index -> incremental sync through the Changes feed, at most
+      once every DRIVE_SYNC_INTERVAL seconds.
+    • Forced or unrecoverable re-crawls keep the previous index on disk until
+      its replacement is saved.
     """
-    needs_update = False
-    current_index = load_index(user_id)
-    if not current_index: # Always update if no cache
-        needs_update = True
-    # elif last_updated and (datetime.datetime.utcnow() - last_updated).total_seconds() > 86400: # Update if older than 24h
-    #     needs_update = True
-
-    if needs_update:
-        cache_file = drive_cache.cache_path(user_id)
+    current_index = await aload_index(user_id)
+    sync_state = drive_cache.load_sync_state(user_id)
+
+    if current_index and sync_state and not force_full:
+        age = datetime.datetime.now(datetime.timezone.utc).timestamp() - sync_state.get("synced_at", 0)
+        if age < DRIVE_SYNC_INTERVAL:
+            logger.debug(f"Using existing Drive index cache for user {user_id}.")
+            if user_id not in _content_index_tasks:
+                schedule_content_indexing(user_id, creds)  # First request this process has seen
+            return current_index
         try:
-            cache_file.unlink(missing_ok=True) # Delete file if it exists, ignore if not
-            print(f"Removed old cache file for user {user_id} before refresh.")
-        except OSError as e:
-            print(f"Error removing old cache file for {user_id}: {e}")
-        print(f"Updating Drive index cache for user {user_id} (full BFS)...")
-        index = await crawl_drive_tree(creds)
-        save_index(user_id, index)
-        print(f"Saved updated Drive index for user {user_id}.")
-        return index
-    else:
-        print(f"Using existing Drive index cache for user {user_id}.")
-        return current_index
+            return await sync_drive_index(user_id, creds, current_index, sync_state)
+        except HttpError as error:
+            if error.resp.status not in (400, 404, 410):
+                # Rate limits, server errors: the page token is still good, retry next sync
+                logger.warning(f"Incremental sync failed for user {user_id} ({error}). Keeping existing index.")
+                return current_index
+            # Expired/invalid page tokens can only be recovered with a full crawl
+            logger.warning(f"Incremental sync failed for user {user_id} ({error}). Falling back to full crawl.")
+        except Exception as e:
+            logger.warning(f"Incremental sync error for user {user_id}: {e}. Keeping existing index.")
+            return current_index
+
+    if not sync_state and (not current_index or user_id in _crawl_tasks or drive_cache.load_crawl(user_id)):
+        return await _first_index(user_id, creds, wait)
+
+    logger.info(f"Updating Drive index cache for user {user_id} (full concurrent crawl)...")
+    # Take the change token *before* crawling so edits made mid-crawl are replayed next sync
+    page_token, root_id = await get_changes_start_token(creds)
+    index = await crawl_drive_tree(creds, user_id=user_id)
+    save_index(user_id, index)
+    drive_cache.save_sync_state(user_id, page_token, root_id)
+    await asyncio.to_thread(name_index.build_name_index, user_id)
+    schedule_content_indexing(user_id, creds)
+    logger.info(f"Saved updated Drive index for user {user_id}.")
+    return index
+
+async def refresh_drive_index(user_id: str, creds: Credentials):
+    """Cheap per-request freshness check: incremental sync only, never a full
+    crawl. An unfinished first crawl that stopped (or whose worker died) is
+    resumed in the background."""
+    sync_state = drive_cache.load_sync_state(user_id)
+    crawling = sync_state is None and drive_cache.load_crawl(user_id) is not None
+    if not crawling and (not drive_cache.has_index(user_id) or not sync_state):
+        return
+    try:
+        await ensure_drive_index(user_id, creds, wait=False)
+    except Exception as e:
+        logger.error(f"Error refreshing Drive index for user {user_id}: {e}")
 
-async def create_google_doc(title: str, creds: Credentials, content: str | None = None):
+async def create_google_doc(title: str, creds: Credentials, content: str | None = None, raise_retryable: bool = False):
     """
     Creates a Google Doc with the given title and optional content and optionally inserts content.
-    Returns (docId, docUrl).
+    Returns (docId, docUrl), or (None, None) on failure.
+
+    With raise_retryable=True (background jobs), transient failures (429/5xx,
+    timeouts; see job_queue.is_retryable) are raised instead so the job queue
+    can retry them. A doc created before such a failure is deleted first, so
+    the retry doesn't leave an empty duplicate behind.
     """
-    service = build('docs', 'v1', credentials=creds)
+    service = drive_client.get_service("docs", "v1", creds)
+    doc_id = None
 
     try:
         # 1. Create the document with the title
-        document = service.documents().create(body={
+        document = await drive_client.aexecute(service.documents().create(body={
             "title": title
-        }).execute()
+        }))
 
         doc_id = document.get('documentId')
         doc_url = f"https://docs.google.com/document/d/{doc_id}/edit"
-        print(f"Created Google Doc: ID={doc_id}, Title='{title}'")
+        logger.info(f"Created Google Doc: ID={doc_id}, Title='{title}'")
 
         # 2. If content is provided, insert it
         if content and doc_id:
-            print(f"Inserting content into doc {doc_id}...")
+            logger.debug(f"Inserting content into doc {doc_id}...")
             # Documents start with a newline character, insert at index 1
             requests = [
                 {
@@ -294,20 +600,45 @@ async def create_google_doc(title: str, creds: Credentials, content: str | None
                 }
             ]
             # Execute the batch update to insert the text
-            service.documents().batchUpdate(documentId=doc_id, body={'requests': requests}).execute()
-            print(f"Successfully inserted content into doc {doc_id}")
+            await drive_client.aexecute(service.documents().batchUpdate(documentId=doc_id, body={'requests': requests}))
+            logger.info(f"Successfully inserted content into doc {doc_id}")
 
         return doc_id, doc_url
 
-    except HttpError as error:
-        print(f"An API error occurred while creating/updating the doc: {error}")
-        # Depending on the error, you might want to raise it or return None
-        # For now, let's print and return None to indicate failure
-        return None, None
     except Exception as e:
-        print(f"An unexpected error occurred in create_google_doc: {e}")
+        if raise_retryable and job_queue.is_retryable(e):
+            logger.warning(f"Transient error while creating/updating the doc: {e}")
+            if doc_id:
+                await _delete_file_quietly(doc_id, creds)
+            raise
+        if isinstance(e, HttpError):
+            logger.error(f"An API error occurred while creating/updating the doc: {e}")
+        else:
+            logger.error(f"An unexpected error occurred in create_google_doc: {e}")
         return None, None
 
+async def _delete_file_quietly(file_id: str, creds: Credentials):
+    try:
+        drive = drive_client.get_service("drive", "v3", creds)
+        await drive_client.aexecute(drive.files().delete(fileId=file_id))
+    except Exception as e:
+        logger.warning(f"Could not delete partially created doc {file_id}: {e}")
+
+
+async def generate_doc_content(original_request: str) -> str:
+    """Generates (sanitized) Google Doc content for the request with LangChain.
+    Raises on failure, so a background job can retry it."""
+    # Chain: Prompt -> LLM -> String Output
+    content_prompt = ChatPromptTemplate.from_template(content_generation_template)
+    content_chain = content_prompt | gemini_llm | StrOutputParser()
+    logger.debug("Invoking LangChain content generation chain...")
+    # Pass the original request using the key expected by the prompt ('topic')
+    with tracing.span("gemini.generate", via="langchain"):
+        generated_content = await content_chain.ainvoke({"topic": original_request})
+    logger.debug("LangChain content generation complete.")
+    if not generated_content:
+        raise RuntimeError("LangChain generation produced no content.")
+    return sanitize_content(generated_content)
 
 async def run_langchain_doc_creation(original_request: str, generated_title: str, creds: Credentials):
     """
@@ -315,28 +646,11 @@ async def run_langchain_doc_creation(original_request: str, generated_title: str
     then creates the document with the generated title and content.
     Returns (docId, docUrl) or (None, None) on failure.
     """
-    print(f"Running LangChain generation for request: '{original_request}'")
+    logger.info(f"Running LangChain generation for request: '{original_request}'")
     try:
-        # 1. Prepare the LangChain prompt and chain for content generation
-        # Use the specific prompt template designed for content generation
-        content_prompt = ChatPromptTemplate.from_template(content_generation_template)
-        # Chain: Prompt -> LLM -> String Output
-        content_chain = content_prompt | gemini_llm | StrOutputParser() # Use the imported gemini_llm
-
-        # 2. Invoke the chain asynchronously to generate content
-        print("Invoking LangChain content generation chain...")
-        # Pass the original request using the key expected by the prompt ('topic')
-        generated_content = await content_chain.ainvoke({"topic": original_request})
-        print("LangChain content generation complete.")
-        # print(f"Generated Content Preview (first 100 chars): {generated_content[:100]}...") # Optional: Log preview
+        cleaned_content = await generate_doc_content(original_request)
 
-        if not generated_content:
-             print("Error: LangChain generation failed to produce content.")
-             return None, None # Indicate failure
-
-        # 3. Call the modified create_google_doc with title and the generated content
-        print(f"Creating Google Doc '{generated_title}' using LangChain flow...")
-        cleaned_content = sanitize_content(generated_content)
+        logger.info(f"Creating Google Doc '{generated_title}' using LangChain flow...")
         doc_id, doc_url = await create_google_doc(
             title=generated_title,
             creds=creds,
@@ -347,9 +661,7 @@ async def run_langchain_doc_creation(original_request: str, generated_title: str
 
     except Exception as e:
         # Log the exception for debugging
-        print(f"An error occurred during LangChain document creation process: {e}")
-        import traceback
-        traceback.print_exc() # Print detailed traceback
+        logger.exception(f"An error occurred during LangChain document creation process: {e}")
         return None, None # Indicate failure
 
 async def move_doc_to_folder(file_id: str, current_parent_id: str, target_folder_id: str, creds: Credentials, doc_name: str = "Unknown File") -> str:
@@ -366,23 +678,23 @@ async def move_doc_to_folder(file_id: str, current_parent_id: str, target_folder
         A status message indicating success or failure.
     """
     try:
-        drive_service = build('drive', 'v3', credentials=creds)
-        print(f"Attempting to move file '{doc_name}' (ID: {file_id}) from parent {current_parent_id} to target {target_folder_id}")
+        drive_service = drive_client.get_service("drive", "v3", creds)
+        logger.debug(f"Attempting to move file '{doc_name}' (ID: {file_id}) from parent {current_parent_id} to target {target_folder_id}")
 
         # Move the file by updating its parents field
         # We need to remove the old parent and add the new one.
-        file_metadata = drive_service.files().update(
+        file_metadata = await drive_client.aexecute(drive_service.files().update(
             fileId=file_id,
             addParents=target_folder_id,
             removeParents=current_parent_id,
             fields='id, parents' # Request necessary fields
-        ).execute()
+        ))
 
-        print(f"Successfully moved '{doc_name}' (ID: {file_id}) to folder ID {target_folder_id}. New parents: {file_metadata.get('parents')}")
+        logger.info(f"Successfully moved '{doc_name}' (ID: {file_id}) to folder ID {target_folder_id}. New parents: {file_metadata.get('parents')}")
         return f"✅ Successfully moved '{doc_name}' to the target folder."
 
     except HttpError as error:
-        print(f"An API error occurred while moving '{doc_name}': {error}")
+        logger.error(f"An API error occurred while moving '{doc_name}': {error}")
         # Provide more specific error messages based on common issues
         reason = error._get_reason()
         if error.resp.status == 404:
@@ -392,58 +704,157 @@ async def move_doc_to_folder(file_id: str, current_parent_id: str, target_folder
         else:
             return f"❌ Failed to move '{doc_name}': {reason}"
     except Exception as e:
-        print(f"An unexpected error occurred while moving '{doc_name}': {e}")
+        logger.error(f"An unexpected error occurred while moving '{doc_name}': {e}")
         return f"❌ An unexpected error occurred while trying to move '{doc_name}'."
 
-async def get_drive_item_content(target_name: str, creds: Credentials) -> str | None:
+async def _download_text(request, item_id: str, modified_time: str | None) -> str:
+    """Downloads a text export and stores it in the content cache."""
+    text = (await drive_client.adownload(request)).decode('utf-8')
+    await content_cache.put(item_id, modified_time, text)
+    return text
+
+# --- Full-text and passage-vector indexing of document contents (see
+# fulltext_index and vector_index) ---
+FULLTEXT_INDEX_CONCURRENCY = int(os.getenv("FULLTEXT_INDEX_CONCURRENCY", "4"))
+# Documents exported per round; their new passages are embedded together
+CONTENT_INDEX_BATCH = int(os.getenv("CONTENT_INDEX_BATCH", "32"))
+_content_index_tasks: dict[str, asyncio.Task] = {}
+
+async def _export_text(service, item: dict, user_id: str) -> str:
+    """Plain text of a Doc, Slides deck or text file, from the content cache when unchanged.
+
+    Bulk indexing reads the content cache but doesn't fill it: storing every
+    document would evict the ones users are working with.
+    """
+    cached = await content_cache.get(item["id"], item.get("modifiedTime"))
+    if cached is not None:
+        return cached
+    if item.get("mimeType", "").startswith("application/vnd.google-apps."):
+        request = service.files().export_media(fileId=item["id"], mimeType="text/plain")
+    else:
+        request = service.files().get_media(fileId=item["id"])
+    await get_rate_limiter(user_id).acquire()
+    return (await drive_client.adownload(request)).decode('utf-8')
+
+async def index_document_contents(user_id: str, creds: Credentials) -> int:
+    """(Re)indexes the text of every document whose modifiedTime changed since it
+    was last indexed, and drops documents no longer in the Drive index."""
+    items = await aload_index(user_id) or []
+    to_index, to_drop = await asyncio.to_thread(fulltext_index.stale_items, user_id, items)
+    to_embed, to_unembed = await asyncio.to_thread(vector_index.stale_items, user_id, items)
+    await asyncio.to_thread(fulltext_index.remove_documents, user_id, to_drop)
+    await asyncio.to_thread(vector_index.remove_documents, user_id, to_unembed)
+    queued = {item["id"] for item in to_index}
+    to_index += [item for item in to_embed if item["id"] not in queued]
+    if not to_index:
+        return 0
+
+    logger.info(f"Indexing the text of {len(to_index)} documents for user {user_id}...")
+    service = drive_client.get_service("drive", "v3", creds)
+    semaphore = asyncio.Semaphore(FULLTEXT_INDEX_CONCURRENCY)
+
+    async def export_one(item: dict) -> tuple[dict, str] | None:
+        async with semaphore:
+            try:
+                return item, await _export_text(service, item, user_id)
+            except (HttpError, UnicodeDecodeError) as e:
+                # Not exportable (too large, binary, no access): index the name
+                # only, so it isn't retried until the file changes
+                logger.warning(f"Could not export '{item.get('name')}' for indexing: {e}")
+                return item, ""
+            except Exception as e:
+                logger.warning(f"Skipping '{item.get('name')}' this round: {e}")
+                return None
+
+    indexed = 0
+    for i in range(0, len(to_index), CONTENT_INDEX_BATCH):
+        docs = [doc for doc in await asyncio.gather(*(export_one(item) for item in to_index[i:i + CONTENT_INDEX_BATCH])) if doc]
+        for item, text in docs:
+            await asyncio.to_thread(fulltext_index.add_document, user_id, item, text)
+        try:
+            await vector_index.update_documents(user_id, docs)
+        except Exception as e:
+            # Still stale in vector_index.stale_items, so the next pass retries the embeddings
+            logger.error(f"Embedding {len(docs)} documents failed for user {user_id}: {e}")
+        indexed += len(docs)
+    logger.info(f"Indexed {indexed}/{len(to_index)} documents for user {user_id}.")
+    return indexed
+
+async def _run_content_indexing(user_id: str, creds: Credentials):
+    try:
+        # Outlives the request that scheduled it, so it gets its own trace
+        with tracing.start_trace("content_index"):
+            await index_document_contents(user_id, creds)
+    except Exception as e:
+        logger.error(f"Content indexing failed for user {user_id}: {e}")
+
+def schedule_content_indexing(user_id: str, creds: Credentials):
+    """Starts a background indexing pass unless one is already running for the user."""
+    task = _content_index_tasks.get(user_id)
+    if task and not task.done():
+        return
+    _content_index_tasks[user_id] = asyncio.create_task(_run_content_indexing(user_id, creds))
+
+async def get_drive_item_content(target_name: str, creds: Credentials, user_id: str | None = None) -> str | None:
     """
     Searches for a file/folder by name in Google Drive and attempts to retrieve its text content.
 
     Args:
         target_name: The name of the file or folder to search for.
         creds: The user's Google OAuth credentials.
+        user_id: When given, the item is resolved through the user's Drive index.
 
     Returns:
         The text content of the item, a summary (for folders),
         or None if not found or content cannot be extracted.
     """
-    print(f"Attempting to get content for '{target_name}'...")
-    service = build('drive', 'v3', credentials=creds)
+    logger.debug(f"Attempting to get content for '{target_name}'...")
+    service = drive_client.get_service("drive", "v3", creds)
 
     try:
         # --- Search for the file/folder by name ---
         # Note: This finds the first match. Might need refinement if names collide.
-        print(f"Searching Drive for: '{target_name}'")
-        results = service.files().list(
-            q=f"name = '{target_name}' and trashed = false",
-            spaces='drive',
-            fields='files(id, name, mimeType)',
-            pageSize=1 # Limit to the first match for simplicity
-        ).execute()
-        
-        items = results.get('files', [])
+        if user_id:
+            item = await find_item_by_name(target_name, user_id, creds)
+        else:
+            logger.debug(f"Searching Drive for: '{target_name}'")
+            results = await drive_client.aexecute(service.files().list(
+                q=f"name = '{target_name}' and trashed = false",
+                spaces='drive',
+                fields='files(id, name, mimeType, modifiedTime)',
+                pageSize=1 # Limit to the first match for simplicity
+            ))
+            items = results.get('files', [])
+            item = items[0] if items else None
 
-        if not items:
-            print(f"Item '{target_name}' not found in Drive.")
+        if not item:
+            logger.info(f"Item '{target_name}' not found in Drive.")
             return None # Or raise a specific exception?
 
-        item = items[0]
         item_id = item['id']
         item_name = item['name']
         mime_type = item['mimeType']
-        print(f"Found item: ID={item_id}, Name='{item_name}', Type={mime_type}")
+        modified_time = item.get('modifiedTime')
+        logger.debug(f"Found item: ID={item_id}, Name='{item_name}', Type={mime_type}")
+
+        # --- Unchanged since the last export? Skip the download ---
+        if mime_type != FOLDER_MIME:
+            cached = await content_cache.get(item_id, modified_time)
+            if cached is not None:
+                logger.debug(f"Using cached content for '{item_name}' (modified {modified_time}).")
+                return cached
 
         # --- Extract content based on MIME type ---
         
         # Handle Folders
         if mime_type == 'application/vnd.google-apps.folder':
-            print(f"Item '{item_name}' is a folder. Listing contents...")
-            folder_contents = service.files().list(
+            logger.debug(f"Item '{item_name}' is a folder. Listing contents...")
+            folder_contents = await drive_client.aexecute(service.files().list(
                 q=f"'{item_id}' in parents and trashed = false",
                 spaces='drive',
                 fields='files(name, mimeType)',
                 pageSize=10 # Limit number of listed items for brevity
-            ).execute()
+            ))
             children = folder_contents.get('files', [])
             if not children:
                 return f"Folder '{item_name}' is empty."
@@ -456,47 +867,25 @@ async def get_drive_item_content(target_name: str, creds: Credentials) -> str |
 
         # Handle Google Docs
         elif mime_type == 'application/vnd.google-apps.document':
-            print(f"Exporting Google Doc '{item_name}' as text...")
+            logger.debug(f"Exporting Google Doc '{item_name}' as text...")
             request = service.files().export_media(fileId=item_id, mimeType='text/plain')
-            # Use io.BytesIO to handle the downloaded bytes
-            fh = io.BytesIO()
-            downloader = MediaIoBaseDownload(fh, request)
-            done = False
-            while done is False:
-                status, done = downloader.next_chunk()
-                print(f"Download {int(status.progress() * 100)}%.")
-            fh.seek(0)
-            return fh.read().decode('utf-8')
+            return await _download_text(request, item_id, modified_time)
 
         # Handle Plain Text files
         elif mime_type.startswith('text/'):
-             print(f"Downloading text file '{item_name}'...")
+             logger.debug(f"Downloading text file '{item_name}'...")
              request = service.files().get_media(fileId=item_id)
-             fh = io.BytesIO()
-             downloader = MediaIoBaseDownload(fh, request)
-             done = False
-             while done is False:
-                status, done = downloader.next_chunk()
-                print(f"Download {int(status.progress() * 100)}%.")
-             fh.seek(0)
-             return fh.read().decode('utf-8')
+             return await _download_text(request, item_id, modified_time)
         
         # Handle Google Slides (Attempt export as text, might not be ideal)
         elif mime_type == 'application/vnd.google-apps.presentation':
-            print(f"Attempting to export Google Slides '{item_name}' as text...")
+            logger.debug(f"Attempting to export Google Slides '{item_name}' as text...")
             try:
                 request = service.files().export_media(fileId=item_id, mimeType='text/plain')
-                fh = io.BytesIO()
-                downloader = MediaIoBaseDownload(fh, request)
-                done = False
-                while done is False:
-                    status, done = downloader.next_chunk()
-                    print(f"Download {int(status.progress() * 100)}%.")
-                fh.seek(0)
                 # Often slide text export includes speaker notes etc., might need cleaning
-                return fh.read().decode('utf-8') 
+                return await _download_text(request, item_id, modified_time)
             except HttpError as export_error:
-                print(f"Could not export slides as text: {export_error}")
+                logger.warning(f"Could not export slides as text: {export_error}")
                 return f"Cannot directly extract text content from Google Slides '{item_name}'."
 
 
@@ -504,57 +893,84 @@ async def get_drive_item_content(target_name: str, creds: Credentials) -> str |
         
         # Unsupported types
         else:
-            print(f"Unsupported MIME type for content extraction: {mime_type}")
+            logger.warning(f"Unsupported MIME type for content extraction: {mime_type}")
             return f"Cannot extract text content from file type: {mime_type}"
 
     except HttpError as error:
-        print(f"An API error occurred: {error}")
+        logger.error(f"An API error occurred: {error}")
         # Handle specific errors? (e.g., 401 Unauthorized, 403 Forbidden, 404 Not Found)
         # Depending on error.resp.status, you might return different messages
         return f"Error accessing Google Drive: {error.resp.status} {error._get_reason()}"
     except Exception as e:
-         print(f"An unexpected error occurred in get_drive_item_content: {e}")
+         logger.error(f"An unexpected error occurred in get_drive_item_content: {e}")
          # Propagate or handle? For now, return an error message
          return f"An unexpected error occurred while fetching content: {e}"
 
-async def update_google_doc(doc_id: str, new_content: str, creds: Credentials):
+# Requests per documents.batchUpdate call when an update is large
+DOCS_BATCH_MAX_REQUESTS = int(os.getenv("DOCS_BATCH_MAX_REQUESTS", "500"))
+
+def _full_replace_requests(document: dict, new_content: str) -> list[dict]:
+    end_index = document.get('body', {}).get('content', [])[-1].get('endIndex', 1)
+    logger.debug(f"Real document end index: {end_index}")
+    requests = []
+    if end_index - 1 > 1:
+        requests.append({
+            "deleteContentRange": {
+                "range": {
+                    "startIndex": 1,  # After the title usually
+                    "endIndex": end_index - 1  # Careful: endIndex is exclusive
+                }
+            }
+        })
+    requests.append({
+        "insertText": {
+            "location": {"index": 1},
+            "text": "\n\n" + new_content
+        }
+    })
+    return requests
+
+async def update_google_doc(doc_id: str, new_content: str, creds: Credentials, mode: str = "diff"):
     """
-    Replaces the content of an existing Google Doc with new content.
+    Updates an existing Google Doc so its text becomes new_content.
+
+    In "diff" mode only the changed text is deleted/inserted (see doc_diff),
+    so untouched text keeps its formatting and comments. Documents the diff
+    can't handle (tables, tables of contents) fall back to "replace" mode,
+    which clears the body and inserts the new content.
     """
-    service = build('docs', 'v1', credentials=creds)
+    service = drive_client.get_service("docs", "v1", creds)
 
     try:
-        print(f"Clearing and updating doc {doc_id}...")
-
-        # --- First, get the real end index of the doc ---
-        document = service.documents().get(documentId=doc_id).execute()
-        end_index = document.get('body', {}).get('content', [])[-1].get('endIndex', 1)
-        print(f"Real document end index: {end_index}")
-
-        # Now safely delete from index 1 to real end index
-        requests = [
-            {
-                "deleteContentRange": {
-                    "range": {
-                        "startIndex": 1,  # After the title usually
-                        "endIndex": end_index - 1  # Careful: endIndex is exclusive
-                    }
-                }
-            },
-            {
-                "insertText": {
-                    "location": {"index": 1},
-                    "text": "\n\n" + new_content
-                }
-            }
-        ]
-        service.documents().batchUpdate(
-            documentId=doc_id,
-            body={"requests": requests}
-        ).execute()
+        document = await drive_client.aexecute(service.documents().get(documentId=doc_id))
 
-        print(f"✅ Document {doc_id} updated successfully.")
+        requests = None
+        if mode == "diff":
+            try:
+                # Diffing a long document is CPU-bound; keep it off the event loop
+                requests = await asyncio.to_thread(doc_diff.build_requests, document, new_content)
+                logger.info(f"Updating doc {doc_id} with {len(requests)} diff request(s)...")
+            except doc_diff.UnsupportedDocument as e:
+                logger.warning(f"Can't diff doc {doc_id} ({e}); replacing its content instead.")
+        if requests is None:
+            logger.info(f"Clearing and updating doc {doc_id}...")
+            requests = _full_replace_requests(document, new_content)
+
+        if not requests:
+            logger.info(f"Document {doc_id} already up to date.")
+            return True
+
+        # Requests are ordered from the end of the document backwards, so
+        # splitting them across calls never invalidates a later index.
+        for i in range(0, len(requests), DOCS_BATCH_MAX_REQUESTS):
+            body = {"requests": requests[i:i + DOCS_BATCH_MAX_REQUESTS]}
+            if i == 0 and document.get("revisionId"):
+                # Fail rather than corrupt the doc if it changed since we read it
+                body["writeControl"] = {"requiredRevisionId": document["revisionId"]}
+            await drive_client.aexecute(service.documents().batchUpdate(documentId=doc_id, body=body))
+
+        logger.info(f"✅ Document {doc_id} updated successfully.")
         return True
     except Exception as e:
-        print(f"Error updating document: {e}")
+        logger.error(f"Error updating document: {e}")
         return False
@@ -0,0 +1,132 @@
+# services/intent_service.py
+# Local fast path for intent parsing: compiled patterns for the common
+# phrasings, checked against the user's Drive name index. Only when this is
+# not confident does parse_user_message spend a Gemini round trip.
+
+import logging
+import os
+import re
+import threading
+
+from services import name_index
+
+logger = logging.getLogger(__name__)
+
+FOLDER_MIME = "application/vnd.google-apps.folder"
+
+# Below this confidence the message is sent to Gemini instead
+INTENT_MIN_CONFIDENCE = float(os.getenv("INTENT_MIN_CONFIDENCE", "0.7"))
+
+_Q_OPEN = r"[\"'“‘]?"
+_Q_CLOSE = r"[\"'”’]?"
+_POLITE = r"(?:(?:hey|hi|ok|okay)[,\s]+)?(?:please\s+)?(?:(?:can|could|would|will)\s+you\s+)?(?:please\s+)?"
+_END = r"\s*(?:please)?\s*[.!?]*\s*$"
+
+CREATE_RE = re.compile(
+    rf"^{_POLITE}(?:create|make|start|write|new)\s+(?:me\s+)?(?:a\s+|an\s+)?(?:new\s+)?(?:google\s+)?"
+    rf"(?:doc|document|file)\s+(?:called|named|titled|with\s+(?:the\s+)?(?:title|name))\s+"
+    rf"{_Q_OPEN}(?P<name>.+?){_Q_CLOSE}{_END}",
+    re.IGNORECASE,
+)
+MOVE_RE = re.compile(
+    rf"^{_POLITE}move\s+(?:the\s+|my\s+)?(?:(?:file|doc|document|folder)\s+)?{_Q_OPEN}(?P<doc>.+?){_Q_CLOSE}"
+    rf"(?:\s+(?:to|into)\s+(?:the\s+|my\s+)?(?:folder\s+)?{_Q_OPEN}(?P<target>.+?){_Q_CLOSE}(?:\s+folder)?)?{_END}",
+    re.IGNORECASE,
+)
+ANALYZE_RE = re.compile(
+    rf"^{_POLITE}(?P<verb>summarize|summarise|analyze|analyse|explain|condense|shorten|proofread|"
+    rf"tell\s+me\s+about|what(?:'s|\s+is)\s+in)\s+(?:the\s+|my\s+)?(?:(?:file|doc|document)\s+)?"
+    rf"{_Q_OPEN}(?P<target>.+?){_Q_CLOSE}{_END}",
+    re.IGNORECASE,
+)
+SEARCH_RE = re.compile(
+    rf"^{_POLITE}(?:(?:which|what)\s+(?:of\s+my\s+)?(?:docs?|documents?|files?)|(?:find|search)\s+(?:for\s+)?(?:the\s+|my\s+)?"
+    rf"(?:docs?|documents?|files?))\s+(?:that\s+)?(?:mentions?|mentioning|contains?|containing|talks?\s+about|talking\s+about|says?|about|with|discuss(?:es|ing)?)\s+"
+    rf"(?P<terms>.+?){_END}",
+    re.IGNORECASE,
+)
+SUMMARIZE_RE = re.compile(
+    r"\b(?:summari[sz](?:e[sd]?|ing|ation)|shorter|make\s+concise|cut\s+down|condense|make\s+briefer)\b",
+    re.IGNORECASE,
+)
+
+_counters = {"fast_path": 0, "fallback": 0}
+_by_action: dict[str, int] = {}
+_lock = threading.Lock()
+
+
+def is_summarize_request(query: str) -> bool:
+    return SUMMARIZE_RE.search(query) is not None
+
+def _resolve(user_id: str | None, name: str, mime_type: str | None = None) -> tuple[float, str]:
+    """Confidence that `name` refers to an existing item, and its canonical name.
+
+    Only an exact or case-insensitive match is confident enough for the fast
+    path: a token or prefix match ("budget" -> "Budget 2024") may be a
+    different file, and acting on it could edit a doc the user never named.
+    Weaker matches keep the literal name and go to the Gemini classifier.
+    """
+    if not user_id:
+        return 0.0, name
+    candidates = name_index.search_names(user_id, name, limit=1, mime_type=mime_type)
+    if not candidates:
+        return 0.0, name
+    score, item = candidates[0]
+    if score >= name_index.SCORE_CASEFOLD:
+        return 0.95, item.get("name", name)
+    return 0.5, name
+
+def _match(message: str, user_id: str | None) -> tuple[float, dict] | None:
+    m = CREATE_RE.match(message)
+    if m:
+        # A new doc doesn't need to exist yet; the phrasing alone is enough
+        return 0.95, {"action_to_perform": "createDoc", "name": m.group("name").strip()}
+
+    m = MOVE_RE.match(message)
+    if m:
+        confidence, doc_name = _resolve(user_id, m.group("doc").strip())
+        target = m.group("target")
+        if target:
+            target_confidence, target = _resolve(user_id, target.strip(), FOLDER_MIME)
+            confidence = min(confidence, target_confidence)
+        return confidence, {
+            "action_to_perform": "moveDoc",
+            "doc_name": doc_name,
+            "source_folder": None,
+            "target_folder": target,
+        }
+
+    m = SEARCH_RE.match(message)
+    if m:
+        # Answered from the full-text index; no specific target
+        return 0.9, {"action_to_perform": "analyze", "target": None, "query": message}
+
+    m = ANALYZE_RE.match(message)
+    if m:
+        confidence, target = _resolve(user_id, m.group("target").strip())
+        return confidence, {"action_to_perform": "analyze", "target": target, "query": message}
+
+    return None
+
+def classify(message: str, user_id: str | None = None) -> dict | None:
+    """Returns the parsed action when the local rules are confident, else None."""
+    text = " ".join(message.split())
+    result = _match(text, user_id) if text else None
+    with _lock:
+        if result and result[0] >= INTENT_MIN_CONFIDENCE:
+            action = result[1]["action_to_perform"]
+            _counters["fast_path"] += 1
+            _by_action[action] = _by_action.get(action, 0) + 1
+            logger.debug(f"Parsed action locally (confidence {result[0]:.2f}): {result[1]}")
+            return result[1]
+        _counters["fallback"] += 1
+    return None
+
+def intent_stats() -> dict:
+    with _lock:
+        total = _counters["fast_path"] + _counters["fallback"]
+        return {
+            **_counters,
+            "by_action": dict(_by_action),
+            "hit_rate": _counters["fast_path"] / total if total else 0.0,
+        }
@@ -0,0 +1,294 @@
+# services/job_queue.py
+# Background jobs for slow, side-effecting work (document creation, moves,
+# document updates), so /api/ask can answer with a job id instead of holding
+# the request open for the whole LLM generation.
+#
+# Each process runs JOB_WORKERS worker tasks, which also caps how many jobs
+# (and so LLM generations) run at once per process. Job records (state,
+# stage, attempts, result) live in SQLite next to the session store, so
+# GET /api/jobs/{id} can be answered by any worker. The work itself - a
+# coroutine factory holding the user's credentials - stays in the memory of
+# the process that accepted it; credentials are never written to disk. A
+# process heartbeats its unfinished jobs, and jobs whose process stopped
+# heartbeating (crash, restart) are reported as failed.
+#
+# RetryableJobError, transient Google API errors (429 / 5xx) and timeouts
+# are retried with exponential backoff and jitter, up to max_attempts.
+
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import pathlib
+import random
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+from google.api_core import exceptions as api_exceptions
+from googleapiclient.errors import HttpError
+
+from services import drive_cache, tracing
+
+logger = logging.getLogger(__name__)
+
+JOB_DB_PATH = pathlib.Path(os.getenv("JOB_DB", str(drive_cache.CACHE_DIR / "jobs.db")))
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_RETRY_BASE_SECONDS = float(os.getenv("JOB_RETRY_BASE_SECONDS", "2"))
+JOB_RETRY_MAX_SECONDS = float(os.getenv("JOB_RETRY_MAX_SECONDS", "60"))
+JOB_HEARTBEAT_SECONDS = float(os.getenv("JOB_HEARTBEAT_SECONDS", "10"))
+# An unfinished job not heartbeated for this long belongs to a dead process
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "60"))
+# Finished jobs are kept this long for status polling
+JOB_TTL = float(os.getenv("JOB_TTL", str(24 * 60 * 60)))
+
+QUEUED = "queued"
+RUNNING = "running"
+RETRYING = "retrying"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+UNFINISHED = (QUEUED, RUNNING, RETRYING)
+
+RETRYABLE_HTTP_STATUSES = {429, 500, 502, 503, 504}
+RETRYABLE_EXCEPTIONS = (
+    asyncio.TimeoutError,
+    ConnectionError,
+    api_exceptions.TooManyRequests,
+    api_exceptions.ResourceExhausted,
+    api_exceptions.InternalServerError,
+    api_exceptions.ServiceUnavailable,
+    api_exceptions.DeadlineExceeded,
+)
+
+# Identifies this process's jobs (pids get reused across restarts)
+PROCESS_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id           TEXT PRIMARY KEY,
+    user_id      TEXT NOT NULL,
+    kind         TEXT NOT NULL,
+    state        TEXT NOT NULL,
+    stage        TEXT,
+    progress     TEXT,
+    attempts     INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    result       TEXT,
+    error        TEXT,
+    owner        TEXT NOT NULL,
+    created_at   REAL NOT NULL,
+    updated_at   REAL NOT NULL,
+    heartbeat_at REAL NOT NULL,
+    next_attempt_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_owner ON jobs (owner, state);
+CREATE INDEX IF NOT EXISTS jobs_updated ON jobs (updated_at);
+"""
+
+
+class RetryableJobError(Exception):
+    """Raise from a job to have it retried (with backoff)."""
+
+
+class JobFailed(Exception):
+    """Raise from a job to fail it with a user-facing message, without retrying."""
+
+
+# report(stage, **data): records the job's current stage and progress details
+ProgressReporter = Callable[..., Awaitable[None]]
+# Does the work; returns the JSON-serializable result shown to the user
+JobHandler = Callable[[ProgressReporter], Awaitable[dict]]
+# Called with the error message once a job has failed for good
+FailureCallback = Callable[[str], None]
+
+
+@dataclass
+class _Job:
+    id: str
+    user_id: str
+    kind: str
+    handler: JobHandler
+    max_attempts: int
+    on_failure: FailureCallback | None = None
+    attempts: int = 0
+
+
+# --- Job records ---
+_local = threading.local()
+
+def _db() -> sqlite3.Connection:
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        JOB_DB_PATH.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(JOB_DB_PATH, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(_SCHEMA)
+        _local.conn = conn
+    return conn
+
+def _update(job_id: str, **fields):
+    fields["updated_at"] = fields["heartbeat_at"] = time.time()
+    columns = ", ".join(f"{name} = ?" for name in fields)
+    _db().execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+
+def _row_to_job(row: sqlite3.Row) -> dict:
+    job = dict(row)
+    for key in ("progress", "result"):
+        job[key] = json.loads(job[key]) if job[key] else None
+    for key in ("user_id", "owner", "heartbeat_at"):
+        job.pop(key)
+    return job
+
+def get_job(job_id: str, user_id: str) -> dict | None:
+    """The job's public record, or None if it doesn't exist or isn't the user's."""
+    conn = _db()
+    conn.row_factory = sqlite3.Row
+    try:
+        row = conn.execute("SELECT * FROM jobs WHERE id = ? AND user_id = ?", (job_id, user_id)).fetchone()
+        if row is None:
+            return None
+        if row["state"] in UNFINISHED and row["heartbeat_at"] < time.time() - JOB_LEASE_SECONDS:
+            # Its process is gone, and the work (and credentials) with it
+            conn.execute(
+                "UPDATE jobs SET state = ?, error = ?, updated_at = ? WHERE id = ? AND heartbeat_at = ?",
+                (FAILED, "The server restarted before this finished. Please try again.", time.time(), job_id, row["heartbeat_at"]),
+            )
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return _row_to_job(row)
+    finally:
+        conn.row_factory = None
+
+
+# --- Worker pool ---
+_queue: asyncio.Queue | None = None
+_tasks: list[asyncio.Task] = []
+_running = 0
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, (RetryableJobError, *RETRYABLE_EXCEPTIONS)):
+        return True
+    return isinstance(error, HttpError) and error.resp.status in RETRYABLE_HTTP_STATUSES
+
+def _backoff(attempt: int) -> float:
+    """Exponential backoff (with jitter) before retry number `attempt`."""
+    return random.uniform(0.5, 1.0) * min(JOB_RETRY_BASE_SECONDS * 2 ** (attempt - 1), JOB_RETRY_MAX_SECONDS)
+
+async def _run(job: _Job):
+    global _running
+    job.attempts += 1
+    _update(job.id, state=RUNNING, attempts=job.attempts, next_attempt_at=None)
+
+    async def report(stage: str, **data):
+        _update(job.id, stage=stage, progress=json.dumps(data) if data else None)
+
+    _running += 1
+    try:
+        # Each attempt is its own trace, tagged with the job
+        with tracing.start_trace(f"job.{job.kind}", job_id=job.id, attempt=job.attempts):
+            result = await job.handler(report)
+    except asyncio.CancelledError:
+        _update(job.id, state=FAILED, error="The server shut down before this finished. Please try again.")
+        raise
+    except Exception as e:
+        if not isinstance(e, JobFailed) and job.attempts < job.max_attempts and is_retryable(e):
+            delay = _backoff(job.attempts)
+            logger.warning(f"Job {job.id} attempt {job.attempts} failed ({e!r}); retrying in {delay:.1f}s.")
+            _update(job.id, state=RETRYING, error=str(e), next_attempt_at=time.time() + delay)
+            asyncio.get_running_loop().call_later(delay, _queue.put_nowait, job)
+            return
+        error = str(e) or e.__class__.__name__
+        # JobFailed is an expected outcome; anything else gets its traceback logged
+        logger.error(f"Job {job.id} failed after {job.attempts} attempt(s): {error}",
+                     exc_info=not isinstance(e, JobFailed))
+        _update(job.id, state=FAILED, error=error)
+        if job.on_failure:
+            job.on_failure(error)
+    else:
+        _update(job.id, state=SUCCEEDED, stage=None, error=None, result=json.dumps(result))
+    finally:
+        _running -= 1
+
+async def _worker():
+    while True:
+        job = await _queue.get()
+        try:
+            await _run(job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Bookkeeping failed (e.g. the database is locked); keep the worker alive
+            logger.error(f"Job worker error on {job.id}: {e}")
+        finally:
+            _queue.task_done()
+
+async def _heartbeat():
+    while True:
+        await asyncio.sleep(JOB_HEARTBEAT_SECONDS)
+        try:
+            conn = _db()
+            conn.execute(
+                f"UPDATE jobs SET heartbeat_at = ? WHERE owner = ? AND state IN ({','.join('?' * len(UNFINISHED))})",
+                (time.time(), PROCESS_ID, *UNFINISHED),
+            )
+            conn.execute(
+                f"DELETE FROM jobs WHERE updated_at < ? AND state NOT IN ({','.join('?' * len(UNFINISHED))})",
+                (time.time() - JOB_TTL, *UNFINISHED),
+            )
+        except sqlite3.Error as e:
+            logger.error(f"Job heartbeat failed: {e}")
+
+def _ensure_workers():
+    global _queue
+    if _queue is None:
+        _queue = asyncio.Queue()
+        # A fresh context, so the workers don't inherit the submitting request's trace
+        _tasks.extend(asyncio.create_task(_worker(), context=contextvars.Context()) for _ in range(JOB_WORKERS))
+        _tasks.append(asyncio.create_task(_heartbeat(), context=contextvars.Context()))
+        logger.info(f"Started {JOB_WORKERS} job workers ({PROCESS_ID}).")
+
+def submit(
+    user_id: str,
+    kind: str,
+    handler: JobHandler,
+    max_attempts: int = JOB_MAX_ATTEMPTS,
+    on_failure: FailureCallback | None = None,
+) -> str:
+    """Queues `handler` and returns the job id to poll."""
+    _ensure_workers()
+    job = _Job(uuid.uuid4().hex, user_id, kind, handler, max_attempts, on_failure)
+    now = time.time()
+    _db().execute(
+        "INSERT INTO jobs (id, user_id, kind, state, max_attempts, owner, created_at, updated_at, heartbeat_at) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (job.id, user_id, kind, QUEUED, max_attempts, PROCESS_ID, now, now, now),
+    )
+    _queue.put_nowait(job)
+    logger.info(f"Queued {kind} job {job.id} for user {user_id[:10]} ({_queue.qsize()} waiting).")
+    return job.id
+
+async def shutdown():
+    """Cancels this process's workers; their unfinished jobs are marked failed."""
+    global _queue
+    for task in _tasks:
+        task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
+    _tasks.clear()
+    _queue = None
+    _db().execute(
+        f"UPDATE jobs SET state = ?, error = ?, updated_at = ? WHERE owner = ? AND state IN ({','.join('?' * len(UNFINISHED))})",
+        (FAILED, "The server restarted before this finished. Please try again.", time.time(), PROCESS_ID, *UNFINISHED),
+    )
+
+def job_queue_stats() -> dict:
+    return {
+        "workers": JOB_WORKERS if _queue is not None else 0,
+        "waiting": _queue.qsize() if _queue is not None else 0,
+        "running": _running,
+    }
@@ -0,0 +1,107 @@
+# services/log_sink.py
+# Logging setup. The services log through the standard `logging` module
+# (one logger per module, with levels); install() routes those records to
+# stdout. With LOG_FORMAT=json (the default) each record becomes one JSON
+# object tagged with the current trace id and span, so a request's log lines
+# can be joined with its timing summary. tracing's records (per-request
+# breakdowns, spans) go through emit(). LOG_FORMAT=text keeps plain lines
+# for local development.
+#
+# Handlers only put records on a queue; formatting and writing happen on a
+# background thread (logging's QueueListener), so logging on the event loop
+# never blocks on a slow stdout pipe.
+
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+
+from services import tracing
+
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+_trace_logger = logging.getLogger("tracing")
+_listener: logging.handlers.QueueListener | None = None
+
+
+class _TraceContext(logging.Filter):
+    """Tags records with the trace and span they were logged in. Runs in the
+    thread that logged, before the record is handed to the writer thread."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        trace_id = tracing.current_trace_id()
+        if trace_id:
+            record.trace_id = trace_id
+            record.span = tracing.current_span_name()
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Hand the record over as is: the writer thread formats the message
+        # and any traceback
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "pid": record.process,
+            "level": record.levelname.lower(),
+            "logger": record.name,
+        }
+        if getattr(record, "trace_id", None):
+            entry["trace_id"] = record.trace_id
+            entry["span"] = record.span
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        else:
+            entry["event"] = "log"
+            entry["msg"] = record.getMessage()
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields = getattr(record, "fields", None)
+        if fields:
+            record.msg = f"[{fields.get('event', 'log')}] " + " ".join(
+                f"{key}={value}" for key, value in fields.items() if key != "event"
+            )
+            record.args = None
+        return super().format(record)
+
+
+def emit(record: dict):
+    """Logs a structured record (one JSON object, or key=value text)."""
+    _trace_logger.info(record.get("event", "log"), extra={"fields": record})
+
+
+def install():
+    """Routes log records to stdout through a background writer (once per process)."""
+    global _listener
+    if _listener is not None:
+        return
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else TextFormatter())
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    handler = _QueueHandler(records)
+    handler.addFilter(_TraceContext())
+
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(handler)
+    _listener = logging.handlers.QueueListener(records, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
@@ -0,0 +1,164 @@
+# services/name_index.py
+# Per-user in-memory lookup structures over Drive item names.
+# Built once per index version (right after the index is saved, or lazily on
+# the first lookup in a worker that hasn't seen that version yet).
+
+import bisect
+import re
+import threading
+import unicodedata
+
+from services import drive_cache
+
+# Score of each match tier; within a tier shorter names rank first
+SCORE_EXACT = 1.0
+SCORE_CASEFOLD = 0.9
+SCORE_TOKEN = 0.75
+SCORE_PREFIX = 0.6
+SCORE_FUZZY = 0.45
+
+FUZZY_MAX_EDITS = 2
+FUZZY_MIN_TOKEN_LEN = 4  # Short tokens produce too many near-misses
+
+_TOKEN_RE = re.compile(r"[^\W_]+", re.UNICODE)
+
+
+def fold(text: str) -> str:
+    """Case- and accent-insensitive form used for every non-exact comparison."""
+    text = unicodedata.normalize("NFKD", text.casefold())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return " ".join(text.split())
+
+def tokenize(text: str) -> list[str]:
+    return _TOKEN_RE.findall(fold(text))
+
+def _deletes(token: str) -> set[str]:
+    return {token[:i] + token[i + 1:] for i in range(len(token))} | {token}
+
+def edit_distance(a: str, b: str, max_dist: int) -> int:
+    """Levenshtein distance, giving up (returning max_dist + 1) once it exceeds max_dist."""
+    if abs(len(a) - len(b)) > max_dist:
+        return max_dist + 1
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i] + [0] * len(b)
+        row_min = i
+        for j, cb in enumerate(b, 1):
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb))
+            row_min = min(row_min, cur[j])
+        if row_min > max_dist:
+            return max_dist + 1
+        prev = cur
+    return prev[-1]
+
+
+class NameIndex:
+    """Exact, casefolded, token/prefix and fuzzy (bounded edit distance) name lookups."""
+
+    def __init__(self, items: list[dict]):
+        self.items = items
+        self.exact: dict[str, list[int]] = {}
+        self.folded: dict[str, list[int]] = {}
+        self.tokens: dict[str, set[int]] = {}
+        self.token_count: list[int] = []
+        for pos, item in enumerate(items):
+            name = item.get("name") or ""
+            self.exact.setdefault(name, []).append(pos)
+            folded = fold(name)
+            self.folded.setdefault(folded, []).append(pos)
+            toks = set(_TOKEN_RE.findall(folded))
+            self.token_count.append(len(toks))
+            for tok in toks:
+                self.tokens.setdefault(tok, set()).add(pos)
+        self.sorted_tokens = sorted(self.tokens)
+        # Symmetric-delete index (one deletion) over the token vocabulary
+        self.deletes: dict[str, list[str]] = {}
+        for tok in self.sorted_tokens:
+            if len(tok) >= FUZZY_MIN_TOKEN_LEN:
+                for d in _deletes(tok):
+                    self.deletes.setdefault(d, []).append(tok)
+
+    def _prefix_tokens(self, prefix: str) -> list[str]:
+        start = bisect.bisect_left(self.sorted_tokens, prefix)
+        end = bisect.bisect_left(self.sorted_tokens, prefix + "\uffff")
+        return self.sorted_tokens[start:end]
+
+    def _fuzzy_tokens(self, token: str) -> list[str]:
+        if len(token) < FUZZY_MIN_TOKEN_LEN:
+            return []
+        candidates = set()
+        for d in _deletes(token):
+            candidates.update(self.deletes.get(d, ()))
+        return [c for c in candidates if edit_distance(token, c, FUZZY_MAX_EDITS) <= FUZZY_MAX_EDITS]
+
+    def _token_matches(self, token: str) -> dict[int, float]:
+        """Item positions matching one query token, with the best per-token score."""
+        scores: dict[int, float] = {}
+        for pos in self.tokens.get(token, ()):
+            scores[pos] = SCORE_TOKEN
+        for tok in self._prefix_tokens(token):
+            for pos in self.tokens[tok]:
+                scores.setdefault(pos, SCORE_PREFIX)
+        if not scores:
+            for tok in self._fuzzy_tokens(token):
+                for pos in self.tokens[tok]:
+                    scores.setdefault(pos, SCORE_FUZZY)
+        return scores
+
+    def search(self, query: str, limit: int = 5, mime_type: str | None = None) -> list[tuple[float, dict]]:
+        """Returns up to `limit` (score, item) candidates, best first."""
+        def allowed(pos: int) -> bool:
+            return not mime_type or self.items[pos].get("mimeType") == mime_type
+
+        scored: dict[int, float] = {}
+        for pos in self.exact.get(query, ()):
+            if allowed(pos):
+                scored[pos] = SCORE_EXACT
+        for pos in self.folded.get(fold(query), ()):
+            if allowed(pos):
+                scored.setdefault(pos, SCORE_CASEFOLD)
+
+        if not scored:
+            query_tokens = tokenize(query)
+            per_token = [self._token_matches(tok) for tok in query_tokens]
+            if per_token and all(per_token):
+                common = set.intersection(*(set(m) for m in per_token))
+                for pos in filter(allowed, common):
+                    score = sum(m[pos] for m in per_token) / len(per_token)
+                    # Penalise names with many extra words beyond the query
+                    coverage = len(query_tokens) / max(self.token_count[pos], len(query_tokens))
+                    scored[pos] = score * (0.8 + 0.2 * coverage)
+
+        results = [(score, self.items[pos]) for pos, score in scored.items()]
+        results.sort(key=lambda r: (-r[0], len(r[1].get("name") or "")))
+        return results[:limit]
+
+
+# --- Per-user registry ---
+_indexes: dict[str, tuple[float, NameIndex]] = {}
+_lock = threading.Lock()
+
+def build_name_index(user_id: str) -> NameIndex | None:
+    """(Re)builds the user's name index from the stored Drive index."""
+    version = drive_cache.updated_at(user_id)
+    items = drive_cache.load_index(user_id)
+    if version is None or items is None:
+        return None
+    index = NameIndex(items)
+    with _lock:
+        _indexes[user_id] = (version.timestamp(), index)
+    return index
+
+def get_name_index(user_id: str) -> NameIndex | None:
+    version = drive_cache.updated_at(user_id)
+    if version is None:
+        return None
+    with _lock:
+        entry = _indexes.get(user_id)
+    if entry and entry[0] == version.timestamp():
+        return entry[1]
+    return build_name_index(user_id)
+
+def search_names(user_id: str, query: str, limit: int = 5, mime_type: str | None = None) -> list[tuple[float, dict]]:
+    index = get_name_index(user_id)
+    return index.search(query, limit=limit, mime_type=mime_type) if index else []
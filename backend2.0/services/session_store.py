@@ -0,0 +1,246 @@
+# services/session_store.py
+# Conversation state that must survive across requests: pending multi-step
+# flows (create / move confirmations), chat histories and the active doc.
+#
+# With several gunicorn workers a follow-up request ("Yes") can land on a
+# different process than the one that asked the question, so state can't live
+# in module-level dicts. Two backends, picked by SESSION_STORE:
+#   "sqlite" (default) - one WAL-mode database shared by every worker on the host
+#   "memory"           - per-process dict, fine for a single dev worker
+# Values are JSON; every entry has a TTL and a size cap.
+
+import json
+import logging
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from services import chat_history, drive_cache, gemini_cache
+
+logger = logging.getLogger(__name__)
+
+SESSION_STORE = os.getenv("SESSION_STORE", "sqlite").lower()
+SESSION_DB_PATH = pathlib.Path(os.getenv("SESSION_DB", str(drive_cache.CACHE_DIR / "sessions.db")))
+
+PENDING_TTL = float(os.getenv("SESSION_PENDING_TTL", str(30 * 60)))
+HISTORY_TTL = float(os.getenv("SESSION_HISTORY_TTL", str(24 * 60 * 60)))
+# Per-user caps: serialized size of any one entry, and turns kept in a history
+MAX_VALUE_BYTES = int(os.getenv("SESSION_MAX_VALUE_BYTES", str(256 * 1024)))
+MAX_HISTORY_MESSAGES = int(os.getenv("SESSION_MAX_HISTORY_MESSAGES", "40"))
+# Memory backend only: total entries across all users (LRU beyond that)
+MEMORY_MAX_ENTRIES = int(os.getenv("SESSION_MEMORY_MAX_ENTRIES", "10000"))
+
+PENDING = "pending"
+HISTORY = "history"
+ACTIVE_DOC = "active_doc"
+
+
+class ValueTooLarge(ValueError):
+    pass
+
+
+def _encode(value) -> str:
+    data = json.dumps(value)
+    if len(data) > MAX_VALUE_BYTES:
+        raise ValueTooLarge(f"{len(data)} bytes exceeds the {MAX_VALUE_BYTES}-byte session entry cap")
+    return data
+
+def _state_of(data: str | None) -> str | None:
+    if data is None:
+        return None
+    value = json.loads(data)
+    return value.get("state") if isinstance(value, dict) else None
+
+
+class MemorySessionStore:
+    def __init__(self):
+        self._entries: "OrderedDict[tuple[str, str], tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _load(self, key: tuple[str, str]) -> str | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, data = entry
+        if expires_at < time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return data
+
+    def _store(self, key: tuple[str, str], data: str | None, ttl: float):
+        if data is None:
+            self._entries.pop(key, None)
+            return
+        self._entries[key] = (time.time() + ttl, data)
+        self._entries.move_to_end(key)
+        while len(self._entries) > MEMORY_MAX_ENTRIES:
+            self._entries.popitem(last=False)
+
+    def get(self, namespace: str, user_id: str):
+        with self._lock:
+            data = self._load((namespace, user_id))
+        return json.loads(data) if data is not None else None
+
+    def set(self, namespace: str, user_id: str, value, ttl: float):
+        data = _encode(value)
+        with self._lock:
+            self._store((namespace, user_id), data, ttl)
+
+    def delete(self, namespace: str, user_id: str):
+        with self._lock:
+            self._entries.pop((namespace, user_id), None)
+
+    def transition(self, namespace: str, user_id: str, expected_state: str, value, ttl: float) -> bool:
+        data = _encode(value) if value is not None else None
+        key = (namespace, user_id)
+        with self._lock:
+            if _state_of(self._load(key)) != expected_state:
+                return False
+            self._store(key, data, ttl)
+            return True
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    namespace  TEXT NOT NULL,
+    user_id    TEXT NOT NULL,
+    value      TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    PRIMARY KEY (namespace, user_id)
+);
+CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires_at);
+"""
+
+# Expired rows are swept at most this often (reads ignore them regardless)
+SWEEP_INTERVAL = 60.0
+
+class SQLiteSessionStore:
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        self._local = threading.local()
+        self._last_sweep = 0.0
+
+    def _db(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def _sweep(self, conn: sqlite3.Connection, now: float):
+        if now - self._last_sweep > SWEEP_INTERVAL:
+            self._last_sweep = now
+            conn.execute("DELETE FROM sessions WHERE expires_at < ?", (now,))
+
+    def _load(self, conn: sqlite3.Connection, namespace: str, user_id: str) -> str | None:
+        row = conn.execute(
+            "SELECT value FROM sessions WHERE namespace = ? AND user_id = ? AND expires_at >= ?",
+            (namespace, user_id, time.time()),
+        ).fetchone()
+        return row[0] if row else None
+
+    def _store(self, conn: sqlite3.Connection, namespace: str, user_id: str, data: str | None, ttl: float):
+        if data is None:
+            conn.execute("DELETE FROM sessions WHERE namespace = ? AND user_id = ?", (namespace, user_id))
+        else:
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (namespace, user_id, value, expires_at) VALUES (?, ?, ?, ?)",
+                (namespace, user_id, data, time.time() + ttl),
+            )
+
+    def get(self, namespace: str, user_id: str):
+        data = self._load(self._db(), namespace, user_id)
+        return json.loads(data) if data is not None else None
+
+    def set(self, namespace: str, user_id: str, value, ttl: float):
+        data = _encode(value)
+        conn = self._db()
+        self._store(conn, namespace, user_id, data, ttl)
+        self._sweep(conn, time.time())
+
+    def delete(self, namespace: str, user_id: str):
+        self._store(self._db(), namespace, user_id, None, 0)
+
+    def transition(self, namespace: str, user_id: str, expected_state: str, value, ttl: float) -> bool:
+        data = _encode(value) if value is not None else None
+        conn = self._db()
+        # IMMEDIATE takes the write lock up front, so no other worker can
+        # change the entry between our read and our write
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if _state_of(self._load(conn, namespace, user_id)) != expected_state:
+                conn.execute("ROLLBACK")
+                return False
+            self._store(conn, namespace, user_id, data, ttl)
+            conn.execute("COMMIT")
+            return True
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+
+def _create_store():
+    if SESSION_STORE == "memory":
+        return MemorySessionStore()
+    if SESSION_STORE != "sqlite":
+        logger.warning(f"Unknown SESSION_STORE '{SESSION_STORE}', using sqlite.")
+    return SQLiteSessionStore(SESSION_DB_PATH)
+
+store = _create_store()
+
+
+# --- Pending multi-step flows ---
+def get_pending(user_id: str) -> dict | None:
+    return store.get(PENDING, user_id)
+
+def set_pending(user_id: str, data: dict):
+    store.set(PENDING, user_id, data, PENDING_TTL)
+
+def clear_pending(user_id: str):
+    store.delete(PENDING, user_id)
+
+def transition_pending(user_id: str, from_state: str, data: dict | None) -> bool:
+    """Atomically replaces (or with None, clears) the pending flow, but only
+    if it is still in `from_state`. False means another request got there first."""
+    return store.transition(PENDING, user_id, from_state, data, PENDING_TTL)
+
+
+# --- Chat histories ---
+def _history_message(entry) -> dict:
+    """A Gemini Content (or an equivalent dict) as a plain {"role", "parts"} dict."""
+    role, parts = gemini_cache.content_parts(entry)
+    return {"role": role, "parts": parts}
+
+def get_history(user_id: str) -> list[dict]:
+    return store.get(HISTORY, user_id) or []
+
+def save_history(user_id: str, history: list):
+    """Stores the history compacted to its token budget (see chat_history),
+    dropping the oldest turns beyond the per-user caps."""
+    messages = [_history_message(entry) for entry in chat_history.compact(history)]
+    messages = messages[-MAX_HISTORY_MESSAGES:]
+    while messages:
+        try:
+            store.set(HISTORY, user_id, messages, HISTORY_TTL)
+            return
+        except ValueTooLarge:
+            messages = messages[2:]  # Drop the oldest user/model exchange
+    store.delete(HISTORY, user_id)
+
+
+# --- Active document ---
+def get_active_doc(user_id: str) -> str | None:
+    return store.get(ACTIVE_DOC, user_id)
+
+def set_active_doc(user_id: str, doc_id: str):
+    store.set(ACTIVE_DOC, user_id, doc_id, HISTORY_TTL)
+
+def clear_active_doc(user_id: str):
+    store.delete(ACTIVE_DOC, user_id)
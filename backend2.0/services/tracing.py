@@ -0,0 +1,282 @@
+# services/tracing.py
+# Per-request tracing and latency metrics.
+#
+# A span times one step: a Drive API call, a Gemini call, loading an index, a
+# phase of /ask. The current trace and span live in contextvars, so they
+# follow a request into every asyncio task it starts (tasks copy the context
+# when created) and into asyncio.to_thread calls. Each finished span feeds a
+# latency histogram, rendered by /metrics in Prometheus text format, and adds
+# to its trace's breakdown. The breakdown is logged as one record when the
+# request ends, so every request shows where its time went.
+#
+# Metrics are per process; with several gunicorn workers a scrape sees the
+# worker that served it.
+
+import contextvars
+import functools
+import inspect
+import os
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Callable
+
+# Also log every span, not just the per-request summary
+TRACE_LOG_SPANS = os.getenv("TRACE_LOG_SPANS", "false").lower() == "true"
+METRIC_PREFIX = "docupilot"
+# Histogram bucket bounds, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+class Trace:
+    def __init__(self, name: str, trace_id: str | None = None):
+        self.id = trace_id or uuid.uuid4().hex[:16]
+        self.name = name
+        self.attrs: dict = {}
+        self.failed = False  # Set for failures that didn't raise (e.g. a 5xx response)
+        self.breakdown: dict[str, list] = {}  # span name -> [count, total seconds]
+        self._lock = threading.Lock()
+
+    def add(self, name: str, seconds: float):
+        with self._lock:
+            entry = self.breakdown.setdefault(name, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+
+
+class Span:
+    def __init__(self, name: str, trace: Trace | None, parent: "Span | None", attrs: dict):
+        self.name = name
+        self.trace = trace
+        self.parent = parent
+        self.attrs = attrs
+        self.start = time.perf_counter()
+        self.error = False
+
+
+_trace: contextvars.ContextVar[Trace | None] = contextvars.ContextVar("trace", default=None)
+_span: contextvars.ContextVar[Span | None] = contextvars.ContextVar("span", default=None)
+
+def current_trace_id() -> str | None:
+    trace = _trace.get()
+    return trace.id if trace else None
+
+def current_span_name() -> str | None:
+    span = _span.get()
+    return span.name if span else None
+
+
+# --- Histograms ---
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float):
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+        self.count += 1
+        self.sum += seconds
+
+_histograms: dict[tuple[str, str], Histogram] = {}  # (span name, "ok" | "error")
+_metrics_lock = threading.Lock()
+
+def observe(name: str, seconds: float, error: bool = False):
+    key = (name, "error" if error else "ok")
+    with _metrics_lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+
+# --- Spans ---
+def _finish(span: Span):
+    seconds = time.perf_counter() - span.start
+    observe(span.name, seconds, span.error)
+    if span.trace:
+        span.trace.add(span.name, seconds)
+    if TRACE_LOG_SPANS:
+        _emit({"event": "span", "span": span.name, "duration_ms": round(seconds * 1000, 2),
+               "error": span.error, "parent": span.parent.name if span.parent else None, **span.attrs})
+
+@contextmanager
+def span(name: str, **attrs):
+    """Times the enclosed block as a child of the current span."""
+    current = Span(name, _trace.get(), _span.get(), attrs)
+    token = _span.set(current)
+    try:
+        yield current
+    except BaseException:
+        current.error = True
+        raise
+    finally:
+        _span.reset(token)
+        _finish(current)
+
+def traced(name: str):
+    """Decorator form of span(), for sync and async functions."""
+    def decorate(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+@contextmanager
+def start_trace(name: str, trace_id: str | None = None, **attrs):
+    """Root of a request: every span inside is added to its breakdown, which
+    is logged when the block exits. The root span is recorded under
+    `trace.name`, which the block may refine (e.g. with the matched route)."""
+    trace = Trace(name, trace_id)
+    trace.attrs.update(attrs)
+    root = Span(name, trace, _span.get(), {})
+    trace_token = _trace.set(trace)
+    span_token = _span.set(root)
+    try:
+        yield trace
+    except BaseException:
+        root.error = True
+        raise
+    finally:
+        _span.reset(span_token)
+        _trace.reset(trace_token)
+        root.name = trace.name
+        root.error = root.error or trace.failed
+        seconds = time.perf_counter() - root.start
+        _finish(root)
+        _emit({
+            "event": "request",
+            "trace_id": trace.id,
+            "name": trace.name,
+            "duration_ms": round(seconds * 1000, 2),
+            "error": root.error,
+            **trace.attrs,
+            "breakdown": {
+                name: {"count": count, "ms": round(total * 1000, 2)}
+                for name, (count, total) in sorted(trace.breakdown.items(), key=lambda e: -e[1][1])
+                if name != trace.name
+            },
+        })
+
+
+class Phases:
+    """Sequential phases of one flow (e.g. /ask's states), each timed as a
+    span `<prefix>.<phase>`. Entering a phase ends the previous one."""
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self._span: Span | None = None
+        self._token = None
+
+    def enter(self, phase: str):
+        self.close()
+        self._span = Span(f"{self.prefix}.{phase}", _trace.get(), _span.get(), {})
+        self._token = _span.set(self._span)
+
+    def fail(self):
+        if self._span:
+            self._span.error = True
+
+    def close(self):
+        if self._span is not None:
+            _span.reset(self._token)
+            _finish(self._span)
+            self._span = None
+
+
+def _emit(record: dict):
+    from services import log_sink  # log_sink tags records with the trace context from here
+    log_sink.emit(record)
+
+
+# --- Gauges from the services' own stats ---
+_collectors: dict[str, Callable[[], dict]] = {}
+
+def register_collector(prefix: str, collect: Callable[[], dict]):
+    """Exposes the numeric values of `collect()` as gauges `<prefix>_<key>`."""
+    _collectors[prefix] = collect
+
+
+# --- Prometheus text exposition ---
+def _label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def render_metrics() -> str:
+    metric = f"{METRIC_PREFIX}_span_duration_seconds"
+    lines = [
+        f"# HELP {metric} Duration of traced operations (requests, Drive and Gemini calls, /ask phases).",
+        f"# TYPE {metric} histogram",
+    ]
+    with _metrics_lock:
+        snapshot = {key: (list(h.buckets), h.count, h.sum) for key, h in _histograms.items()}
+    for (name, status), (buckets, count, total) in sorted(snapshot.items()):
+        labels = f'span="{_label(name)}",status="{status}"'
+        cumulative = 0
+        for bound, n in zip(BUCKETS, buckets):
+            cumulative += n
+            lines.append(f'{metric}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{metric}_bucket{{{labels},le="+Inf"}} {count}')
+        lines.append(f"{metric}_sum{{{labels}}} {total:.6f}")
+        lines.append(f"{metric}_count{{{labels}}} {count}")
+
+    for prefix, collect in sorted(_collectors.items()):
+        try:
+            values = collect()
+        except Exception as e:
+            lines.append(f"# {prefix} collector failed: {e}")
+            continue
+        for key, value in sorted(values.items()):
+            if isinstance(value, bool):
+                value = int(value)
+            if isinstance(value, (int, float)):
+                gauge = f"{METRIC_PREFIX}_{prefix}_{key}"
+                lines += [f"# TYPE {gauge} gauge", f"{gauge} {value}"]
+    return "\n".join(lines) + "\n"
+
+
+# --- ASGI middleware: one trace per HTTP request ---
+_REQUEST_ID_RE = re.compile(r"[A-Za-z0-9._-]{1,64}")
+
+class TracingMiddleware:
+    """Starts a trace per request (reusing an incoming X-Request-ID), tags it
+    with the matched route and status, and returns its id as X-Trace-Id."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        headers = dict(scope.get("headers") or [])
+        incoming = headers.get(b"x-request-id", b"").decode("latin-1")
+        if not _REQUEST_ID_RE.fullmatch(incoming):
+            incoming = None
+        with start_trace("http", trace_id=incoming) as trace:
+            async def send_with_trace(message):
+                if message["type"] == "http.response.start":
+                    trace.attrs["status"] = message["status"]
+                    trace.failed = message["status"] >= 500
+                    message["headers"] = [*message.get("headers", []), (b"x-trace-id", trace.id.encode())]
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_with_trace)
+            finally:
+                # The route template (not the raw path) keeps metric labels bounded
+                route = getattr(scope.get("route"), "path", None) or "unmatched"
+                trace.name = f"http {scope['method']} {route}"
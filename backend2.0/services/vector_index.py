@@ -0,0 +1,400 @@
+# services/vector_index.py
+# Per-user semantic index over document passages.
+#
+# Documents are split into ~EMBED_CHUNK_TOKENS passages; each passage's
+# vector lives in a memory-mapped float32 matrix (drive_cache/vectors/<user>/
+# vectors.f32) and its text and content hash in a SQLite table next to it.
+# Re-indexing a document only embeds passages whose hash is new; unchanged
+# ones keep their rows. The matrix is append-only (dead rows are compacted
+# away once they make up half of it), so rows never change meaning under a
+# reader in another worker.
+#
+# Search is exact below ANN_MIN_VECTORS passages. Above that an IVF index
+# (k-means centroids over the vectors) is kept per process: a query is
+# scored only against the passages in its ANN_PROBES nearest clusters.
+# Vectors added after the centroids were trained are assigned
+# incrementally; the centroids are retrained once the index doubles.
+
+import asyncio
+import hashlib
+import logging
+import os
+import pathlib
+import sqlite3
+import threading
+
+import numpy as np
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from services import drive_cache
+from services.embeddings import get_provider
+from services.fulltext_index import is_indexable
+from services.gemini_models import CHARS_PER_TOKEN
+
+logger = logging.getLogger(__name__)
+
+VECTOR_DIR = pathlib.Path(os.getenv("VECTOR_DIR", str(drive_cache.CACHE_DIR / "vectors")))
+
+EMBED_CHUNK_TOKENS = int(os.getenv("EMBED_CHUNK_TOKENS", "300"))
+EMBED_CHUNK_OVERLAP_TOKENS = int(os.getenv("EMBED_CHUNK_OVERLAP_TOKENS", "30"))
+ANN_MIN_VECTORS = int(os.getenv("ANN_MIN_VECTORS", "4096"))
+ANN_PROBES = int(os.getenv("ANN_PROBES", "8"))
+ANN_TRAIN_ITERATIONS = 8
+ANN_TRAIN_SAMPLE_PER_LIST = 40
+INITIAL_CAPACITY = 1024
+MAX_PASSAGES_PER_FILE = 2  # Keep results from being one document's passages only
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chunks (
+    row          INTEGER PRIMARY KEY,
+    file_id      TEXT NOT NULL,
+    chunk_no     INTEGER NOT NULL,
+    content_hash TEXT NOT NULL,
+    name         TEXT,
+    mime_type    TEXT,
+    text         TEXT NOT NULL,
+    live         INTEGER NOT NULL DEFAULT 1
+);
+CREATE INDEX IF NOT EXISTS chunks_file ON chunks (file_id, live);
+CREATE TABLE IF NOT EXISTS files (
+    file_id       TEXT PRIMARY KEY,
+    modified_time TEXT
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+_splitter = RecursiveCharacterTextSplitter(
+    chunk_size=EMBED_CHUNK_TOKENS * CHARS_PER_TOKEN,
+    chunk_overlap=EMBED_CHUNK_OVERLAP_TOKENS * CHARS_PER_TOKEN,
+    separators=["\n\n", "\n", ". ", " ", ""],
+)
+
+
+def _hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class IVFIndex:
+    """Inverted-file ANN index over rows of the vector matrix."""
+
+    def __init__(self, vectors: np.ndarray, rows: np.ndarray):
+        n = len(rows)
+        nlist = max(int(np.sqrt(n)), 1)
+        rng = np.random.default_rng(0)
+        sample = vectors[rng.choice(n, size=min(n, nlist * ANN_TRAIN_SAMPLE_PER_LIST), replace=False)]
+        centroids = sample[rng.choice(len(sample), size=nlist, replace=False)].copy()
+        for _ in range(ANN_TRAIN_ITERATIONS):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            for c in range(nlist):
+                members = sample[labels == c]
+                if len(members):
+                    centroid = members.mean(axis=0)
+                    centroids[c] = centroid / (np.linalg.norm(centroid) or 1.0)
+        self.centroids = centroids
+        self.trained_size = n
+        self.assignment = np.full(0, -1, dtype=np.int32)  # Cluster of each matrix row
+        self.assign(vectors, rows)
+
+    def assign(self, vectors: np.ndarray, rows: np.ndarray):
+        if len(rows) == 0:
+            return
+        if rows.max() >= len(self.assignment):
+            grown = np.full(rows.max() + 1, -1, dtype=np.int32)
+            grown[:len(self.assignment)] = self.assignment
+            self.assignment = grown
+        self.assignment[rows] = np.argmax(vectors @ self.centroids.T, axis=1)
+
+    def candidates(self, query: np.ndarray, live_rows: np.ndarray) -> np.ndarray:
+        probes = np.argsort(-(self.centroids @ query))[:ANN_PROBES]
+        return live_rows[np.isin(self.assignment[live_rows], probes)]
+
+
+class VectorStore:
+    def __init__(self, user_id: str):
+        self.provider = get_provider()
+        self.dir = VECTOR_DIR / hashlib.sha1(user_id.encode()).hexdigest()[:16]
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.matrix_path = self.dir / "vectors.f32"
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._matrix: np.memmap | None = None
+        self._matrix_epoch = None
+        self._ann: IVFIndex | None = None
+        self._ann_state = None  # (epoch, version) the ANN index reflects
+        self._check_provider()
+
+    # --- storage ---
+    def _db(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.dir / "chunks.db", timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def _meta(self, key: str, default: str | None = None) -> str | None:
+        row = self._db().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def _set_meta(self, conn: sqlite3.Connection, key: str, value):
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def _bump_version(self, conn: sqlite3.Connection):
+        conn.execute(
+            "INSERT INTO meta (key, value) VALUES ('version', '1') "
+            "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1"
+        )
+
+    def _check_provider(self):
+        """Vectors from a different provider/dimension are useless: start over."""
+        if self._meta("provider") == self.provider.name:
+            return
+        conn = self._db()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if self._meta("provider") == self.provider.name:  # Another worker got here first
+                conn.execute("COMMIT")
+                return
+            conn.execute("DELETE FROM chunks")
+            conn.execute("DELETE FROM files")
+            self.matrix_path.unlink(missing_ok=True)
+            self._set_meta(conn, "provider", self.provider.name)
+            self._set_meta(conn, "epoch", int(self._meta("epoch", "0")) + 1)
+            self._bump_version(conn)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _open_matrix(self, min_rows: int, writable: bool = False) -> np.memmap:
+        """The vector matrix, grown on disk (doubling) to hold at least `min_rows`."""
+        epoch = self._meta("epoch", "0")
+        row_bytes = self.provider.dim * 4
+        size = self.matrix_path.stat().st_size if self.matrix_path.exists() else 0
+        if writable and size < min_rows * row_bytes:
+            capacity = max(INITIAL_CAPACITY, size // row_bytes)
+            while capacity < min_rows:
+                capacity *= 2
+            with open(self.matrix_path, "ab") as f:
+                f.truncate(capacity * row_bytes)
+            size = capacity * row_bytes
+        if (self._matrix is None or self._matrix_epoch != epoch or len(self._matrix) < min_rows
+                or (writable and self._matrix.mode != "r+")):
+            if size == 0:
+                return np.zeros((0, self.provider.dim), dtype=np.float32)
+            self._matrix = np.memmap(self.matrix_path, dtype=np.float32, mode="r+" if writable else "r",
+                                     shape=(size // row_bytes, self.provider.dim))
+            self._matrix_epoch = epoch
+        return self._matrix
+
+    # --- indexing ---
+    def _plan(self, docs: list[tuple[dict, str]]):
+        """Splits each document and sorts its passages into kept (same hash),
+        new (to embed) and stale (no longer present) ones."""
+        conn = self._db()
+        new_chunks: list[tuple[dict, int, str, str]] = []  # (item, chunk_no, hash, text)
+        kept: list[tuple[int, int, dict]] = []               # (row, chunk_no, item)
+        stale_rows: list[int] = []
+        for item, text in docs:
+            chunks = _splitter.split_text(text) if text else []
+            existing = dict(conn.execute(
+                "SELECT content_hash, row FROM chunks WHERE file_id = ? AND live = 1", (item["id"],)
+            ).fetchall())
+            wanted = set()
+            for chunk_no, chunk in enumerate(chunks):
+                content_hash = _hash(chunk)
+                if content_hash in wanted:
+                    continue  # Repeated passage (boilerplate); one vector is enough
+                wanted.add(content_hash)
+                if content_hash in existing:
+                    kept.append((existing[content_hash], chunk_no, item))
+                else:
+                    new_chunks.append((item, chunk_no, content_hash, chunk))
+            stale_rows += [row for content_hash, row in existing.items() if content_hash not in wanted]
+        return new_chunks, kept, stale_rows
+
+    def _write(self, docs, new_chunks, kept, stale_rows, vectors):
+        conn = self._db()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany("INSERT OR REPLACE INTO files (file_id, modified_time) VALUES (?, ?)",
+                             [(item["id"], item.get("modifiedTime")) for item, _ in docs])
+            conn.executemany("UPDATE chunks SET chunk_no = ?, name = ? WHERE row = ?",
+                             [(chunk_no, item.get("name"), row) for row, chunk_no, item in kept])
+            conn.executemany("UPDATE chunks SET live = 0 WHERE row = ?", [(row,) for row in stale_rows])
+            if new_chunks:
+                # Rows are allocated and their vectors written inside the write
+                # transaction, so other workers never see a row without its vector
+                start = conn.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM chunks").fetchone()[0]
+                with self._lock:
+                    matrix = self._open_matrix(start + len(new_chunks), writable=True)
+                    matrix[start:start + len(new_chunks)] = vectors
+                    matrix.flush()
+                conn.executemany(
+                    "INSERT INTO chunks (row, file_id, chunk_no, content_hash, name, mime_type, text) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(start + i, item["id"], chunk_no, content_hash, item.get("name"), item.get("mimeType"), chunk)
+                     for i, (item, chunk_no, content_hash, chunk) in enumerate(new_chunks)],
+                )
+            if new_chunks or stale_rows:
+                self._bump_version(conn)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self._maybe_compact()
+
+    async def update_documents(self, docs: list[tuple[dict, str]]) -> int:
+        """Indexes (item, text) pairs; returns the number of passages embedded."""
+        new_chunks, kept, stale_rows = await asyncio.to_thread(self._plan, docs)
+        vectors = await self.provider.embed([chunk[3] for chunk in new_chunks]) if new_chunks else None
+        await asyncio.to_thread(self._write, docs, new_chunks, kept, stale_rows, vectors)
+        return len(new_chunks)
+
+    def remove_documents(self, file_ids: list[str]):
+        if not file_ids:
+            return
+        conn = self._db()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany("UPDATE chunks SET live = 0 WHERE file_id = ?", [(f,) for f in file_ids])
+            conn.executemany("DELETE FROM files WHERE file_id = ?", [(f,) for f in file_ids])
+            self._bump_version(conn)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self._maybe_compact()
+
+    def _maybe_compact(self):
+        """Rewrites the matrix without dead rows once they are half of it."""
+        conn = self._db()
+        total, live = conn.execute("SELECT COUNT(*), COALESCE(SUM(live), 0) FROM chunks").fetchone()
+        if total < INITIAL_CAPACITY or live * 2 > total:
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = [r for (r,) in conn.execute("SELECT row FROM chunks WHERE live = 1 ORDER BY row")]
+            conn.execute("DELETE FROM chunks WHERE live = 0")
+            # Ascending order: each target row is free by the time it's written
+            conn.executemany("UPDATE chunks SET row = ? WHERE row = ?", [(i, row) for i, row in enumerate(rows) if i != row])
+            self._set_meta(conn, "epoch", int(self._meta("epoch", "0")) + 1)
+            self._bump_version(conn)
+            with self._lock:
+                old = self._open_matrix(rows[-1] + 1 if rows else 0)
+                tmp = self.matrix_path.with_suffix(".tmp")
+                capacity = max(INITIAL_CAPACITY, len(rows) * 2)
+                compacted = np.memmap(tmp, dtype=np.float32, mode="w+", shape=(capacity, self.provider.dim))
+                if rows:
+                    compacted[:len(rows)] = old[rows]
+                compacted.flush()
+                del compacted
+                # Swapped in last, so a failure above leaves both file and table as they were
+                tmp.replace(self.matrix_path)
+                self._matrix = None
+            conn.execute("COMMIT")
+            logger.info(f"Compacted vector index {self.dir.name}: {total} -> {len(rows)} rows.")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    # --- search ---
+    def _live_rows(self) -> np.ndarray:
+        rows = self._db().execute("SELECT row FROM chunks WHERE live = 1 ORDER BY row").fetchall()
+        return np.fromiter((r for (r,) in rows), dtype=np.int64, count=len(rows))
+
+    def _candidates(self, query: np.ndarray, live_rows: np.ndarray, matrix: np.ndarray) -> np.ndarray:
+        if len(live_rows) < ANN_MIN_VECTORS:
+            return live_rows
+        with self._lock:
+            state = (self._meta("epoch"), self._meta("version"))
+            if self._ann is None or self._ann_state[0] != state[0] or len(live_rows) > 2 * self._ann.trained_size:
+                self._ann = IVFIndex(np.asarray(matrix[live_rows]), live_rows)
+            elif self._ann_state != state:
+                known = np.full(int(live_rows[-1]) + 1, -1, dtype=np.int32)
+                overlap = min(len(known), len(self._ann.assignment))
+                known[:overlap] = self._ann.assignment[:overlap]
+                unassigned = live_rows[known[live_rows] < 0]
+                self._ann.assign(np.asarray(matrix[unassigned]), unassigned)
+            self._ann_state = state
+            return self._ann.candidates(query, live_rows)
+
+    def _score(self, query_vector: np.ndarray, k: int) -> list[dict]:
+        live_rows = self._live_rows()
+        if len(live_rows) == 0:
+            return []
+        with self._lock:
+            matrix = self._open_matrix(int(live_rows[-1]) + 1)
+        candidates = self._candidates(query_vector, live_rows, matrix)
+        scores = np.asarray(matrix[candidates]) @ query_vector
+        order = np.argsort(-scores)
+
+        conn = self._db()
+        results, per_file = [], {}
+        for i in order:
+            hit = conn.execute(
+                "SELECT file_id, name, mime_type, chunk_no, text FROM chunks WHERE row = ? AND live = 1",
+                (int(candidates[i]),),
+            ).fetchone()
+            if not hit:
+                continue
+            file_id, name, mime_type, chunk_no, text = hit
+            if per_file.get(file_id, 0) >= MAX_PASSAGES_PER_FILE:
+                continue
+            per_file[file_id] = per_file.get(file_id, 0) + 1
+            results.append({"id": file_id, "name": name, "mimeType": mime_type, "chunk": chunk_no,
+                            "text": text, "score": float(scores[i])})
+            if len(results) >= k:
+                break
+        return results
+
+    def indexed_versions(self) -> dict[str, str | None]:
+        return dict(self._db().execute("SELECT file_id, modified_time FROM files"))
+
+    def passage_count(self) -> int:
+        return self._db().execute("SELECT COUNT(*) FROM chunks WHERE live = 1").fetchone()[0]
+
+    async def search(self, query: str, k: int = 5) -> list[dict]:
+        if await asyncio.to_thread(self.passage_count) == 0:
+            return []
+        query_vector = (await self.provider.embed([query], is_query=True))[0]
+        return await asyncio.to_thread(self._score, query_vector, k)
+
+
+# --- Per-user registry ---
+_stores: dict[str, VectorStore] = {}
+_stores_lock = threading.Lock()
+
+def get_store(user_id: str) -> VectorStore:
+    with _stores_lock:
+        store = _stores.get(user_id)
+        if store is None:
+            store = _stores[user_id] = VectorStore(user_id)
+        return store
+
+async def update_documents(user_id: str, docs: list[tuple[dict, str]]) -> int:
+    return await get_store(user_id).update_documents(docs)
+
+def stale_items(user_id: str, items: list[dict]) -> tuple[list[dict], list[str]]:
+    """(items to (re)embed, file ids to drop), like fulltext_index.stale_items.
+    Tracked separately so a new store (or a provider change) backfills."""
+    indexed = get_store(user_id).indexed_versions()
+    current = {item["id"]: item for item in items if is_indexable(item.get("mimeType"))}
+    to_index = [item for file_id, item in current.items() if indexed.get(file_id, "") != item.get("modifiedTime")]
+    to_drop = [file_id for file_id in indexed if file_id not in current]
+    return to_index, to_drop
+
+def remove_documents(user_id: str, file_ids: list[str]):
+    get_store(user_id).remove_documents(file_ids)
+
+async def search_passages(user_id: str, query: str, k: int = 5) -> list[dict]:
+    """Top-k passages across the user's whole Drive, at most MAX_PASSAGES_PER_FILE per document."""
+    try:
+        return await get_store(user_id).search(query, k)
+    except Exception as e:
+        logger.error(f"Passage search failed for user {user_id}: {e}")
+        return []
@@ -0,0 +1,30 @@
+# tests/test_analyze_service.py
+# Run from backend2.0: python -m pytest -q
+
+from services.analyze_service import restore_spacing, split_document
+
+DOCUMENT = (
+    "Quarterly report\n\n"
+    "Revenue grew 12% over the quarter. Costs were flat.  Margins improved.\n"
+    "  Indented line with trailing spaces   \n\n\n"
+    + "A long paragraph of words that has to be split on spaces. " * 40
+    + "\n\n\tTabbed closing line.\n"
+)
+
+
+def test_split_document_round_trips():
+    chunks = split_document(DOCUMENT, chunk_tokens=50)
+    assert len(chunks) > 1
+    assert "".join(chunks) == DOCUMENT
+
+
+def test_unchanged_edit_is_byte_identical():
+    chunks = split_document(DOCUMENT, chunk_tokens=50)
+    # The model's answer comes back stripped
+    edited = [chunk.strip() for chunk in chunks]
+    assert "".join(restore_spacing(c, e) for c, e in zip(chunks, edited)) == DOCUMENT
+
+
+def test_restore_spacing_keeps_separators_around_edits():
+    assert restore_spacing("\n  Old text.\n\n", "New text.") == "\n  New text.\n\n"
+    assert restore_spacing(" \n", "") == " \n"
@@ -0,0 +1,46 @@
+# tests/test_content_indexing.py
+# Run from backend2.0: python -m pytest -q
+
+import asyncio
+import os
+
+# google_service builds the LangChain doc-generation LLM at import, which
+# needs a key (nothing is called with it here)
+os.environ.setdefault("GEMINI_API_KEY", "test-key")
+
+from services import fulltext_index, google_service, vector_index  # noqa: E402
+from services.embeddings import HashingEmbeddingProvider  # noqa: E402
+
+DOC = "application/vnd.google-apps.document"
+
+
+class FailingEmbeddingProvider(HashingEmbeddingProvider):
+    async def embed(self, texts, is_query=False):
+        raise RuntimeError("embedding service unavailable")
+
+
+def test_fulltext_indexes_documents_when_embedding_fails(tmp_path, monkeypatch):
+    items = [
+        {"id": "doc-1", "name": "Q3 budget", "mimeType": DOC, "modifiedTime": "1"},
+        {"id": "doc-2", "name": "Team offsite", "mimeType": DOC, "modifiedTime": "1"},
+    ]
+    texts = {"doc-1": "The quarterly budget covers travel.", "doc-2": "The offsite is in Lisbon."}
+
+    async def export_text(service, item, user_id):
+        return texts[item["id"]]
+
+    monkeypatch.setattr(fulltext_index, "FULLTEXT_DIR", tmp_path)
+    monkeypatch.setattr(vector_index, "VECTOR_DIR", tmp_path / "vectors")
+    monkeypatch.setattr(vector_index, "get_provider", lambda: FailingEmbeddingProvider(dim=16))
+    monkeypatch.setattr(vector_index, "_stores", {})
+    monkeypatch.setattr(google_service.drive_cache, "load_index", lambda user_id: items)
+    monkeypatch.setattr(google_service, "_export_text", export_text)
+    monkeypatch.setattr(google_service.drive_client, "get_service", lambda *args, **kwargs: None)
+
+    asyncio.run(google_service.index_document_contents("user-fts", creds=None))
+
+    assert [r["id"] for r in fulltext_index.search_documents("user-fts", "Lisbon")] == ["doc-2"]
+    assert fulltext_index.stale_items("user-fts", items) == ([], [])
+    # The embeddings are still owed, so the next pass retries them
+    to_embed, _ = vector_index.stale_items("user-fts", items)
+    assert {item["id"] for item in to_embed} == {"doc-1", "doc-2"}
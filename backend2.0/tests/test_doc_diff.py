@@ -0,0 +1,166 @@
+# tests/test_doc_diff.py
+# Run from backend2.0: python -m pytest -q
+
+import random
+
+import pytest
+
+from services import doc_diff
+
+IMAGE = object()  # An inline object: takes one index, has no text
+
+
+def make_document(*paragraphs) -> dict:
+    """A Docs API document; each paragraph is a list of strings and IMAGEs."""
+    content = [{"endIndex": 1, "sectionBreak": {}}]
+    index = 1
+    for parts in paragraphs:
+        start, elements = index, []
+        for part in parts:
+            if part is IMAGE:
+                elements.append({"startIndex": index, "endIndex": index + 1, "inlineObjectElement": {}})
+                index += 1
+            else:
+                end = index + sum(doc_diff._utf16_len(ch) for ch in part)
+                elements.append({"startIndex": index, "endIndex": end, "textRun": {"content": part}})
+                index = end
+        content.append({"startIndex": start, "endIndex": index, "paragraph": {"elements": elements}})
+    return {"body": {"content": content}}
+
+def text_document(text: str, image_at: int | None = None) -> dict:
+    """One paragraph per line of `text`, optionally with an image before `image_at`."""
+    paragraphs, offset = [], 0
+    for line in text.splitlines(keepends=True):
+        parts = [line]
+        if image_at is not None and offset <= image_at < offset + len(line):
+            cut = image_at - offset
+            parts = [p for p in (line[:cut], IMAGE, line[cut:]) if p != ""]
+        paragraphs.append(parts)
+        offset += len(line)
+    return make_document(*paragraphs)
+
+
+def body_cells(document: dict) -> list:
+    """One cell per document index from 1: a character, "" for the low
+    surrogate of a pair, or IMAGE."""
+    cells = []
+    for element in document["body"]["content"]:
+        for part in element.get("paragraph", {}).get("elements", []):
+            if "textRun" in part:
+                for ch in part["textRun"]["content"]:
+                    cells += [ch, ""] if doc_diff._utf16_len(ch) == 2 else [ch]
+            else:
+                cells.append(IMAGE)
+    return cells
+
+def apply_requests(document: dict, requests: list[dict]) -> list:
+    """Runs the requests in order, the way the Docs API would."""
+    cells = body_cells(document)
+    for request in requests:
+        if "deleteContentRange" in request:
+            r = request["deleteContentRange"]["range"]
+            start, end = r["startIndex"] - 1, r["endIndex"] - 1
+            assert 0 <= start < end < len(cells), "deletes the final newline or runs past the body"
+            assert cells[start] != "" and (end == len(cells) or cells[end] != ""), "splits a surrogate pair"
+            del cells[start:end]
+        else:
+            insert = request["insertText"]
+            at = insert["location"]["index"] - 1
+            assert 0 <= at < len(cells), "inserts after the final newline"
+            assert cells[at] != "", "inserts inside a surrogate pair"
+            new = []
+            for ch in insert["text"]:
+                new += [ch, ""] if doc_diff._utf16_len(ch) == 2 else [ch]
+            cells[at:at] = new
+    return cells
+
+def text_of(cells: list) -> str:
+    return "".join(c for c in cells if c is not IMAGE)
+
+
+def check(document: dict, new_text: str) -> list[dict]:
+    requests = doc_diff.build_requests(document, new_text)
+    cells = apply_requests(document, requests)
+    expected = new_text if new_text.endswith("\n") else new_text + "\n"
+    assert text_of(cells) == expected
+    return requests
+
+
+def test_unchanged_text_needs_no_requests():
+    assert check(text_document("Alpha\nBeta\n"), "Alpha\nBeta\n") == []
+
+def test_insertions():
+    old = "Budget\nTravel plan\n"
+    requests = check(text_document(old), "Q3 Budget\nTravel plan for March\nHiring\n")
+    assert all("insertText" in r for r in requests)
+    # Appending goes in front of the body's final newline
+    check(text_document(old), old + "Appendix\n")
+    check(text_document(old), "Intro\n" + old)
+
+def test_deletions():
+    old = "Keep this\nDrop this line\nAnd keep this one too\n"
+    requests = check(text_document(old), "Keep this\nAnd keep this one\n")
+    assert all("deleteContentRange" in r for r in requests)
+    check(text_document(old), "")
+    check(text_document(old), "Keep this")
+
+def test_small_edit_touches_only_the_changed_text():
+    old = "".join(f"Line {i} of the report.\n" for i in range(200))
+    new = old.replace("Line 120 of", "Line 120 from")
+    requests = check(text_document(old), new)
+    inserted = sum(len(r["insertText"]["text"]) for r in requests if "insertText" in r)
+    deleted = sum(r["deleteContentRange"]["range"]["endIndex"] - r["deleteContentRange"]["range"]["startIndex"]
+                  for r in requests if "deleteContentRange" in r)
+    assert inserted <= len("from") and deleted <= len("of")
+
+def test_unicode_uses_utf16_indices():
+    old = "Café ☕ plans 🎉🎉\nTeam 👩‍💻 notes\nEnd 𝔘𝔫𝔦𝔠𝔬𝔡𝔢\n"
+    check(text_document(old), "Café ☕ plans 🎉\nTeam 👩‍💻 notes 🚀\nEnd 𝔘𝔫𝔦𝔠𝔬𝔡𝔢!\n")
+    check(text_document(old), old.replace("🎉🎉", "🎊"))
+    check(text_document(old), "🌍" + old)
+    check(text_document("plain\n"), "plain 😀 text\n")
+
+def test_edits_around_an_inline_image():
+    old = "Before the picture and after it\nNext line\n"
+    document = text_document(old, image_at=old.index("and"))
+    check(document, "Before a picture and then after it\nNext\n")
+    # Deleting across the image removes the text on both sides of it, not the image
+    requests = check(document, "Before it\nNext line\n")
+    assert IMAGE in apply_requests(document, requests)
+
+def test_large_changed_block_is_replaced_whole(monkeypatch):
+    monkeypatch.setattr(doc_diff, "DOC_DIFF_MAX_CHAR_BLOCK", 10)
+    old = "Header\nThe first draft of this paragraph\nFooter\n"
+    new = "Header\nThe second draft of that paragraph\nFooter\n"
+    requests = check(text_document(old), new)
+    assert requests == [
+        {"deleteContentRange": {"range": {"startIndex": 8, "endIndex": 8 + len("The first draft of this paragraph\n")}}},
+        {"insertText": {"location": {"index": 8}, "text": "The second draft of that paragraph\n"}},
+    ]
+
+def test_unsupported_documents_raise():
+    document = text_document("Intro\n")
+    document["body"]["content"].append({"startIndex": 7, "endIndex": 20, "table": {}})
+    with pytest.raises(doc_diff.UnsupportedDocument):
+        doc_diff.build_requests(document, "Intro\n")
+
+def test_too_many_edits_raise(monkeypatch):
+    monkeypatch.setattr(doc_diff, "DOC_DIFF_MAX_OPS", 3)
+    old = "".join(f"row {i}\n" for i in range(10))
+    with pytest.raises(doc_diff.UnsupportedDocument):
+        doc_diff.build_requests(text_document(old), old.replace("row", "Row"))
+
+def test_random_edits_produce_the_target_text():
+    rng = random.Random(14)
+    alphabet = "abc d\n\né🎉"
+    for _ in range(1000):
+        old = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 40))) + "\n"
+        new = list(old[:-1])
+        for _ in range(rng.randint(0, 5)):
+            at = rng.randint(0, len(new))
+            if new and rng.random() < 0.5:
+                del new[at:at + rng.randint(1, 4)]
+            else:
+                new[at:at] = rng.choice(alphabet) * rng.randint(1, 3)
+        image_at = rng.randrange(len(old)) if rng.random() < 0.3 else None
+        check(text_document(old, image_at=image_at), "".join(new))
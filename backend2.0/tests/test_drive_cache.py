@@ -0,0 +1,196 @@
+# tests/test_drive_cache.py
+# Run from backend2.0: python -m pytest -q
+
+import asyncio
+import os
+import threading
+from collections import OrderedDict
+
+import pytest
+
+# google_service builds the LangChain doc-generation LLM at import, which
+# needs a key (nothing is called with it here)
+os.environ.setdefault("GEMINI_API_KEY", "test-key")
+
+from services import drive_cache, google_service  # noqa: E402
+
+FOLDER = "application/vnd.google-apps.folder"
+DOC = "application/vnd.google-apps.document"
+
+
+@pytest.fixture(autouse=True)
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(drive_cache, "DB_PATH", tmp_path / "drive_index.db")
+    monkeypatch.setattr(drive_cache, "CACHE_DIR", tmp_path)
+    monkeypatch.setattr(drive_cache, "_local", threading.local())
+    monkeypatch.setattr(drive_cache, "_index_cache", OrderedDict())
+    monkeypatch.setattr(drive_cache, "_index_cache_items", 0)
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(drive_cache, "_now", lambda: now[0])
+    return now
+
+
+def item(item_id: str, parent: str, path: str, mime_type: str = DOC) -> dict:
+    return {"id": item_id, "name": path.rsplit("/", 1)[-1], "mimeType": mime_type, "parents": [parent], "path": path}
+
+
+def test_checkpoints_accumulate_items_and_frontier(clock):
+    crawl = drive_cache.start_crawl("u1", "worker-a", "token-1", "root-id")
+    assert crawl["frontier"] == [("root", "")] and crawl["items_found"] == 0
+    assert drive_cache.load_index("u1") == []
+    # Only one crawl per user
+    assert drive_cache.start_crawl("u1", "worker-b", "token-2", "root-id") is None
+
+    clock[0] += 5
+    assert drive_cache.checkpoint_crawl("u1", "worker-a", [item("A", "root-id", "A", FOLDER), item("d1", "root-id", "d1")],
+                                        [("A", "A")], folders_done=1)
+    clock[0] += 5
+    assert drive_cache.checkpoint_crawl("u1", "worker-a", [item("d2", "A", "A/d2")], [], folders_done=1)
+
+    crawl = drive_cache.load_crawl("u1")
+    assert crawl["frontier"] == [] and crawl["folders_done"] == 2 and crawl["items_found"] == 3
+    assert crawl["checkpoint_at"] - crawl["started_at"] == 10
+    # The partial index is usable while the crawl runs
+    assert [(i["id"], i["path"]) for i in drive_cache.load_index("u1")] == [("A", "A"), ("d1", "d1"), ("d2", "A/d2")]
+    assert drive_cache.load_sync_state("u1") is None
+
+    assert drive_cache.finish_crawl("u1", "worker-a")
+    assert drive_cache.load_crawl("u1") is None
+    assert drive_cache.load_sync_state("u1")["page_token"] == "token-1"
+
+def test_abandoned_crawl_is_resumed_from_its_frontier(clock):
+    drive_cache.start_crawl("u1", "worker-a", "token-1", "root-id")
+    drive_cache.checkpoint_crawl("u1", "worker-a", [item("A", "root-id", "A", FOLDER), item("B", "root-id", "B", FOLDER)],
+                                 [("A", "A"), ("B", "B")], folders_done=1)
+
+    # Still within the lease: the crawl belongs to worker-a
+    clock[0] += 60
+    assert drive_cache.claim_crawl("u1", "worker-b", lease_seconds=120) is None
+    # Its owner may always reclaim it (e.g. after its own task was cancelled)
+    assert drive_cache.claim_crawl("u1", "worker-a", lease_seconds=120)["owner"] == "worker-a"
+
+    clock[0] += 121
+    crawl = drive_cache.claim_crawl("u1", "worker-b", lease_seconds=120)
+    assert crawl["owner"] == "worker-b"
+    assert crawl["frontier"] == [("A", "A"), ("B", "B")] and crawl["folders_done"] == 1
+
+    # The old owner woke up: its progress is refused and changes nothing
+    assert not drive_cache.checkpoint_crawl("u1", "worker-a", [item("x", "A", "A/x")], [("B", "B")], folders_done=1)
+    assert not drive_cache.finish_crawl("u1", "worker-a")
+    assert drive_cache.load_crawl("u1")["frontier"] == [("A", "A"), ("B", "B")]
+    assert {i["id"] for i in drive_cache.load_index("u1")} == {"A", "B"}
+
+    assert drive_cache.checkpoint_crawl("u1", "worker-b", [item("a1", "A", "A/a1"), item("b1", "B", "B/b1")], [],
+                                        folders_done=2)
+    assert drive_cache.finish_crawl("u1", "worker-b")
+    assert {i["id"] for i in drive_cache.load_index("u1")} == {"A", "B", "a1", "b1"}
+
+def test_aload_index_reads_off_the_event_loop(monkeypatch):
+    drive_cache.save_index("u1", [item("d1", "root-id", "d1")])
+    threads = []
+    load_index = drive_cache.load_index
+
+    def recording_load_index(user_id):
+        threads.append(threading.current_thread())
+        return load_index(user_id)
+
+    monkeypatch.setattr(drive_cache, "load_index", recording_load_index)
+    assert asyncio.run(drive_cache.aload_index("u1")) == load_index("u1")
+    assert asyncio.run(drive_cache.aload_index("nobody")) is None
+    assert threading.main_thread() not in threads
+
+
+# --- End to end: crawl_drive_tree interrupted, then resumed from the saved frontier ---
+class FakeDrive:
+    """files().list over an in-memory tree, two items per page."""
+
+    PAGE_SIZE = 2
+
+    def __init__(self, tree: dict[str, list[dict]]):
+        self.tree = tree
+        self.listed: list[str] = []
+
+    def files(self):
+        return self
+
+    def list(self, q: str, pageToken: str | None = None, **kwargs):
+        return {"folder": q.split("'")[1], "offset": int(pageToken or 0)}
+
+    async def aexecute(self, request):
+        await asyncio.sleep(0)
+        folder, offset = request["folder"], request["offset"]
+        if offset == 0:
+            self.listed.append(folder)
+        children = self.tree.get(folder, [])
+        page = [dict(f) for f in children[offset:offset + self.PAGE_SIZE]]
+        more = offset + self.PAGE_SIZE < len(children)
+        return {"files": page, "nextPageToken": str(offset + self.PAGE_SIZE) if more else None}
+
+def make_tree(depth: int = 3, fanout: int = 3) -> dict[str, list[dict]]:
+    tree = {}
+
+    def fill(folder_id: str, level: int):
+        children = tree[folder_id] = []
+        for n in range(fanout):
+            child = f"{folder_id}.{n}" if folder_id != "root" else str(n)
+            is_folder = level < depth and n != fanout - 1
+            children.append({"id": child, "name": f"item {child}", "mimeType": FOLDER if is_folder else DOC,
+                             "parents": [folder_id]})
+            if is_folder:
+                fill(child, level + 1)
+    fill("root", 1)
+    return tree
+
+@pytest.fixture
+def drive(monkeypatch):
+    fake = FakeDrive(make_tree())
+    monkeypatch.setattr(google_service.drive_client, "get_service", lambda *args, **kwargs: fake)
+    monkeypatch.setattr(google_service.drive_client, "aexecute", fake.aexecute)
+    monkeypatch.setattr(google_service, "get_rate_limiter", lambda user_id: google_service.RateLimiter(1e6))
+    # Checkpoint after every folder
+    monkeypatch.setattr(google_service, "CRAWL_CHECKPOINT_SECONDS", 0)
+    return fake
+
+
+def test_interrupted_crawl_resumes_without_relisting_finished_folders(drive, clock):
+    expected = asyncio.run(google_service.crawl_drive_tree(None, max_concurrency=3))
+    folder_count = len(drive.tree)
+    drive.listed.clear()
+
+    drive_cache.start_crawl("u1", "worker-a", "token-1", "root-id")
+    checkpoints = []
+
+    def checkpoint_then_die(items, frontier, folders_done):
+        # The worker is killed while saving its fourth checkpoint
+        if len(checkpoints) == 3:
+            raise RuntimeError("worker killed")
+        checkpoints.append(frontier)
+        assert drive_cache.checkpoint_crawl("u1", "worker-a", items, frontier, folders_done)
+
+    with pytest.raises(RuntimeError, match="worker killed"):
+        asyncio.run(google_service.crawl_drive_tree(None, user_id="u1", max_concurrency=3,
+                                                    on_checkpoint=checkpoint_then_die))
+    saved = drive_cache.load_crawl("u1")
+    assert saved["frontier"] == [tuple(f) for f in checkpoints[-1]]
+    assert 0 < saved["folders_done"] < folder_count
+
+    # Another worker takes over once the lease has run out
+    clock[0] += google_service.CRAWL_LEASE_SECONDS + 1
+    crawl = drive_cache.claim_crawl("u1", "worker-b", google_service.CRAWL_LEASE_SECONDS)
+    drive.listed.clear()
+
+    def checkpoint(items, frontier, folders_done):
+        assert drive_cache.checkpoint_crawl("u1", "worker-b", items, frontier, folders_done)
+
+    asyncio.run(google_service.crawl_drive_tree(None, user_id="u1", max_concurrency=3,
+                                                frontier=crawl["frontier"], on_checkpoint=checkpoint))
+    assert drive_cache.finish_crawl("u1", "worker-b")
+
+    # Only the folders still in the saved frontier (and their subfolders) are listed again
+    assert len(drive.listed) == len(set(drive.listed)) == folder_count - saved["folders_done"]
+    assert sorted((i["id"], i["path"]) for i in drive_cache.load_index("u1")) == \
+        sorted((i["id"], i["path"]) for i in expected)
+    assert drive_cache.load_crawl("u1") is None
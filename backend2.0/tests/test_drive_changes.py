@@ -0,0 +1,111 @@
+# tests/test_drive_changes.py
+# Run from backend2.0: python -m pytest -q
+
+import random
+
+from services.drive_changes import apply_drive_changes
+
+ROOT = "root"
+FOLDER = "application/vnd.google-apps.folder"
+DOC = "application/vnd.google-apps.document"
+
+
+def crawl(files: dict[str, dict]) -> dict[str, str]:
+    """id -> path, as a fresh crawl from the root would see the tree."""
+    children: dict[str, list[str]] = {}
+    for file_id, f in files.items():
+        children.setdefault(f["parents"][0], []).append(file_id)
+    paths = {}
+    stack = [(ROOT, "")]
+    while stack:
+        parent_id, parent_path = stack.pop()
+        for child_id in children.get(parent_id, []):
+            name = files[child_id]["name"]
+            paths[child_id] = f"{parent_path}/{name}" if parent_path else name
+            if files[child_id]["mimeType"] == FOLDER:
+                stack.append((child_id, paths[child_id]))
+    return paths
+
+def index_of(files: dict[str, dict]) -> list[dict]:
+    return [{**files[file_id], "id": file_id, "path": path} for file_id, path in crawl(files).items()]
+
+def change(file_id: str, files: dict[str, dict]) -> dict:
+    if file_id not in files:
+        return {"fileId": file_id, "removed": True}
+    return {"fileId": file_id, "file": {"id": file_id, **files[file_id]}}
+
+def paths_of(index: list[dict]) -> dict[str, str]:
+    return {item["id"]: item["path"] for item in index}
+
+
+def test_move_under_unchanged_folder_whose_ancestor_moved():
+    files = {
+        "f0": {"name": "n0", "mimeType": FOLDER, "parents": [ROOT]},
+        "f9": {"name": "n9", "mimeType": FOLDER, "parents": ["f0"]},
+        "f5": {"name": "m5", "mimeType": FOLDER, "parents": ["f9"]},
+        "f1": {"name": "n1", "mimeType": FOLDER, "parents": [ROOT]},
+        "f4": {"name": "n4", "mimeType": FOLDER, "parents": ["f1"]},
+        "f3": {"name": "m55", "mimeType": DOC, "parents": [ROOT]},
+    }
+    index = index_of(files)
+    files["f3"]["parents"] = ["f4"]  # into the unchanged folder f4...
+    files["f1"]["parents"] = ["f5"]  # ...whose ancestor f1 moves in the same batch
+    new_index, _, _ = apply_drive_changes(index, [change("f3", files), change("f1", files)], ROOT)
+    assert paths_of(new_index)["f3"] == "n0/n9/m5/n1/n4/m55"
+    assert paths_of(new_index) == crawl(files)
+
+
+def test_random_change_batches_match_a_fresh_crawl():
+    rng = random.Random(1234)
+    for _ in range(2000):
+        files: dict[str, dict] = {}
+        for i in range(rng.randint(1, 25)):
+            folders = [file_id for file_id, f in files.items() if f["mimeType"] == FOLDER]
+            files[f"f{i}"] = {
+                "name": f"n{i}",
+                "mimeType": rng.choice((FOLDER, DOC)),
+                "parents": [rng.choice(folders + [ROOT])],
+            }
+        index = index_of(files)
+        stored = {item["id"]: item for item in index}
+
+        touched: set[str] = set()
+        next_id = len(files)
+        for _ in range(rng.randint(1, 6)):
+            if not files:
+                break
+            file_id = rng.choice(sorted(files))
+            op = rng.random()
+            if op < 0.45:
+                # Move, never below itself
+                below = {file_id}
+                grew = True
+                while grew:
+                    extra = {c for c, f in files.items() if f["parents"][0] in below} - below
+                    below |= extra
+                    grew = bool(extra)
+                targets = [c for c, f in files.items() if f["mimeType"] == FOLDER and c not in below]
+                files[file_id]["parents"] = [rng.choice(targets + [ROOT])]
+            elif op < 0.65:
+                files[file_id]["name"] = f"m{rng.randint(0, 99)}"
+            elif op < 0.8:
+                del files[file_id]
+            else:
+                folders = [c for c, f in files.items() if f["mimeType"] == FOLDER]
+                file_id = f"f{next_id}"
+                next_id += 1
+                files[file_id] = {"name": f"n{file_id}", "mimeType": rng.choice((FOLDER, DOC)),
+                                  "parents": [rng.choice(folders + [ROOT])]}
+            touched.add(file_id)
+
+        # Drive reports each touched file once, in its latest state
+        changes = [change(file_id, files) for file_id in sorted(touched)]
+        new_index, upserted, deleted = apply_drive_changes(index, changes, ROOT)
+        expected = crawl(files)
+        assert paths_of(new_index) == expected
+
+        # The delta alone brings the stored index to the same state
+        for file_id in deleted:
+            stored.pop(file_id, None)
+        stored.update({item["id"]: item for item in upserted})
+        assert paths_of(list(stored.values())) == expected
@@ -0,0 +1,93 @@
+# tests/test_job_queue.py
+# Run from backend2.0: python -m pytest -q
+
+import asyncio
+import threading
+
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+from services import job_queue
+
+
+@pytest.fixture(autouse=True)
+def queue(tmp_path, monkeypatch):
+    monkeypatch.setattr(job_queue, "JOB_DB_PATH", tmp_path / "jobs.db")
+    monkeypatch.setattr(job_queue, "_local", threading.local())
+    monkeypatch.setattr(job_queue, "_queue", None)
+    monkeypatch.setattr(job_queue, "_tasks", [])
+    monkeypatch.setattr(job_queue, "JOB_RETRY_BASE_SECONDS", 0.01)
+
+
+def run_job(handler, max_attempts=3, on_failure=None) -> dict:
+    """Submits `handler` and waits for the job to finish; returns its record."""
+    async def main():
+        job_id = job_queue.submit("u1", "test", handler, max_attempts=max_attempts, on_failure=on_failure)
+        try:
+            for _ in range(500):
+                job = job_queue.get_job(job_id, "u1")
+                if job["state"] in (job_queue.SUCCEEDED, job_queue.FAILED):
+                    return job
+                await asyncio.sleep(0.01)
+            raise AssertionError(f"job still {job['state']}")
+        finally:
+            await job_queue.shutdown()
+    return asyncio.run(main())
+
+def http_error(status: int) -> HttpError:
+    return HttpError(httplib2.Response({"status": status}), b"")
+
+def failing(errors: list[Exception], result=None):
+    """A handler raising each of `errors` in turn, then returning `result`."""
+    calls = []
+
+    async def handler(report):
+        calls.append(len(calls) + 1)
+        await report("working", attempt=len(calls))
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return result
+    return handler, calls
+
+
+def test_retryable_errors_are_retried_until_success():
+    errors = [job_queue.RetryableJobError("busy"), http_error(503)]
+    handler, calls = failing(errors, result={"doc_id": "d1"})
+    job = run_job(handler)
+
+    assert job["state"] == job_queue.SUCCEEDED
+    assert job["attempts"] == 3 and calls == [1, 2, 3]
+    assert job["result"] == {"doc_id": "d1"}
+    assert job["error"] is None
+
+def test_job_fails_for_good_after_max_attempts():
+    failures = []
+    handler, calls = failing([TimeoutError("slow")] * 5)
+    job = run_job(handler, max_attempts=3, on_failure=failures.append)
+
+    assert job["state"] == job_queue.FAILED
+    assert job["attempts"] == 3 and len(calls) == 3
+    assert job["error"] == "slow"
+    assert failures == ["slow"]
+
+@pytest.mark.parametrize("error", [
+    job_queue.JobFailed("That folder no longer exists."),
+    ValueError("bad input"),
+    http_error(404),
+])
+def test_permanent_errors_are_not_retried(error):
+    failures = []
+    handler, calls = failing([error] * 3)
+    job = run_job(handler, on_failure=failures.append)
+
+    assert job["state"] == job_queue.FAILED
+    assert job["attempts"] == 1 and calls == [1]
+    assert failures == [job["error"]]
+
+def test_is_retryable():
+    assert job_queue.is_retryable(job_queue.RetryableJobError())
+    assert job_queue.is_retryable(asyncio.TimeoutError())
+    assert job_queue.is_retryable(http_error(429))
+    assert not job_queue.is_retryable(http_error(403))
+    assert not job_queue.is_retryable(job_queue.JobFailed("no"))
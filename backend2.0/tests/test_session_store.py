@@ -0,0 +1,87 @@
+# tests/test_session_store.py
+# Run from backend2.0: python -m pytest -q
+
+import threading
+
+import pytest
+
+from services import session_store
+
+TTL = 60.0
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return session_store.MemorySessionStore()
+    return session_store.SQLiteSessionStore(tmp_path / "sessions.db")
+
+
+def test_transition_from_the_expected_state(store):
+    store.set("pending", "u1", {"state": "createDoc_confirm", "title": "Plan"}, TTL)
+
+    assert store.transition("pending", "u1", "createDoc_confirm", {"state": "createDoc_content", "title": "Plan"}, TTL)
+    assert store.get("pending", "u1") == {"state": "createDoc_content", "title": "Plan"}
+
+    # None clears the flow
+    assert store.transition("pending", "u1", "createDoc_content", None, TTL)
+    assert store.get("pending", "u1") is None
+
+def test_transition_from_another_state_is_refused(store):
+    pending = {"state": "moveDoc_target_pending", "doc": "Plan"}
+    store.set("pending", "u1", pending, TTL)
+
+    assert not store.transition("pending", "u1", "moveDoc_confirm", {"state": "done"}, TTL)
+    assert not store.transition("pending", "u1", "moveDoc_confirm", None, TTL)
+    assert store.get("pending", "u1") == pending
+
+def test_transition_without_a_pending_flow_is_refused(store):
+    assert not store.transition("pending", "u1", "createDoc_confirm", {"state": "createDoc_content"}, TTL)
+    assert store.get("pending", "u1") is None
+    # Other users' and namespaces' entries don't count
+    store.set("pending", "u2", {"state": "createDoc_confirm"}, TTL)
+    store.set("history", "u1", {"state": "createDoc_confirm"}, TTL)
+    assert not store.transition("pending", "u1", "createDoc_confirm", None, TTL)
+
+def test_transition_from_an_expired_flow_is_refused(store):
+    store.set("pending", "u1", {"state": "createDoc_confirm"}, -1)
+    assert not store.transition("pending", "u1", "createDoc_confirm", {"state": "createDoc_content"}, TTL)
+    assert store.get("pending", "u1") is None
+
+def test_oversized_transition_leaves_the_flow_unchanged(store, monkeypatch):
+    monkeypatch.setattr(session_store, "MAX_VALUE_BYTES", 100)
+    store.set("pending", "u1", {"state": "createDoc_confirm"}, TTL)
+    with pytest.raises(session_store.ValueTooLarge):
+        store.transition("pending", "u1", "createDoc_confirm", {"state": "x", "preview": "." * 200}, TTL)
+    assert store.get("pending", "u1") == {"state": "createDoc_confirm"}
+
+def test_only_one_worker_wins_a_racing_transition(tmp_path):
+    path = tmp_path / "sessions.db"
+    session_store.SQLiteSessionStore(path).set("pending", "u1", {"state": "moveDoc_confirm"}, TTL)
+
+    # One store per thread, like separate gunicorn workers answering "Yes" twice
+    results = {}
+    barrier = threading.Barrier(8)
+
+    def confirm(n):
+        worker_store = session_store.SQLiteSessionStore(path)
+        barrier.wait()
+        results[n] = worker_store.transition("pending", "u1", "moveDoc_confirm", {"state": f"moved-{n}"}, TTL)
+
+    threads = [threading.Thread(target=confirm, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    winners = [n for n, won in results.items() if won]
+    assert len(results) == 8 and len(winners) == 1
+    assert session_store.SQLiteSessionStore(path).get("pending", "u1") == {"state": f"moved-{winners[0]}"}
+
+def test_transition_pending_uses_the_pending_namespace(monkeypatch):
+    monkeypatch.setattr(session_store, "store", session_store.MemorySessionStore())
+    session_store.set_pending("u1", {"state": "createDoc_confirm"})
+
+    assert not session_store.transition_pending("u1", "moveDoc_confirm", None)
+    assert session_store.transition_pending("u1", "createDoc_confirm", {"state": "createDoc_content"})
+    assert session_store.get_pending("u1") == {"state": "createDoc_content"}
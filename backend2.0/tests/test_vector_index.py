@@ -0,0 +1,65 @@
+# tests/test_vector_index.py
+# Run from backend2.0: python -m pytest -q
+
+import asyncio
+
+import pytest
+
+from services import vector_index
+from services.embeddings import HashingEmbeddingProvider
+
+DOC = "application/vnd.google-apps.document"
+
+
+def paragraph(topic: str, n: int = 60) -> str:
+    return " ".join(f"{topic} note {i} about the {topic} plan." for i in range(n))
+
+def document(*topics: str) -> str:
+    return "\n\n".join(paragraph(topic) for topic in topics)
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(vector_index, "VECTOR_DIR", tmp_path)
+    monkeypatch.setattr(vector_index, "get_provider", lambda: HashingEmbeddingProvider(dim=64))
+    return vector_index.VectorStore("user-1")
+
+
+def test_unchanged_passages_are_not_embedded_again(store):
+    item = {"id": "doc-1", "name": "Plans", "mimeType": DOC, "modifiedTime": "2024-01-01T00:00:00Z"}
+    text = document("budget", "hiring", "travel")
+    first = asyncio.run(store.update_documents([(item, text)]))
+    assert first > 1
+
+    # Touched but unchanged: every passage hash is known
+    item = {**item, "modifiedTime": "2024-01-02T00:00:00Z"}
+    assert asyncio.run(store.update_documents([(item, text)])) == 0
+    assert store.indexed_versions() == {"doc-1": "2024-01-02T00:00:00Z"}
+
+    # One paragraph rewritten: only its passages are embedded
+    edited = document("budget", "offsites", "travel")
+    embedded = asyncio.run(store.update_documents([(item, edited)]))
+    assert 0 < embedded < first
+    assert store.passage_count() == len({vector_index._hash(c) for c in vector_index._splitter.split_text(edited)})
+
+
+def test_compaction_keeps_search_results(store, monkeypatch):
+    docs = [
+        ({"id": f"doc-{i}", "name": f"Doc {i}", "mimeType": DOC, "modifiedTime": "1"}, document(*topics))
+        for i, topics in enumerate([("budget", "travel"), ("hiring", "budget"), ("travel", "offsites"),
+                                    ("roadmap", "hiring"), ("budget", "roadmap"), ("offsites", "travel")])
+    ]
+    asyncio.run(store.update_documents(docs))
+    store.remove_documents(["doc-2", "doc-3", "doc-4", "doc-5"])
+    queries = ["budget plan", "hiring note 7", "travel"]
+    before = [asyncio.run(store.search(q, k=4)) for q in queries]
+    assert all(before)
+
+    # Now small enough to trigger: the dead rows are at least half of the matrix
+    monkeypatch.setattr(vector_index, "INITIAL_CAPACITY", 4)
+    store._maybe_compact()
+    total = store._db().execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+    assert total == store.passage_count()
+
+    after = [asyncio.run(store.search(q, k=4)) for q in queries]
+    assert after == before
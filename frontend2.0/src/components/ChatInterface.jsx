@@ -35,6 +35,89 @@ function ChatInterface({ backendUrl }) {
     fetchInitialData();
   }, [backendUrl]);
 
+  // Status lines shown (until the first token arrives) for backend state events
+  const STAGE_LABELS = {
+    document_loaded: 'Reading document...',
+    preview_ready: 'Preview ready.',
+    analyzing: (data) => `Analyzing section ${data.done} of ${data.total}...`,
+  };
+
+  // Status lines for the stages of background jobs (GET /api/jobs/{id})
+  const JOB_STAGE_LABELS = {
+    generating: 'Writing the document...',
+    creating: 'Creating the Google Doc...',
+    moving: 'Moving file...',
+    updating: 'Updating the document...',
+  };
+  const JOB_POLL_INTERVAL_MS = 1000;
+  const JOB_POLL_MAX_ERRORS = 10;
+
+  // Polls a background job, showing its stage in message `messageId` and then its outcome
+  const pollJob = async (jobId, messageId, queuedText) => {
+    const showInMessage = (text) => {
+      setMessages((prev) => prev.map((m) => (m.id === messageId ? { ...m, text } : m)));
+    };
+    let errors = 0;
+    while (true) {
+      await new Promise((resolve) => setTimeout(resolve, JOB_POLL_INTERVAL_MS));
+      let job;
+      try {
+        job = (await axios.get(`${backendUrl}/api/jobs/${jobId}`, { withCredentials: true })).data;
+        errors = 0;
+      } catch (error) {
+        errors += 1;
+        if (error.response?.status === 404 || errors >= JOB_POLL_MAX_ERRORS) {
+          showInMessage("⚠️ Lost track of that task. Please check your Drive.");
+          return;
+        }
+        continue;
+      }
+      if (job.state === 'succeeded') {
+        showInMessage(job.result?.message || 'Done.');
+        return;
+      }
+      if (job.state === 'failed') {
+        showInMessage(job.error || '⚠️ That task failed. Please try again.');
+        return;
+      }
+      const stage = job.state === 'retrying' ? 'Hit a temporary error, retrying...' : JOB_STAGE_LABELS[job.stage];
+      showInMessage(stage ? `${queuedText}\n\n_${stage}_` : queuedText);
+    }
+  };
+
+  // POSTs to /api/ask/stream and calls onEvent(eventName, data) for each Server-Sent Event
+  const streamAsk = async (body, onEvent) => {
+    const response = await fetch(`${backendUrl}/api/ask/stream`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      credentials: 'include',
+      body: JSON.stringify(body),
+    });
+    if (!response.ok || !response.body) {
+      throw new Error(`Request failed with status ${response.status}`);
+    }
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+      let boundary;
+      while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+        const rawEvent = buffer.slice(0, boundary);
+        buffer = buffer.slice(boundary + 2);
+        let eventName = 'message';
+        let data = '';
+        for (const line of rawEvent.split('\n')) {
+          if (line.startsWith('event: ')) eventName = line.slice(7);
+          else if (line.startsWith('data: ')) data += line.slice(6);
+        }
+        onEvent(eventName, data ? JSON.parse(data) : {});
+      }
+    }
+  };
+
   const handleInputChange = (event) => {
     setInputValue(event.target.value);
   };
@@ -66,13 +149,39 @@ function ChatInterface({ backendUrl }) {
 
     setIsLoading(true);
 
+    // Placeholder agent message that fills in as tokens stream in
+    const streamingId = `stream_${Date.now()}`;
+    const showStreaming = (text) => {
+      setMessages((prev) => [...prev.filter((m) => m.id !== streamingId), { id: streamingId, sender: 'agent', text }]);
+    };
+
     try {
-      const response = await axios.post(`${backendUrl}/api/ask`, {
+      let streamedText = '';
+      let finalData = null;
+      let streamError = null;
+      await streamAsk({
         message: messageToSend, // Send original text even for buttons
         confirmation: confirmationToSend,
         regenerate: regenerateToSend,
         skip_preview: skipToSend,
-      }, { withCredentials: true });
+      }, (event, data) => {
+        if (event === 'token') {
+          streamedText += data.text;
+          showStreaming(streamedText);
+        } else if (event === 'state') {
+          const label = STAGE_LABELS[data.stage];
+          const labelText = typeof label === 'function' ? label(data) : label;
+          if (labelText && !streamedText) showStreaming(`_${labelText}_`);
+        } else if (event === 'done') {
+          finalData = data;
+        } else if (event === 'error') {
+          streamError = data;
+        }
+      });
+      if (streamError) {
+        throw new Error(streamError.detail || 'Request failed');
+      }
+      const response = { data: finalData || {} };
 
       const agentMessage = { // Construct agent message object
         id: response.data.messageId || `agent_${Date.now()}`,
@@ -84,10 +193,15 @@ function ChatInterface({ backendUrl }) {
         allowSkip: response.data.allowSkip || false
       };
       
-      // --- Add AGENT message ---
-      setMessages((prev) => [...prev, agentMessage]); // Add agent message
+      // --- Replace the streamed placeholder with the final AGENT message ---
+      setMessages((prev) => [...prev.filter((m) => m.id !== streamingId), agentMessage]);
       console.log("Added agent message:", agentMessage);
 
+      // Slow actions run as background jobs; keep the chat usable while they finish
+      if (response.data.jobId) {
+        pollJob(response.data.jobId, agentMessage.id, agentMessage.text);
+      }
+
       // --- Update confirmation state based on agent response ---
       if (agentMessage.needsConfirmation) {
         console.log(`Setting confirmation pending for Msg ID: ${agentMessage.id}, Type: ${agentMessage.confirmationType}, Regen: ${agentMessage.allowRegenerate}, Skip: ${agentMessage.allowSkip}`);
@@ -107,7 +221,7 @@ function ChatInterface({ backendUrl }) {
     } catch (error) {
       console.error("Error sending message:", error);
       const errorMsg = { id: `agent_${Date.now()}`, sender: 'agent', text: "⚠️ Error connecting to the backend." };
-      setMessages((prev) => [...prev, errorMsg]);
+      setMessages((prev) => [...prev.filter((m) => m.id !== streamingId), errorMsg]);
       // Clear confirmation state on error too
       setConfirmationPendingMsgId(null);
       setConfirmationType(null);